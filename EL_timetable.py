@@ -1,11 +1,34 @@
 import os
 import io
+import gzip
+import zipfile
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import json
+import queue
 import calendar
+import click
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, date, timedelta
-from flask import Flask, request, redirect, url_for, render_template_string, flash, send_file
+from decimal import Decimal, ROUND_HALF_UP
+from flask import Flask, Response, request, redirect, url_for, render_template_string, flash, send_file
+from markupsafe import escape
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import extract, func
+from sqlalchemy import event, func, text, case, and_, or_, literal, null, select, union_all
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import aliased, attributes, joinedload
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.schema import CreateTable
 
 # -------------------------
 # Flask setup
@@ -14,6 +37,14 @@ app = Flask(__name__)
 app.config["SECRET_KEY"] = "change-me"
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///schedule.db"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config["OPENING_TIME"] = os.environ.get("OPENING_TIME", "08:00")
+app.config["CLOSING_TIME"] = os.environ.get("CLOSING_TIME", "21:00")
+app.config["LOG_RETENTION_DAYS"] = int(os.environ.get("LOG_RETENTION_DAYS", 180))
+app.config["LOG_ARCHIVE_DIR"] = os.environ.get("LOG_ARCHIVE_DIR", os.path.join(app.instance_path, "log_archive"))
+app.config["BACKUP_DIR"] = os.environ.get("BACKUP_DIR", os.path.join(app.instance_path, "backups"))
+app.config["BACKUP_RETENTION"] = int(os.environ.get("BACKUP_RETENTION", 14))
+app.config["BACKUP_INTERVAL_HOURS"] = float(os.environ.get("BACKUP_INTERVAL_HOURS", 0))  # 0 = no in-process job
+app.config["ARCHIVE_DELETES"] = os.environ.get("ARCHIVE_DELETES", "0") == "1"  # copy deleted rows to archive_* tables
 db = SQLAlchemy(app)
 
 # -------------------------
@@ -28,8 +59,8 @@ class Teacher(db.Model):
 
 # Many-to-many link table between students and subjects
 student_subjects = db.Table("student_subjects",
-    db.Column("student_id", db.Integer, db.ForeignKey("student.id")),
-    db.Column("subject_id", db.Integer, db.ForeignKey("subject.id"))
+    db.Column("student_id", db.Integer, db.ForeignKey("student.id", ondelete="CASCADE")),
+    db.Column("subject_id", db.Integer, db.ForeignKey("subject.id", ondelete="CASCADE"))
 )
 
 class Student(db.Model):
@@ -57,41 +88,63 @@ class Subject(db.Model):
     price = db.Column(db.Float, nullable=False)
     number_of_classes = db.Column(db.Integer, nullable=False)
     discount = db.Column(db.Float, default=0.0)  # percentage discount
+    teacher_rate_cents = db.Column(db.Integer, nullable=False, default=0, server_default="0")  # teacher pay per hour
 
 class ClassSession(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    teacher_id = db.Column(db.Integer, db.ForeignKey("teacher.id"), nullable=False)
-    student_id = db.Column(db.Integer, db.ForeignKey("student.id"), nullable=False)
-    subject_id = db.Column(db.Integer, db.ForeignKey("subject.id"), nullable=False)
+    teacher_id = db.Column(db.Integer, db.ForeignKey("teacher.id", ondelete="CASCADE"), nullable=False)
+    student_id = db.Column(db.Integer, db.ForeignKey("student.id", ondelete="CASCADE"), nullable=False)
+    subject_id = db.Column(db.Integer, db.ForeignKey("subject.id", ondelete="CASCADE"), nullable=False)
     session_date = db.Column(db.Date, nullable=False)
     start_time = db.Column(db.Time, nullable=False)
     end_time = db.Column(db.Time, nullable=False)
     notes = db.Column(db.String(255), nullable=True)
 
-    teacher = db.relationship("Teacher", backref=db.backref("sessions", lazy=True))
-    student = db.relationship("Student", backref=db.backref("sessions", lazy=True))
-    subject = db.relationship("Subject", backref=db.backref("sessions", lazy=True))
+    # passive_deletes: the database removes a deleted parent's rows, the ORM doesn't load them first
+    teacher = db.relationship("Teacher", backref=db.backref("sessions", lazy=True, passive_deletes=True))
+    student = db.relationship("Student", backref=db.backref("sessions", lazy=True, passive_deletes=True))
+    subject = db.relationship("Subject", backref=db.backref("sessions", lazy=True, passive_deletes=True))
+
+    # Range scans for timetables and filtered exports
+    __table_args__ = (
+        db.Index("ix_class_session_date_start", "session_date", "start_time"),
+        db.Index("ix_class_session_teacher_date", "teacher_id", "session_date", "start_time"),
+        db.Index("ix_class_session_student_date", "student_id", "session_date", "start_time"),
+        db.Index("ix_class_session_subject_date", "subject_id", "session_date"),
+    )
 
 class Payment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    student_id = db.Column(db.Integer, db.ForeignKey("student.id"), nullable=False)
-    subject_id = db.Column(db.Integer, db.ForeignKey("subject.id"), nullable=False)
+    student_id = db.Column(db.Integer, db.ForeignKey("student.id", ondelete="CASCADE"), nullable=False)
+    subject_id = db.Column(db.Integer, db.ForeignKey("subject.id", ondelete="CASCADE"), nullable=False)
     amount = db.Column(db.Float, nullable=False)
     date = db.Column(db.Date, default=date.today)
     method = db.Column(db.String(50), nullable=True)  # cash, card, transfer
 
-    student = db.relationship("Student", backref=db.backref("payments", lazy=True))
-    subject = db.relationship("Subject", backref=db.backref("payments", lazy=True))
+    student = db.relationship("Student", backref=db.backref("payments", lazy=True, passive_deletes=True))
+    subject = db.relationship("Subject", backref=db.backref("payments", lazy=True, passive_deletes=True))
+
+    __table_args__ = (
+        db.Index("ix_payment_date", "date"),
+        db.Index("ix_payment_student_subject", "student_id", "subject_id"),
+    )
 
 class Attendance(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    session_id = db.Column(db.Integer, db.ForeignKey("class_session.id"), nullable=False)
-    student_id = db.Column(db.Integer, db.ForeignKey("student.id"), nullable=False)
+    session_id = db.Column(db.Integer, db.ForeignKey("class_session.id", ondelete="CASCADE"), nullable=False)
+    student_id = db.Column(db.Integer, db.ForeignKey("student.id", ondelete="CASCADE"), nullable=False)
     status = db.Column(db.String(20), nullable=False)  # Arrived, Late, Absent, Vacation
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
-    session = db.relationship("ClassSession", backref=db.backref("attendance", lazy=True))
-    student = db.relationship("Student", backref=db.backref("attendance", lazy=True))
+    session = db.relationship("ClassSession", backref=db.backref("attendance", lazy=True, passive_deletes=True))
+    student = db.relationship("Student", backref=db.backref("attendance", lazy=True, passive_deletes=True))
+
+    # One mark per student per session; re-marking updates the existing row
+    __table_args__ = (
+        db.Index("uq_attendance_session_student", "session_id", "student_id", unique=True),
+        db.Index("ix_attendance_timestamp", "timestamp"),
+        db.Index("ix_attendance_student_status", "student_id", "status"),
+    )
 
 class LogEntry(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -99,6 +152,273 @@ class LogEntry(db.Model):
     details = db.Column(db.String(255), nullable=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index("ix_log_entry_timestamp", "timestamp"),
+        db.Index("ix_log_entry_action_timestamp", "action", "timestamp"),
+    )
+
+class TeacherAvailability(db.Model):
+    """A weekly window in which a teacher can be scheduled (weekday 0 = Monday)."""
+    id = db.Column(db.Integer, primary_key=True)
+    teacher_id = db.Column(db.Integer, db.ForeignKey("teacher.id", ondelete="CASCADE"), nullable=False)
+    weekday = db.Column(db.Integer, nullable=False)
+    start_time = db.Column(db.Time, nullable=False)
+    end_time = db.Column(db.Time, nullable=False)
+
+    teacher = db.relationship("Teacher", backref=db.backref("availability", lazy=True, passive_deletes=True))
+
+    __table_args__ = (
+        db.Index("ix_teacher_availability_teacher_weekday", "teacher_id", "weekday"),
+    )
+
+class AttendanceStat(db.Model):
+    """Attendance marks counted per (student, teacher, subject, month, status), kept in step with Attendance."""
+    student_id = db.Column(db.Integer, primary_key=True)
+    teacher_id = db.Column(db.Integer, primary_key=True)
+    subject_id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.String(7), primary_key=True)  # YYYY-MM of the session date
+    status = db.Column(db.String(20), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index("ix_attendance_stat_teacher_month", "teacher_id", "month"),
+        db.Index("ix_attendance_stat_subject_month", "subject_id", "month"),
+        db.Index("ix_attendance_stat_month", "month"),
+    )
+
+class AttendanceStreak(db.Model):
+    """Each student's latest absence and the Arrived/Late marks after it, kept in step with Attendance."""
+    student_id = db.Column(db.Integer, primary_key=True)
+    last_absent = db.Column(db.Date, nullable=True)
+    streak = db.Column(db.Integer, nullable=False, default=0)
+
+class PackageUsage(db.Model):
+    """Classes used (attendance marked Arrived or Late) per student and subject, kept in step with Attendance."""
+    student_id = db.Column(db.Integer, primary_key=True)
+    subject_id = db.Column(db.Integer, primary_key=True)
+    used = db.Column(db.Integer, nullable=False, default=0)
+
+class ChangeLog(db.Model):
+    """One row per insert, update or delete of a session, attendance mark or payment.
+
+    Written in the same transaction as the change; version only ever grows
+    (AUTOINCREMENT never reuses a number, and restore_backup keeps the
+    sequence), so clients sync from the last version they saw.
+    """
+    version = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)  # session, attendance, payment
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)  # insert, update, delete
+    # Owner columns so feeds can be filtered without joining back to deleted rows
+    teacher_id = db.Column(db.Integer, nullable=True)
+    student_id = db.Column(db.Integer, nullable=True)
+    session_date = db.Column(db.Date, nullable=True)
+    changed_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_change_log_teacher_version", "teacher_id", "version"),
+        db.Index("ix_change_log_student_version", "student_id", "version"),
+        {"sqlite_autoincrement": True},
+    )
+
+class LedgerEntry(db.Model):
+    """One money movement for a student and subject in integer cents: charges positive, payments negative."""
+    id = db.Column(db.Integer, primary_key=True)
+    student_id = db.Column(db.Integer, db.ForeignKey("student.id", ondelete="CASCADE"), nullable=False)
+    subject_id = db.Column(db.Integer, db.ForeignKey("subject.id", ondelete="CASCADE"), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # charge, reversal, payment
+    amount_cents = db.Column(db.Integer, nullable=False)
+    payment_id = db.Column(db.Integer, db.ForeignKey("payment.id", ondelete="CASCADE"), nullable=True)
+    note = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_ledger_entry_student_subject", "student_id", "subject_id"),
+        db.Index("ix_ledger_entry_payment", "payment_id"),
+    )
+
+class Balance(db.Model):
+    """Running ledger totals per (student, subject), updated in the same transaction as each entry."""
+    student_id = db.Column(db.Integer, primary_key=True)
+    subject_id = db.Column(db.Integer, primary_key=True)
+    charged_cents = db.Column(db.Integer, nullable=False, default=0)
+    paid_cents = db.Column(db.Integer, nullable=False, default=0)
+    balance_cents = db.Column(db.Integer, nullable=False, default=0)  # charged - paid; negative is credit
+
+    __table_args__ = (
+        db.Index("ix_balance_balance", "balance_cents"),
+    )
+
+# Copies of rows removed by a delete in archive mode (ARCHIVE_DELETES), one
+# table per source table: the source columns without constraints, plus when
+# and along with which teacher/student/subject the row was archived.
+ARCHIVED_TABLES = [Teacher.__table__, Student.__table__, Subject.__table__, student_subjects,
+                   ClassSession.__table__, Attendance.__table__, Payment.__table__,
+                   TeacherAvailability.__table__, LedgerEntry.__table__]
+
+def _archive_table(table):
+    return db.Table(
+        f"archive_{table.name}",
+        db.Column("archive_id", db.Integer, primary_key=True),
+        *[db.Column(c.name, c.type) for c in table.columns],
+        db.Column("archived_at", db.DateTime, nullable=False),
+        db.Column("archived_with", db.String(40), nullable=False),  # e.g. "teacher 3"
+    )
+
+archive_tables = {table.name: _archive_table(table) for table in ARCHIVED_TABLES}
+
+# -------------------------
+# Schema maintenance
+# -------------------------
+@event.listens_for(Engine, "connect")
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite enforces foreign keys (and so ON DELETE CASCADE) only when each connection asks
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+def ensure_foreign_keys():
+    """Rebuild tables whose foreign keys lack the model's ON DELETE action.
+
+    SQLite cannot alter a constraint, so each such table is recreated and its
+    rows copied across, following SQLite's documented create/copy/drop/rename
+    sequence. Rows pointing at parents that no longer exist are not carried
+    over; they are copied to the table's archive_ table first, tagged
+    "orphaned", and counted in the report. Indexes are recreated afterwards by
+    ensure_schema.
+    """
+    now = datetime.utcnow()
+    with db.engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
+        try:
+            for table in db.metadata.sorted_tables:
+                wanted = {(fk.parent.name, fk.column.table.name, fk.ondelete or "NO ACTION")
+                          for fk in table.foreign_keys}
+                if not wanted:
+                    continue
+                actual = {(row[3], row[2], row[6]) for row in
+                          conn.exec_driver_sql(f"PRAGMA foreign_key_list({table.name})")}
+                if wanted <= actual:
+                    continue
+                existing = {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table.name})")}
+                columns = ", ".join(c.name for c in table.columns if c.name in existing)
+                parents = " AND ".join(
+                    f"({fk.parent.name} IS NULL OR {fk.parent.name} IN "
+                    f"(SELECT {fk.column.name} FROM {fk.column.table.name}))"
+                    for fk in table.foreign_keys
+                )
+                archived = conn.execute(archive_tables[table.name].insert().from_select(
+                    [c.name for c in table.columns if c.name in existing] + ["archived_at", "archived_with"],
+                    select(*[c for c in table.columns if c.name in existing],
+                           literal(now), literal("orphaned")).where(text(f"NOT ({parents})"))
+                )).rowcount
+                create = str(CreateTable(table).compile(dialect=conn.dialect))
+                assert f"CREATE TABLE {table.name} (" in create
+                conn.exec_driver_sql(create.replace(f"CREATE TABLE {table.name} (",
+                                                    f"CREATE TABLE {table.name}__new (", 1))
+                conn.exec_driver_sql(f"INSERT INTO {table.name}__new ({columns}) "
+                                     f"SELECT {columns} FROM {table.name} WHERE {parents}")
+                conn.exec_driver_sql(f"DROP TABLE {table.name}")
+                conn.exec_driver_sql(f"ALTER TABLE {table.name}__new RENAME TO {table.name}")
+                print(f"Rebuilt {table.name} with ON DELETE foreign keys." +
+                      (f" Moved {archived} orphaned rows to archive_{table.name}." if archived else ""))
+            conn.commit()
+        finally:
+            conn.exec_driver_sql("PRAGMA foreign_keys=ON")
+
+def ensure_column(model, name):
+    """Add a model column that an older database's table was created without."""
+    table = model.__table__
+    existing = {row[1] for row in db.session.execute(text(f"PRAGMA table_info({table.name})"))}
+    if name in existing:
+        return
+    column = table.c[name]
+    ddl = f"ALTER TABLE {table.name} ADD COLUMN {name} {column.type.compile(db.engine.dialect)}"
+    if column.server_default is not None:
+        ddl += f" NOT NULL DEFAULT {column.server_default.arg}" if not column.nullable else \
+            f" DEFAULT {column.server_default.arg}"
+    db.session.execute(text(ddl))
+    db.session.commit()
+
+def ensure_schema():
+    """Create missing tables, then any columns and indexes added since the tables were created."""
+    db.create_all()
+    ensure_column(Subject, "teacher_rate_cents")
+    ensure_foreign_keys()
+    # Older databases may hold repeated marks; keep the latest so the unique index can be built
+    db.session.execute(text(
+        "DELETE FROM attendance WHERE id NOT IN "
+        "(SELECT MAX(id) FROM attendance GROUP BY session_id, student_id)"
+    ))
+    db.session.commit()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    # Backfill the attendance summary the first time it exists alongside attendance history
+    if not (db.session.query(AttendanceStat.query.exists()).scalar() and
+            db.session.query(PackageUsage.query.exists()).scalar() and
+            db.session.query(AttendanceStreak.query.exists()).scalar()) and \
+            db.session.query(Attendance.query.exists()).scalar():
+        rebuild_attendance_stats()
+    # Likewise open the ledger from existing enrollments and payments
+    if not db.session.query(LedgerEntry.query.exists()).scalar() and (
+            db.session.query(Payment.query.exists()).scalar() or
+            db.session.query(db.session.query(student_subjects).exists()).scalar()):
+        rebuild_ledger()
+    ensure_student_fts()
+
+# Full-text index over student contact fields. Phone columns are indexed both as typed
+# and as bare digits, so "555-1234" and "5551234" find the same student.
+STUDENT_FTS_COLUMNS = ["name", "student_no", "id_number", "phones", "contacts", "address"]
+STUDENT_PHONE_FIELDS = ["telephone", "mobile", "contact1_phone", "contact2_phone"]
+
+def _student_fts_values(row):
+    def digits(col):
+        expr = f"coalesce({row}.{col}, '')"
+        for ch in ("-", " ", "+", "(", ")", "."):
+            expr = f"replace({expr}, '{ch}', '')"
+        return expr
+    phones = " || ' ' || ".join(
+        [f"coalesce({row}.{c}, '')" for c in STUDENT_PHONE_FIELDS] + [digits(c) for c in STUDENT_PHONE_FIELDS]
+    )
+    return (f"{row}.id, {row}.name, {row}.student_id, {row}.id_number, {phones}, "
+            f"coalesce({row}.contact1_name, '') || ' ' || coalesce({row}.contact2_name, ''), {row}.address")
+
+def ensure_student_fts():
+    """Create the student_fts table and the triggers that keep it in sync; skipped if SQLite lacks FTS5."""
+    exists = db.session.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'student_fts'"
+    )).first()
+    if exists:
+        return
+    columns = ", ".join(STUDENT_FTS_COLUMNS)
+    try:
+        db.session.execute(text(
+            f"CREATE VIRTUAL TABLE student_fts USING fts5({columns}, tokenize='unicode61', prefix='2 3')"
+        ))
+    except OperationalError:
+        db.session.rollback()
+        print("SQLite FTS5 is not available; student search falls back to LIKE scans.")
+        return
+    db.session.execute(text(
+        f"CREATE TRIGGER student_fts_ai AFTER INSERT ON student BEGIN "
+        f"INSERT INTO student_fts(rowid, {columns}) VALUES ({_student_fts_values('new')}); END"
+    ))
+    db.session.execute(text(
+        "CREATE TRIGGER student_fts_ad AFTER DELETE ON student BEGIN "
+        "DELETE FROM student_fts WHERE rowid = old.id; END"
+    ))
+    db.session.execute(text(
+        f"CREATE TRIGGER student_fts_au AFTER UPDATE ON student BEGIN "
+        f"DELETE FROM student_fts WHERE rowid = old.id; "
+        f"INSERT INTO student_fts(rowid, {columns}) VALUES ({_student_fts_values('new')}); END"
+    ))
+    db.session.execute(text(
+        f"INSERT INTO student_fts(rowid, {columns}) SELECT {_student_fts_values('student')} FROM student"
+    ))
+    db.session.commit()
+
 # -------------------------
 # Base template
 # -------------------------
@@ -125,10 +445,16 @@ BASE = """
       <a class="btn btn-outline-secondary btn-sm" href="{{ url_for('manage_students') }}">Students</a>
       <a class="btn btn-outline-secondary btn-sm" href="{{ url_for('manage_subjects') }}">Subjects</a>
       <a class="btn btn-outline-success btn-sm" href="{{ url_for('add_session') }}">Add Session</a>
+      <a class="btn btn-outline-success btn-sm" href="{{ url_for('schedule_term') }}">Term Scheduler</a>
+      <a class="btn btn-outline-success btn-sm" href="{{ url_for('bulk_sessions') }}">Bulk Reschedule</a>
+      <a class="btn btn-outline-primary btn-sm" href="{{ url_for('session_search') }}">Find Sessions</a>
       <a class="btn btn-outline-dark btn-sm" href="{{ url_for('payments') }}">Payments</a>
       <a class="btn btn-outline-dark btn-sm" href="{{ url_for('teacher_totals') }}">Teacher Totals</a>
       <a class="btn btn-outline-dark btn-sm" href="{{ url_for('weekly_timetable') }}">Weekly Grid</a>
+      <a class="btn btn-outline-dark btn-sm" href="{{ url_for('calendar_view') }}">Calendar</a>
+      <a class="btn btn-outline-dark btn-sm" href="{{ url_for('attendance_register') }}">Register</a>
       <a class="btn btn-outline-dark btn-sm" href="{{ url_for('logs') }}">Logs</a>
+      <a class="btn btn-outline-dark btn-sm" href="{{ url_for('export_full_report', format='excel') }}">Full Report</a>
     </div>
   </div>
 </nav>
@@ -140,6 +466,81 @@ BASE = """
   {% endwith %}
   {{ content|safe }}
 </div>
+<script>
+  // Typeahead pickers. Markup:
+  //   <div class="typeahead" data-source="/search_x" [data-multiple]>
+  //     <input class="form-control typeahead-input">
+  //     single:   <input type="hidden" name="field">
+  //     multiple: <div class="typeahead-chosen"> with one hidden input per chosen option </div>
+  //     <div class="list-group typeahead-results"></div>
+  //   </div>
+  // Options are fetched a page at a time from the search route; "More" loads the next page.
+  document.querySelectorAll(".typeahead").forEach(box => {
+    const input = box.querySelector(".typeahead-input");
+    const list = box.querySelector(".typeahead-results");
+    const chosen = box.querySelector(".typeahead-chosen");
+    const multiple = box.hasAttribute("data-multiple");
+    let timer = null, ticket = 0;
+
+    const label = opt => opt.detail ? `${opt.name} (${opt.detail})` : opt.name;
+
+    function addChip(opt) {
+      if (chosen.querySelector(`input[value="${opt.id}"]`)) return;
+      const chip = document.createElement("span");
+      chip.className = "badge text-bg-secondary me-1 typeahead-chip";
+      chip.textContent = label(opt) + " ";
+      const hidden = document.createElement("input");
+      hidden.type = "hidden"; hidden.name = chosen.dataset.name; hidden.value = opt.id;
+      const remove = document.createElement("button");
+      remove.type = "button"; remove.className = "btn-close btn-close-white btn-sm";
+      chip.append(hidden, remove);
+      chosen.appendChild(chip);
+    }
+
+    function choose(opt) {
+      if (multiple) { addChip(opt); input.value = ""; }
+      else { box.querySelector("input[type=hidden]").value = opt.id; input.value = opt.name; }
+      list.innerHTML = "";
+    }
+
+    async function load(offset) {
+      const mine = ++ticket;
+      const params = new URLSearchParams({ q: input.value.trim(), offset: offset });
+      const res = await fetch(`${box.dataset.source}?${params}`);
+      const data = await res.json();
+      if (mine !== ticket) return;
+      if (offset === 0) list.innerHTML = "";
+      list.querySelector(".typeahead-more")?.remove();
+      data.results.forEach(opt => {
+        const item = document.createElement("button");
+        item.type = "button";
+        item.className = "list-group-item list-group-item-action";
+        item.textContent = label(opt);
+        item.onclick = () => choose(opt);
+        list.appendChild(item);
+      });
+      if (data.more) {
+        const more = document.createElement("button");
+        more.type = "button";
+        more.className = "list-group-item list-group-item-action text-muted typeahead-more";
+        more.textContent = "More…";
+        more.onclick = () => load(offset + data.results.length);
+        list.appendChild(more);
+      }
+    }
+
+    input.addEventListener("input", () => {
+      if (!multiple) box.querySelector("input[type=hidden]").value = "";
+      clearTimeout(timer);
+      timer = setTimeout(() => load(0), 200);
+    });
+    input.addEventListener("focus", () => { if (!list.children.length) load(0); });
+    if (chosen) chosen.addEventListener("click", e => {
+      if (e.target.classList.contains("btn-close")) e.target.closest(".typeahead-chip").remove();
+    });
+    document.addEventListener("click", e => { if (!box.contains(e.target)) list.innerHTML = ""; });
+  });
+</script>
 </body>
 </html>
 """
@@ -162,73 +563,640 @@ def parse_time(s):
     except:
         return None
 
+def month_bounds(d):
+    """Return (first day of d's month, first day of the following month)."""
+    first = d.replace(day=1)
+    if first.month == 12:
+        return first, first.replace(year=first.year + 1, month=1)
+    return first, first.replace(month=first.month + 1)
+
+def add_months(d, n):
+    """First day of the month n months after d's month (n may be negative)."""
+    index = d.year * 12 + d.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+
+def parse_month(s):
+    """Parse YYYY-MM into the first day of that month, or None."""
+    try:
+        return datetime.strptime(s, "%Y-%m").date()
+    except:
+        return None
+
+# Loader options for listings that show names: teacher, student and subject
+# come back in the same SELECT instead of one lazy query per related row.
+SESSION_NAMES = (joinedload(ClassSession.teacher), joinedload(ClassSession.student),
+                 joinedload(ClassSession.subject))
+
 def current_month_sessions():
-    today = date.today()
+    # A plain range keeps the session_date indexes usable (extract() does not)
+    first, next_first = month_bounds(date.today())
     return ClassSession.query.filter(
-        extract("year", ClassSession.session_date) == today.year,
-        extract("month", ClassSession.session_date) == today.month
+        ClassSession.session_date >= first,
+        ClassSession.session_date < next_first
     )
 
-def log_action(action, details=""):
+def export_filters():
+    """Read the optional start/end (inclusive) and teacher/student/subject filters from the query string."""
+    return {
+        "start": parse_date(request.args.get("start", "")),
+        "end": parse_date(request.args.get("end", "")),
+        "teacher_id": request.args.get("teacher_id", type=int),
+        "student_id": request.args.get("student_id", type=int),
+        "subject_id": request.args.get("subject_id", type=int),
+        "action": request.args.get("action", "").strip(),
+    }
+
+def filter_sessions(query, filters):
+    """Apply export filters to a query that selects from (or joins) ClassSession."""
+    if filters["start"]:
+        query = query.filter(ClassSession.session_date >= filters["start"])
+    if filters["end"]:
+        query = query.filter(ClassSession.session_date <= filters["end"])
+    if filters["teacher_id"]:
+        query = query.filter(ClassSession.teacher_id == filters["teacher_id"])
+    if filters["student_id"]:
+        query = query.filter(ClassSession.student_id == filters["student_id"])
+    if filters["subject_id"]:
+        query = query.filter(ClassSession.subject_id == filters["subject_id"])
+    return query
+
+def filter_payments(query, filters):
+    """Apply export filters to a Payment query; the teacher filter keeps payments for pairs that teacher teaches."""
+    if filters["start"]:
+        query = query.filter(Payment.date >= filters["start"])
+    if filters["end"]:
+        query = query.filter(Payment.date <= filters["end"])
+    if filters["student_id"]:
+        query = query.filter(Payment.student_id == filters["student_id"])
+    if filters["subject_id"]:
+        query = query.filter(Payment.subject_id == filters["subject_id"])
+    if filters["teacher_id"]:
+        taught = db.session.query(ClassSession.id).filter(
+            ClassSession.teacher_id == filters["teacher_id"],
+            ClassSession.student_id == Payment.student_id,
+            ClassSession.subject_id == Payment.subject_id
+        ).exists()
+        query = query.filter(taught)
+    return query
+
+def filter_logs(query, filters):
+    """Apply the date range and an optional exact ?action= filter to a LogEntry query."""
+    if filters["start"]:
+        query = query.filter(LogEntry.timestamp >= datetime.combine(filters["start"], datetime.min.time()))
+    if filters["end"]:
+        query = query.filter(LogEntry.timestamp < datetime.combine(filters["end"] + timedelta(days=1), datetime.min.time()))
+    if filters.get("action"):
+        query = query.filter(LogEntry.action == filters["action"])
+    return query
+
+def log_action(action, details="", commit=True):
     entry = LogEntry(action=action, details=details)
     db.session.add(entry)
-    db.session.commit()
+    if commit:
+        db.session.commit()
+
+# -------------------------
+# Reference-data cache
+# -------------------------
+# Teachers, subjects and students for dropdowns and name lookups, held per
+# process as plain tuples. Any committed write to those tables bumps the
+# version, and the next reader reloads all three lists.
+TeacherRef = namedtuple("TeacherRef", "id name nickname")
+SubjectRef = namedtuple("SubjectRef", "id name price number_of_classes discount teacher_rate_cents")
+StudentRef = namedtuple("StudentRef", "id name")
+REFERENCE_MODELS = (Teacher, Subject, Student)
+
+_reference_lock = threading.Lock()
+_reference_cache = {"version": 0, "data": None}
+
+def invalidate_reference_cache():
+    with _reference_lock:
+        _reference_cache["version"] += 1
+        _reference_cache["data"] = None
+
+def reference_lists():
+    """Name-ordered teacher/subject/student tuples plus by-id maps, from cache when unchanged."""
+    with _reference_lock:
+        version, data = _reference_cache["version"], _reference_cache["data"]
+    if data is not None:
+        return data
+    teachers = [TeacherRef(*row) for row in db.session.query(
+        Teacher.id, Teacher.name, Teacher.nickname).order_by(Teacher.name.asc())]
+    subjects = [SubjectRef(*row) for row in db.session.query(
+        Subject.id, Subject.name, Subject.price, Subject.number_of_classes, Subject.discount,
+        Subject.teacher_rate_cents
+    ).order_by(Subject.name.asc())]
+    students = [StudentRef(*row) for row in db.session.query(Student.id, Student.name).order_by(Student.name.asc())]
+    data = {
+        "teachers": teachers, "subjects": subjects, "students": students,
+        "teacher_by_id": {t.id: t for t in teachers},
+        "subject_by_id": {subj.id: subj for subj in subjects},
+        "student_by_id": {st.id: st for st in students},
+    }
+    with _reference_lock:
+        # Only publish if nothing was written while we were loading
+        if _reference_cache["version"] == version:
+            _reference_cache["data"] = data
+    return data
+
+@event.listens_for(db.session, "before_flush")
+def _note_reference_writes(session, flush_context, instances):
+    if any(isinstance(obj, REFERENCE_MODELS) for obj in list(session.new) + list(session.dirty) + list(session.deleted)):
+        session.info["reference_changed"] = True
+
+@event.listens_for(db.session, "after_commit")
+def _bump_reference_version(session):
+    if session.info.pop("reference_changed", False):
+        invalidate_reference_cache()
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_reference_writes(session):
+    session.info.pop("reference_changed", None)
+
+def change_stamp(owner, owner_id):
+    """(latest session change-log version, reference-data version) for a teacher's or student's cached views.
+
+    Either part moving means a cached timetable or feed of theirs is stale.
+    """
+    column = ChangeLog.teacher_id if owner == "teacher" else ChangeLog.student_id
+    version = db.session.query(func.max(ChangeLog.version)).filter(
+        column == owner_id, ChangeLog.entity == "session"
+    ).scalar() or 0
+    reference_lists()  # reload first if names changed, so the version below matches what we render
+    with _reference_lock:
+        return version, _reference_cache["version"]
+
+# -------------------------
+# Change feed (versioned deltas of sessions, attendance and payments)
+# -------------------------
+CHANGE_ENTITIES = {ClassSession: "session", Attendance: "attendance", Payment: "payment"}
+CHANGES_PAGE_SIZE = 500
+
+def record_changes(rows):
+    """Append change rows (dicts of entity, entity_id, op and owner columns) in one executemany."""
+    if rows:
+        db.session.execute(ChangeLog.__table__.insert(), rows)
+        db.session.info["changes_recorded"] = True
+
+def _record_from_select(entity, op, query):
+    # query selects (entity_id, teacher_id, student_id, session_date); one INSERT .. SELECT, no rows in Python
+    columns = ["entity", "op", "changed_at", "entity_id", "teacher_id", "student_id", "session_date"]
+    query = query.add_columns(literal(entity), literal(op), literal(datetime.utcnow()))
+    db.session.execute(ChangeLog.__table__.insert().from_select(
+        columns[3:] + columns[:3], query
+    ))
+    db.session.info["changes_recorded"] = True
+
+def record_session_changes(op, *criteria):
+    """Log `op` for every session matching criteria. Call before a bulk delete, after a bulk update."""
+    _record_from_select("session", op, select(
+        ClassSession.id, ClassSession.teacher_id, ClassSession.student_id, ClassSession.session_date
+    ).where(*criteria))
+
+def record_attendance_changes(op, *criteria):
+    """Log `op` for every attendance row matching criteria, with the owning session's teacher and date."""
+    _record_from_select("attendance", op, select(
+        Attendance.id, ClassSession.teacher_id, Attendance.student_id, ClassSession.session_date
+    ).join(ClassSession, Attendance.session_id == ClassSession.id).where(*criteria))
+
+def record_payment_changes(op, *criteria):
+    """Log `op` for every payment matching criteria."""
+    _record_from_select("payment", op, select(
+        Payment.id, null(), Payment.student_id, null()
+    ).where(*criteria))
+
+CHANGE_RECORDERS = {
+    ClassSession.__table__: record_session_changes,
+    Attendance.__table__: record_attendance_changes,
+    Payment.__table__: record_payment_changes,
+}
+
+def _change_owner(obj, sessions, history=False):
+    """(teacher_id, student_id, session_date) of a changed object; history=True gives the pre-flush values."""
+    def value(target, key):
+        if not history:
+            return getattr(target, key)
+        hist = attributes.get_history(target, key)
+        return hist.deleted[0] if hist.deleted else getattr(target, key)
+    if isinstance(obj, ClassSession):
+        return value(obj, "teacher_id"), value(obj, "student_id"), value(obj, "session_date")
+    if isinstance(obj, Attendance):
+        teacher_id, session_date = sessions.get(obj.session_id, (None, None))
+        return teacher_id, value(obj, "student_id"), session_date
+    return None, value(obj, "student_id"), None
+
+@event.listens_for(db.session, "after_flush")
+def _record_orm_changes(session, flush_context):
+    changed = [(obj, "insert") for obj in session.new] + [(obj, "delete") for obj in session.deleted] + [
+        (obj, "update") for obj in session.dirty if session.is_modified(obj, include_collections=False)
+    ]
+    changed = [(obj, op) for obj, op in changed if type(obj) in CHANGE_ENTITIES]
+    if not changed:
+        return
+    # Attendance rows take teacher and date from their session: flushed objects first, then one lookup
+    sessions = {obj.id: (obj.teacher_id, obj.session_date) for obj, _ in changed if isinstance(obj, ClassSession)}
+    missing = {obj.session_id for obj, _ in changed if isinstance(obj, Attendance)} - set(sessions)
+    if missing:
+        sessions.update((sid, (teacher_id, day)) for sid, teacher_id, day in session.connection().execute(
+            select(ClassSession.id, ClassSession.teacher_id, ClassSession.session_date).where(
+                ClassSession.id.in_(missing))
+        ))
+    now = datetime.utcnow()
+    rows = []
+    for obj, op in changed:
+        owners = {_change_owner(obj, sessions)}
+        if op == "update":
+            # A move to another teacher, student or day also changes the old owner's view
+            owners.add(_change_owner(obj, sessions, history=True))
+        for teacher_id, student_id, session_date in owners:
+            rows.append({"entity": CHANGE_ENTITIES[type(obj)], "entity_id": obj.id, "op": op,
+                         "teacher_id": teacher_id, "student_id": student_id, "session_date": session_date,
+                         "changed_at": now})
+    session.connection().execute(ChangeLog.__table__.insert(), rows)
+    session.info["changes_recorded"] = True
+
+def change_payloads(entity, ids):
+    """Current state of the given entities keyed by id; deleted ones are absent."""
+    if not ids:
+        return {}
+    if entity == "session":
+        rows = db.session.query(ClassSession).filter(ClassSession.id.in_(ids))
+        return {s.id: {"teacher_id": s.teacher_id, "student_id": s.student_id, "subject_id": s.subject_id,
+                       "date": s.session_date.isoformat(), "start": s.start_time.strftime("%H:%M"),
+                       "end": s.end_time.strftime("%H:%M"), "notes": s.notes} for s in rows}
+    if entity == "attendance":
+        rows = db.session.query(Attendance).filter(Attendance.id.in_(ids))
+        return {a.id: {"session_id": a.session_id, "student_id": a.student_id, "status": a.status,
+                       "timestamp": a.timestamp.isoformat(timespec="seconds")} for a in rows}
+    rows = db.session.query(Payment).filter(Payment.id.in_(ids))
+    return {p.id: {"student_id": p.student_id, "subject_id": p.subject_id, "amount": p.amount,
+                   "date": p.date.isoformat() if p.date else None, "method": p.method} for p in rows}
+
+@app.route("/changes")
+def changes():
+    """Deltas after ?since=<version>, oldest first, one entry per changed entity with its current state.
+
+    Pass the returned version back as since; more=true means another page is waiting.
+    """
+    since = max(request.args.get("since", 0, type=int), 0)
+    limit = max(1, min(request.args.get("limit", CHANGES_PAGE_SIZE, type=int), CHANGES_PAGE_SIZE))
+    rows = db.session.query(ChangeLog.version, ChangeLog.entity, ChangeLog.entity_id, ChangeLog.op).filter(
+        ChangeLog.version > since
+    ).order_by(ChangeLog.version.asc()).limit(limit + 1).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    # Collapse repeated changes to one entry per entity, at its latest version in this page
+    latest = {}
+    for version, entity, entity_id, op in rows:
+        latest.pop((entity, entity_id), None)
+        latest[(entity, entity_id)] = (version, op)
+    payloads = {entity: change_payloads(entity, [eid for (e, eid) in latest if e == entity])
+                for entity in CHANGE_ENTITIES.values()}
+    results = []
+    for (entity, entity_id), (version, op) in latest.items():
+        data = payloads[entity].get(entity_id)
+        results.append({"version": version, "entity": entity, "id": entity_id,
+                        "op": "delete" if data is None else op, "data": data})
+    return {"version": rows[-1].version if rows else since, "more": more, "changes": results}
+
+# -------------------------
+# Live updates (Server-Sent Events)
+# -------------------------
+# After each commit that recorded changes, the broadcaster reads the new
+# change_log rows once and fans them out to every matching subscriber in
+# this process. Slow subscribers that fill their queue are told to resync.
+SSE_HEARTBEAT_SECONDS = 15
+SSE_QUEUE_SIZE = 1000
+
+def change_event(row):
+    return {"version": row.version, "entity": row.entity, "id": row.entity_id, "op": row.op,
+            "teacher_id": row.teacher_id, "student_id": row.student_id,
+            "date": row.session_date.isoformat() if row.session_date else None}
+
+def _change_rows(conn, after, limit=None):
+    query = select(ChangeLog).where(ChangeLog.version > after).order_by(ChangeLog.version.asc())
+    if limit:
+        query = query.limit(limit)
+    return conn.execute(query).all()
+
+class Subscriber:
+    """One open event stream: its filters and a bounded queue of pending events."""
+
+    def __init__(self, teacher_id=None, start=None, end=None):
+        self.queue = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+        self.teacher_id = teacher_id
+        self.start, self.end = start, end  # ISO dates; events without a date are skipped when set
+        self.overflowed = False
+
+    def wants(self, event):
+        if self.teacher_id and event["teacher_id"] != self.teacher_id:
+            return False
+        if self.start or self.end:
+            if not event["date"]:
+                return False
+            if (self.start and event["date"] < self.start) or (self.end and event["date"] > self.end):
+                return False
+        return True
+
+    def offer(self, event):
+        if self.wants(event):
+            try:
+                self.queue.put_nowait(event)
+            except queue.Full:
+                self.overflowed = True
+
+class EventBroadcaster:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.version = 0  # last change_log version fanned out
+
+    def subscribe(self, subscriber, last_version=None):
+        """Register a subscriber, first replaying changes after last_version (an SSE Last-Event-ID)."""
+        with self.lock, db.engine.connect() as conn:
+            if not self.subscribers:
+                # Nobody was listening, so nothing was read while idle; start from now
+                self.version = conn.execute(select(func.max(ChangeLog.version))).scalar() or 0
+            if last_version is not None and last_version < self.version:
+                rows = [row for row in _change_rows(conn, last_version, SSE_QUEUE_SIZE + 1)
+                        if row.version <= self.version]
+                if len(rows) > SSE_QUEUE_SIZE:
+                    subscriber.overflowed = True
+                for row in rows[:SSE_QUEUE_SIZE]:
+                    subscriber.offer(change_event(row))
+            self.subscribers.add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self):
+        """Fan out every change committed since the last publish."""
+        with self.lock:
+            if not self.subscribers:
+                return
+            with db.engine.connect() as conn:
+                rows = _change_rows(conn, self.version)
+            for row in rows:
+                event = change_event(row)
+                for subscriber in self.subscribers:
+                    subscriber.offer(event)
+            if rows:
+                self.version = rows[-1].version
+
+broadcaster = EventBroadcaster()
+
+@event.listens_for(db.session, "after_commit")
+def _publish_changes(session):
+    if session.info.pop("changes_recorded", False):
+        broadcaster.publish()
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_changes(session):
+    session.info.pop("changes_recorded", None)
+
+@app.route("/events/stream")
+def event_stream():
+    """Server-Sent Events of committed session, attendance and payment changes.
+
+    Filters: ?teacher_id=, ?date= (one day) or ?start=/?end=. Reconnecting
+    clients send Last-Event-ID and receive what they missed; a "resync"
+    event means too much was missed and the client should reload.
+    """
+    day = parse_date(request.args.get("date", ""))
+    start = day or parse_date(request.args.get("start", ""))
+    end = day or parse_date(request.args.get("end", ""))
+    subscriber = Subscriber(request.args.get("teacher_id", type=int),
+                            start.isoformat() if start else None, end.isoformat() if end else None)
+    last_id = request.headers.get("Last-Event-ID", "")
+    broadcaster.subscribe(subscriber, int(last_id) if last_id.isdigit() else None)
+
+    def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while not subscriber.overflowed:
+                try:
+                    event = subscriber.queue.get(timeout=SSE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"id: {event['version']}\nevent: {event['entity']}\ndata: {json.dumps(event)}\n\n"
+            yield "event: resync\ndata: {}\n\n"
+        finally:
+            broadcaster.unsubscribe(subscriber)
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # -------------------------
 # Search routes (autocomplete)
 # -------------------------
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_LIMIT = 100
+
+def search_paging():
+    """(limit, offset) from the request, clamped so one call stays small."""
+    limit = max(1, min(request.args.get("limit", SEARCH_PAGE_SIZE, type=int), SEARCH_MAX_LIMIT))
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    return limit, offset
+
+def search_page(model, columns, to_result):
+    """One page of `model` options whose name contains `q` (all options when `q` is empty).
+
+    Fetches one row past the limit to tell the widget whether a next page exists.
+    """
+    q = request.args.get("q", "").strip()
+    limit, offset = search_paging()
+    query = db.session.query(*columns)
+    if q:
+        query = query.filter(func.lower(model.name).like(f"%{q.lower()}%"))
+    rows = query.order_by(model.name.asc(), model.id.asc()).offset(offset).limit(limit + 1).all()
+    return {"results": [to_result(row) for row in rows[:limit]], "more": len(rows) > limit}
+
 @app.route("/search_students")
 def search_students():
+    return search_page(Student, [Student.id, Student.name], lambda row: {"id": row.id, "name": row.name})
+
+STUDENT_SEARCH_LABELS = {"student_no": "Student ID", "id_number": "ID Number", "phones": "Phones",
+                         "contacts": "Contacts", "address": "Address"}
+
+def _fts_query(q):
+    """Turn free text into an FTS5 query: every word must match as a prefix."""
+    words = "".join(ch if ch.isalnum() else " " for ch in q).split()
+    return " ".join(f'"{w}"*' for w in words)
+
+def _highlight(value):
+    # highlight() wraps matches in \x02..\x03 so the stored text can be escaped before adding markup
+    return str(escape(value or "")).replace("\x02", "<mark>").replace("\x03", "</mark>")
+
+@app.route("/search_student_contacts")
+def search_student_contacts():
+    """Ranked student matches across name, IDs, phones, contact names and address, with highlighted fields."""
     q = request.args.get("q", "").strip()
+    limit, offset = search_paging()
+    match = _fts_query(q)
+    if not match:
+        return {"results": [], "more": False}
+    highlights = ", ".join(
+        f"highlight(student_fts, {i}, char(2), char(3))" for i in range(len(STUDENT_FTS_COLUMNS))
+    )
+    try:
+        rows = db.session.execute(text(
+            f"SELECT rowid, {highlights} FROM student_fts WHERE student_fts MATCH :match "
+            f"ORDER BY rank LIMIT :limit OFFSET :offset"
+        ), {"match": match, "limit": limit + 1, "offset": offset}).all()
+    except OperationalError:
+        db.session.rollback()
+        rows = _search_student_contacts_like(q, limit + 1, offset)
+        return {"results": rows[:limit], "more": len(rows) > limit}
     results = []
-    if q:
-        matches = Student.query.filter(func.lower(Student.name).like(f"%{q.lower()}%")).order_by(Student.name.asc()).all()
-        results = [{"id": s.id, "name": s.name} for s in matches]
-    return {"results": results}
+    for row in rows[:limit]:
+        fields = dict(zip(STUDENT_FTS_COLUMNS, row[1:]))
+        results.append({
+            "id": row[0],
+            "name": _highlight(fields.pop("name")),
+            "matches": {STUDENT_SEARCH_LABELS[k]: _highlight(v) for k, v in fields.items() if v and "\x02" in v},
+        })
+    return {"results": results, "more": len(rows) > limit}
+
+def _search_student_contacts_like(q, limit, offset=0):
+    """Fallback for SQLite builds without FTS5: an unranked LIKE scan over the same fields."""
+    pattern = f"%{q.lower()}%"
+    fields = [Student.name, Student.student_id, Student.id_number, Student.address, Student.contact1_name,
+              Student.contact2_name] + [getattr(Student, c) for c in STUDENT_PHONE_FIELDS]
+    matches = Student.query.filter(or_(*[func.lower(f).like(pattern) for f in fields])).order_by(
+        Student.name.asc(), Student.id.asc()
+    ).offset(offset).limit(limit).all()
+    return [{"id": s.id, "name": str(escape(s.name)), "matches": {}} for s in matches]
 
 @app.route("/search_teachers")
 def search_teachers():
-    q = request.args.get("q", "").strip()
-    results = []
-    if q:
-        matches = Teacher.query.filter(func.lower(Teacher.name).like(f"%{q.lower()}%")).order_by(Teacher.name.asc()).all()
-        results = [{"id": t.id, "name": t.name} for t in matches]
-    return {"results": results}
+    return search_page(Teacher, [Teacher.id, Teacher.name], lambda row: {"id": row.id, "name": row.name})
+
+def subject_detail(price, number_of_classes, discount):
+    detail = f"{price:.2f} / {number_of_classes} classes"
+    return f"{detail}, {discount}% off" if discount else detail
 
 @app.route("/search_subjects")
 def search_subjects():
-    q = request.args.get("q", "").strip()
-    results = []
-    if q:
-        matches = Subject.query.filter(func.lower(Subject.name).like(f"%{q.lower()}%")).order_by(Subject.name.asc()).all()
-        results = [{"id": subj.id, "name": subj.name} for subj in matches]
-    return {"results": results}
+    columns = [Subject.id, Subject.name, Subject.price, Subject.number_of_classes, Subject.discount]
+    return search_page(Subject, columns, lambda row: {
+        "id": row.id, "name": row.name,
+        "detail": subject_detail(row.price, row.number_of_classes, row.discount),
+    })
 
 
+# -------------------------
+# Teacher timetable periods (cached tuples, adjacent periods prefetched)
+# -------------------------
+# Each entry is stamped with the teacher's latest session change-log version
+# and the reference-data version, so an entry is only served while neither
+# has moved. After a page is shown the previous and next periods are loaded
+# in the background, making Previous/Next an in-memory lookup.
+HOME_CACHE_SIZE = 64
+
+TimetableRow = namedtuple("TimetableRow", "id session_date start_time end_time student subject notes")
+
+_home_lock = threading.Lock()
+_home_cache = OrderedDict()  # (teacher_id, first, end) -> (stamp, rows), least recently used first
+_home_pending = set()
+_home_prefetch = ThreadPoolExecutor(max_workers=1, thread_name_prefix="timetable-prefetch")
+
+def load_teacher_period(teacher_id, first, end):
+    """The teacher's sessions in [first, end) as TimetableRow tuples, names filled in."""
+    names = load_reference_names()
+    # One range scan on (teacher_id, session_date, start_time); no ORM objects
+    rows = db.session.query(
+        ClassSession.id, ClassSession.session_date, ClassSession.start_time, ClassSession.end_time,
+        ClassSession.student_id, ClassSession.subject_id, ClassSession.notes
+    ).filter(
+        ClassSession.teacher_id == teacher_id,
+        ClassSession.session_date >= first, ClassSession.session_date < end
+    ).order_by(ClassSession.session_date.asc(), ClassSession.start_time.asc())
+    return [TimetableRow(session_id, day, start, finish, names["student"].get(student_id, ""),
+                         names["subject"].get(subject_id, ""), notes)
+            for session_id, day, start, finish, student_id, subject_id, notes in rows]
+
+def teacher_period(teacher_id, first, end):
+    """Cached load_teacher_period, reloaded when the teacher's sessions or any names changed."""
+    key = (teacher_id, first, end)
+    stamp = change_stamp("teacher", teacher_id)
+    with _home_lock:
+        cached = _home_cache.get(key)
+        if cached:
+            _home_cache.move_to_end(key)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    rows = load_teacher_period(teacher_id, first, end)
+    with _home_lock:
+        _home_cache[key] = (stamp, rows)
+        _home_cache.move_to_end(key)
+        while len(_home_cache) > HOME_CACHE_SIZE:
+            _home_cache.popitem(last=False)
+    return rows
+
+def _prefetch_teacher_period(key):
+    try:
+        with app.app_context():
+            teacher_period(*key)
+    except Exception:
+        app.logger.exception("Timetable prefetch failed for %s", key)
+    finally:
+        with _home_lock:
+            _home_pending.discard(key)
+
+def prefetch_teacher_periods(teacher_id, periods):
+    """Warm the cache for (first, end) periods in the background; one queued load per key."""
+    for first, end in periods:
+        key = (teacher_id, first, end)
+        with _home_lock:
+            if key in _home_pending:
+                continue
+            _home_pending.add(key)
+        _home_prefetch.submit(_prefetch_teacher_period, key)
+
 # -------------------------
 # Home / Timetable (daily grouped by teacher)
 # -------------------------
 @app.route("/")
 def home():
-    teachers = Teacher.query.order_by(Teacher.name.asc()).all()
+    refs = reference_lists()
+    teachers = refs["teachers"]
     teacher_id = request.args.get("teacher_id", type=int)
-    selected_teacher = Teacher.query.get(teacher_id) if teacher_id else None
+    selected_teacher = refs["teacher_by_id"].get(teacher_id) if teacher_id else None
+    view = "week" if request.args.get("view") == "week" else "month"
+    anchor = parse_date(request.args.get("date", "")) or date.today()
+    first, end = timetable_period(view, anchor)
+    if view == "week":
+        title = f"Week of {first.strftime('%d %b %Y')}"
+        previous = first - timedelta(days=7)
+    else:
+        title = first.strftime("%B %Y")
+        previous = add_months(first, -1)
+    following = end
     sessions = []
     if selected_teacher:
-        sessions = current_month_sessions().filter_by(teacher_id=teacher_id).order_by(
-            ClassSession.session_date.asc(), ClassSession.start_time.asc()
-        ).all()
+        sessions = teacher_period(teacher_id, first, end)
+        prefetch_teacher_periods(teacher_id, [timetable_period(view, previous), timetable_period(view, following)])
     grouped = {}
     for s in sessions:
         d = s.session_date.isoformat()
         grouped.setdefault(d, []).append(s)
+    # Export buttons download what is on screen: the selected teacher's month or week
+    export_args = {}
+    if selected_teacher:
+        export_args = {"teacher_id": teacher_id, "start": first.isoformat(),
+                       "end": (end - timedelta(days=1)).isoformat()}
+    live_url = url_for("event_stream", **export_args) if selected_teacher else None
     page = """
 <h5>Timetable</h5>
 <div class="mb-3">
-  <a class="btn btn-sm btn-outline-success" href="{{ url_for('export_timetable', format='csv') }}">Download CSV</a>
-  <a class="btn btn-sm btn-outline-success" href="{{ url_for('export_timetable', format='excel') }}">Download Excel</a>
+  <a class="btn btn-sm btn-outline-success" href="{{ url_for('export_timetable', format='csv', **export_args) }}">Download CSV</a>
+  <a class="btn btn-sm btn-outline-success" href="{{ url_for('export_timetable', format='excel', **export_args) }}">Download Excel</a>
+  <a class="btn btn-sm btn-outline-success" href="{{ url_for('export_timetable', format='parquet', **export_args) }}">Download Parquet</a>
 </div>
 <form method="get" class="mb-3">
+      <input type="hidden" name="view" value="{{ view }}">
       <div class="row g-2">
         <div class="col-md-6">
           <select class="form-select" name="teacher_id">
@@ -244,10 +1212,22 @@ def home():
       </div>
     </form>
     {% if selected_teacher %}
-      <h6>Timetable for {{ selected_teacher.name }}{% if selected_teacher.nickname %} ({{ selected_teacher.nickname }}){% endif %} ({{ (date.today()).strftime('%B %Y') }})</h6>
+      <div class="mb-3 d-flex flex-wrap gap-1">
+        <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('home', teacher_id=selected_teacher.id, view=view, date=previous.isoformat()) }}">&laquo; Previous</a>
+        <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('home', teacher_id=selected_teacher.id, view=view) }}">Today</a>
+        <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('home', teacher_id=selected_teacher.id, view=view, date=following.isoformat()) }}">Next &raquo;</a>
+        {% for v in ["month", "week"] %}
+          <a class="btn btn-sm {{ 'btn-secondary' if v == view else 'btn-outline-secondary' }}"
+             href="{{ url_for('home', teacher_id=selected_teacher.id, view=v, date=first.isoformat()) }}">{{ v|capitalize }}</a>
+        {% endfor %}
+        <a class="btn btn-sm btn-outline-danger" href="{{ url_for('bulk_sessions', teacher_id=selected_teacher.id, start=first.isoformat(), end=last.isoformat()) }}">Bulk changes</a>
+      </div>
+      <h6>Timetable for {{ selected_teacher.name }}{% if selected_teacher.nickname %} ({{ selected_teacher.nickname }}){% endif %} ({{ title }})</h6>
       {% if grouped %}
         {% for day, items in grouped.items() %}
-          <h6 class="mt-3">{{ day }}</h6>
+          <h6 class="mt-3">{{ day }}
+            <a class="btn btn-sm btn-outline-secondary ms-2" href="{{ url_for('attendance_register', date=day, teacher_id=selected_teacher.id) }}">Register</a>
+          </h6>
           <table class="table table-sm table-bordered">
             <thead>
               <tr>
@@ -264,8 +1244,8 @@ def home():
                 <tr>
                   <td class="timecell">{{ s.start_time.strftime("%H:%M") }}</td>
                   <td class="timecell">{{ s.end_time.strftime("%H:%M") }}</td>
-                  <td>{{ s.student.name }}</td>
-                  <td>{{ s.subject.name }}</td>
+                  <td>{{ s.student }}</td>
+                  <td>{{ s.subject }}</td>
                   <td>{{ s.notes or "" }}</td>
                   <td>
                     <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('edit_session', session_id=s.id) }}">Edit</a>
@@ -277,11 +1257,1210 @@ def home():
           </table>
         {% endfor %}
       {% else %}
-        <div class="alert alert-secondary">No sessions for this month. Use "Add Session" to create one.</div>
+        <div class="alert alert-secondary">No sessions for this {{ view }}. Use "Add Session" to create one.</div>
       {% endif %}
+      <script>
+        // Reload when a change to what is shown here is committed
+        const events = new EventSource({{ live_url|tojson }});
+        let reloadTimer = null;
+        const reloadSoon = () => { clearTimeout(reloadTimer); reloadTimer = setTimeout(() => location.reload(), 1000); };
+        ["session", "attendance", "resync"].forEach(type => events.addEventListener(type, reloadSoon));
+      </script>
+    {% endif %}
+    """
+    return render(page, teachers=teachers, selected_teacher=selected_teacher, grouped=grouped,
+                  view=view, title=title, first=first, last=end - timedelta(days=1), previous=previous,
+                  following=following, export_args=export_args, live_url=live_url)
+
+# -------------------------
+# Calendar heatmap (session counts per day)
+# -------------------------
+CALENDAR_MAX_MONTHS = 24
+
+def calendar_range():
+    """Read ?start=YYYY-MM and ?months=N; returns (first day, day after the last month)."""
+    first = parse_month(request.args.get("start", "")) or date.today().replace(day=1)
+    months = max(1, min(request.args.get("months", 12, type=int), CALENDAR_MAX_MONTHS))
+    return first, add_months(first, months)
+
+def day_counts(first, end, teacher_id=None, by_teacher=False):
+    """Session counts per day in [first, end) from one GROUP BY over the indexed date range.
+
+    Returns a list with one count per day starting at `first`, or a dict of such
+    lists keyed by teacher id when by_teacher is set.
+    """
+    days = (end - first).days
+    columns = [ClassSession.teacher_id] if by_teacher else []
+    query = db.session.query(*columns, ClassSession.session_date, func.count(ClassSession.id)).filter(
+        ClassSession.session_date >= first, ClassSession.session_date < end
+    )
+    if teacher_id:
+        query = query.filter(ClassSession.teacher_id == teacher_id)
+    rows = query.group_by(*columns, ClassSession.session_date).all()
+    if not by_teacher:
+        counts = [0] * days
+        for day, n in rows:
+            counts[(day - first).days] = n
+        return counts
+    counts = {}
+    for tid, day, n in rows:
+        counts.setdefault(tid, [0] * days)[(day - first).days] = n
+    return counts
+
+@app.route("/calendar/data")
+def calendar_data():
+    first, end = calendar_range()
+    teacher_id = request.args.get("teacher_id", type=int)
+    payload = {"start": first.isoformat(), "end": (end - timedelta(days=1)).isoformat()}
+    if request.args.get("by") == "teacher":
+        payload["teachers"] = day_counts(first, end, teacher_id, by_teacher=True)
+    else:
+        payload["counts"] = day_counts(first, end, teacher_id)
+    return payload
+
+@app.route("/calendar")
+def calendar_view():
+    first, end = calendar_range()
+    months = (end.year - first.year) * 12 + end.month - first.month
+    teacher_id = request.args.get("teacher_id", type=int)
+    teachers = reference_lists()["teachers"]
+    counts = day_counts(first, end, teacher_id)
+    peak = max(counts) if counts else 0
+    # Month grids of (date, count) cells, None padding the days before the 1st
+    grids = []
+    for i in range(months):
+        month_first = add_months(first, i)
+        offset = (month_first - first).days
+        weeks = []
+        for week in calendar.Calendar().monthdatescalendar(month_first.year, month_first.month):
+            weeks.append([(d, counts[offset + d.day - 1]) if d.month == month_first.month else None for d in week])
+        grids.append((month_first, weeks))
+    page = """
+    <h5>Calendar</h5>
+    <form method="get" class="row g-2 mb-3">
+      <div class="col-md-4">
+        <select class="form-select" name="teacher_id">
+          <option value="">-- whole school --</option>
+          {% for t in teachers %}
+            <option value="{{ t.id }}" {% if teacher_id == t.id %}selected{% endif %}>{{ t.name }}</option>
+          {% endfor %}
+        </select>
+      </div>
+      <div class="col-md-2"><input class="form-control" type="month" name="start" value="{{ first.strftime('%Y-%m') }}"></div>
+      <div class="col-md-2">
+        <select class="form-select" name="months">
+          {% for n in [1, 3, 6, 12] %}
+            <option value="{{ n }}" {% if n == months %}selected{% endif %}>{{ n }} month{{ "s" if n > 1 }}</option>
+          {% endfor %}
+        </select>
+      </div>
+      <div class="col-md-2"><button class="btn btn-primary w-100">View</button></div>
+    </form>
+    <div class="mb-3">
+      <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('calendar_view', start=add_months(first, -months).strftime('%Y-%m'), months=months, teacher_id=teacher_id) }}">&laquo; Previous</a>
+      <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('calendar_view', start=add_months(first, months).strftime('%Y-%m'), months=months, teacher_id=teacher_id) }}">Next &raquo;</a>
+    </div>
+    <div class="row">
+      {% for month_first, weeks in grids %}
+        <div class="col-md-3 mb-3">
+          <h6>{{ month_first.strftime('%B %Y') }}</h6>
+          <table class="table table-sm table-bordered text-center mb-0">
+            <thead><tr>{% for d in ["M", "T", "W", "T", "F", "S", "S"] %}<th>{{ d }}</th>{% endfor %}</tr></thead>
+            <tbody>
+              {% for week in weeks %}
+                <tr>
+                  {% for cell in week %}
+                    {% if cell %}
+                      <td title="{{ cell[0].isoformat() }}: {{ cell[1] }} sessions"
+                          style="{% if cell[1] %}background: rgba(25, 135, 84, {{ 0.15 + 0.85 * cell[1] / peak }});{% endif %}">
+                        <a class="text-decoration-none text-dark" href="{{ url_for('attendance_register', date=cell[0].isoformat(), teacher_id=teacher_id) }}">{{ cell[0].day }}</a>
+                      </td>
+                    {% else %}
+                      <td></td>
+                    {% endif %}
+                  {% endfor %}
+                </tr>
+              {% endfor %}
+            </tbody>
+          </table>
+        </div>
+      {% endfor %}
+    </div>
+    """
+    return render(page, grids=grids, first=first, months=months, teacher_id=teacher_id, teachers=teachers,
+                  peak=peak, add_months=add_months)
+
+# -------------------------
+# Student timetable (month / week)
+# -------------------------
+def timetable_period(view, anchor):
+    """(first day, day after the last) of the month or Monday-based week containing anchor."""
+    if view == "week":
+        first = anchor - timedelta(days=anchor.weekday())
+        return first, first + timedelta(days=7)
+    return month_bounds(anchor)
+
+@app.route("/students/<int:student_id>/timetable")
+def student_timetable(student_id):
+    student = Student.query.get_or_404(student_id)
+    view = "week" if request.args.get("view") == "week" else "month"
+    anchor = parse_date(request.args.get("date", "")) or date.today()
+    first, end = timetable_period(view, anchor)
+    # One range scan on (student_id, session_date, start_time) with names joined in
+    sessions = ClassSession.query.options(
+        joinedload(ClassSession.teacher), joinedload(ClassSession.subject)
+    ).filter(
+        ClassSession.student_id == student_id,
+        ClassSession.session_date >= first, ClassSession.session_date < end
+    ).order_by(ClassSession.session_date.asc(), ClassSession.start_time.asc()).all()
+    if view == "week":
+        title = f"Week of {first.strftime('%d %b %Y')}"
+        previous, following = first - timedelta(days=7), end
+    else:
+        title = first.strftime("%B %Y")
+        previous, following = add_months(first, -1), end
+    export_args = {"student_id": student_id, "start": first.isoformat(),
+                   "end": (end - timedelta(days=1)).isoformat()}
+
+    if request.args.get("print"):
+        # Bare page for printing or handing to parents: no navigation, one compact table
+        return render_template_string("""
+<!doctype html>
+<html lang="en">
+<head>
+  <meta charset="utf-8">
+  <title>{{ student.name }} - {{ title }}</title>
+  <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css" rel="stylesheet">
+  <style>@media print { .no-print { display: none; } } body { padding: 1rem; font-size: 0.9rem; }</style>
+</head>
+<body>
+  <h5>{{ student.name }} &middot; {{ title }}</h5>
+  <button class="btn btn-sm btn-outline-secondary no-print mb-2" onclick="window.print()">Print</button>
+  <table class="table table-sm table-bordered">
+    <thead><tr><th>Date</th><th>Time</th><th>Subject</th><th>Teacher</th></tr></thead>
+    <tbody>
+      {% for s in sessions %}
+        <tr>
+          <td class="timecell">{{ s.session_date.strftime("%a %d %b") }}</td>
+          <td class="timecell">{{ s.start_time.strftime("%H:%M") }}-{{ s.end_time.strftime("%H:%M") }}</td>
+          <td>{{ s.subject.name }}</td>
+          <td>{{ s.teacher.nickname or s.teacher.name }}</td>
+        </tr>
+      {% else %}
+        <tr><td colspan="4">No classes.</td></tr>
+      {% endfor %}
+    </tbody>
+  </table>
+</body>
+</html>
+""", student=student, title=title, sessions=sessions)
+
+    grouped = {}
+    for s in sessions:
+        grouped.setdefault(s.session_date, []).append(s)
+    page = """
+    <h5>Timetable for {{ student.name }}</h5>
+    <div class="mb-3 d-flex flex-wrap gap-1">
+      <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('student_timetable', student_id=student.id, view=view, date=previous.isoformat()) }}">&laquo; Previous</a>
+      <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('student_timetable', student_id=student.id, view=view) }}">Today</a>
+      <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('student_timetable', student_id=student.id, view=view, date=following.isoformat()) }}">Next &raquo;</a>
+      {% for v in ["month", "week"] %}
+        <a class="btn btn-sm {{ 'btn-secondary' if v == view else 'btn-outline-secondary' }}"
+           href="{{ url_for('student_timetable', student_id=student.id, view=v, date=first.isoformat()) }}">{{ v|capitalize }}</a>
+      {% endfor %}
+      <a class="btn btn-sm btn-outline-dark" target="_blank" href="{{ url_for('student_timetable', student_id=student.id, view=view, date=first.isoformat(), print=1) }}">Printable</a>
+      <a class="btn btn-sm btn-outline-dark" href="{{ url_for('student_ics', student_id=student.id, _external=True) }}"
+         title="Subscribe to this URL in a calendar app">Calendar feed</a>
+      <a class="btn btn-sm btn-outline-success" href="{{ url_for('export_timetable', format='csv', **export_args) }}">Download CSV</a>
+      <a class="btn btn-sm btn-outline-success" href="{{ url_for('export_timetable', format='excel', **export_args) }}">Download Excel</a>
+    </div>
+    <h6>{{ title }} ({{ sessions|length }} classes)</h6>
+    {% for day, items in grouped.items() %}
+      <h6 class="mt-3">{{ day.strftime("%A %d %B") }}</h6>
+      <table class="table table-sm table-bordered">
+        <thead>
+          <tr>
+            <th class="timecell">Start</th>
+            <th class="timecell">End</th>
+            <th>Subject</th>
+            <th>Teacher</th>
+            <th>Notes</th>
+            <th style="width:80px">Actions</th>
+          </tr>
+        </thead>
+        <tbody>
+          {% for s in items %}
+            <tr>
+              <td class="timecell">{{ s.start_time.strftime("%H:%M") }}</td>
+              <td class="timecell">{{ s.end_time.strftime("%H:%M") }}</td>
+              <td>{{ s.subject.name }}</td>
+              <td>{{ s.teacher.name }}{% if s.teacher.nickname %} ({{ s.teacher.nickname }}){% endif %}</td>
+              <td>{{ s.notes or "" }}</td>
+              <td><a class="btn btn-sm btn-outline-secondary" href="{{ url_for('edit_session', session_id=s.id) }}">Edit</a></td>
+            </tr>
+          {% endfor %}
+        </tbody>
+      </table>
+    {% else %}
+      <div class="alert alert-secondary">No classes in this {{ view }}.</div>
+    {% endfor %}
+    """
+    return render(page, student=student, view=view, first=first, previous=previous, following=following,
+                  title=title, sessions=sessions, grouped=grouped, export_args=export_args)
+
+# -------------------------
+# Calendar feeds (iCalendar per teacher / student)
+# -------------------------
+ICS_PAST_DAYS = 30
+ICS_FUTURE_DAYS = 365
+ICS_CACHE_SIZE = 256
+
+_ics_lock = threading.Lock()
+_ics_cache = OrderedDict()  # (owner, id) -> (etag, body), least recently used first
+
+def _ics_text(value):
+    return (value or "").replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+def _ics_fold(line):
+    # Content lines are limited to 75 octets; continuation lines start with a space
+    raw = line.encode()
+    parts = []
+    while len(raw) > 75:
+        cut = 75 if not parts else 74
+        while cut and (raw[cut] & 0xC0) == 0x80:  # don't split a UTF-8 sequence
+            cut -= 1
+        parts.append(raw[:cut].decode())
+        raw = raw[cut:]
+    parts.append(raw.decode())
+    return "\r\n ".join(parts)
+
+def build_ics(owner, owner_id, title):
+    """The owner's sessions from ICS_PAST_DAYS ago to ICS_FUTURE_DAYS ahead as an iCalendar document."""
+    today = date.today()
+    column = ClassSession.teacher_id if owner == "teacher" else ClassSession.student_id
+    rows = db.session.query(
+        ClassSession.id, ClassSession.session_date, ClassSession.start_time, ClassSession.end_time,
+        ClassSession.teacher_id, ClassSession.student_id, ClassSession.subject_id, ClassSession.notes
+    ).filter(
+        column == owner_id,
+        ClassSession.session_date >= today - timedelta(days=ICS_PAST_DAYS),
+        ClassSession.session_date <= today + timedelta(days=ICS_FUTURE_DAYS)
+    ).order_by(ClassSession.session_date.asc(), ClassSession.start_time.asc()).all()
+    names = load_reference_names()
+    stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//EL Timetable//Schedule//EN", "CALSCALE:GREGORIAN",
+             f"X-WR-CALNAME:{_ics_text(title)}"]
+    for session_id, day, start, end, teacher_id, student_id, subject_id, notes in rows:
+        subject = names["subject"].get(subject_id, "")
+        if owner == "teacher":
+            summary = f"{subject} - {names['student'].get(student_id, '')}"
+        else:
+            summary = f"{subject} with {names['nickname'].get(teacher_id) or names['teacher'].get(teacher_id, '')}"
+        # Floating local times: the school's wall clock, whatever the phone's zone
+        lines += ["BEGIN:VEVENT", f"UID:session-{session_id}@el-timetable", f"DTSTAMP:{stamp}",
+                  f"DTSTART:{datetime.combine(day, start).strftime('%Y%m%dT%H%M%S')}",
+                  f"DTEND:{datetime.combine(day, end).strftime('%Y%m%dT%H%M%S')}",
+                  f"SUMMARY:{_ics_text(summary)}"]
+        if notes:
+            lines.append(f"DESCRIPTION:{_ics_text(notes)}")
+        lines.append("END:VEVENT")
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(_ics_fold(line) for line in lines) + "\r\n"
+
+def ics_response(owner, owner_id, title):
+    """Serve the feed from cache while the owner's sessions and the names it shows are unchanged.
+
+    The ETag is the owner's latest session change-log version, the
+    reference-data version and today's date (the window moves daily), so
+    polling clients get a 304 without the feed being rebuilt.
+    """
+    version, reference_version = change_stamp(owner, owner_id)
+    etag = f"{owner}-{owner_id}-{version}-{reference_version}-{date.today().isoformat()}"
+    with _ics_lock:
+        cached = _ics_cache.get((owner, owner_id))
+        if cached:
+            _ics_cache.move_to_end((owner, owner_id))
+    if cached and cached[0] == etag:
+        body = cached[1]
+    else:
+        body = build_ics(owner, owner_id, title)
+        with _ics_lock:
+            _ics_cache[(owner, owner_id)] = (etag, body)
+            _ics_cache.move_to_end((owner, owner_id))
+            while len(_ics_cache) > ICS_CACHE_SIZE:
+                _ics_cache.popitem(last=False)
+    response = Response(body, mimetype="text/calendar")
+    response.set_etag(etag)
+    response.cache_control.max_age = 300
+    return response.make_conditional(request)
+
+@app.route("/calendar/teacher/<int:teacher_id>.ics")
+def teacher_ics(teacher_id):
+    teacher = reference_lists()["teacher_by_id"].get(teacher_id)
+    if not teacher:
+        return "Teacher not found.", 404
+    return ics_response("teacher", teacher_id, f"Classes - {teacher.name}")
+
+@app.route("/calendar/student/<int:student_id>.ics")
+def student_ics(student_id):
+    student = reference_lists()["student_by_id"].get(student_id)
+    if not student:
+        return "Student not found.", 404
+    return ics_response("student", student_id, f"Classes - {student.name}")
+
+# -------------------------
+# Free-slot finder (per-day availability bitmasks)
+# -------------------------
+# A day is a row of SLOT_MINUTES-long slots between opening and closing time;
+# bit i of a day mask is set when slot i is taken.
+SLOT_MINUTES = 15
+FREE_SLOTS_MAX_DAYS = 92
+
+def _minutes(t):
+    return t.hour * 60 + t.minute
+
+def day_slots():
+    """Number of slots between opening and closing time."""
+    opening = _minutes(parse_time(app.config["OPENING_TIME"]))
+    closing = _minutes(parse_time(app.config["CLOSING_TIME"]))
+    return (closing - opening) // SLOT_MINUTES
+
+def slot_mask(start, end):
+    """Mask of the slots touched by [start, end), clipped to opening hours."""
+    opening = _minutes(parse_time(app.config["OPENING_TIME"]))
+    first = max((_minutes(start) - opening) // SLOT_MINUTES, 0)
+    last = min(-(-(_minutes(end) - opening) // SLOT_MINUTES), day_slots())
+    if last <= first:
+        return 0
+    return ((1 << (last - first)) - 1) << first
+
+def slot_time(index):
+    """Clock time at the start of slot `index`."""
+    minutes = _minutes(parse_time(app.config["OPENING_TIME"])) + index * SLOT_MINUTES
+    return datetime.min.replace(hour=minutes // 60, minute=minutes % 60).time()
+
+def busy_masks(first, last, teacher_ids=(), student_ids=()):
+    """Busy masks per day for the given teachers and students, from one query over [first, last].
+
+    Returns {("teacher", id): {date: mask}, ("student", id): {date: mask}}.
+    """
+    owners = []
+    if teacher_ids:
+        owners.append(ClassSession.teacher_id.in_(list(teacher_ids)))
+    if student_ids:
+        owners.append(ClassSession.student_id.in_(list(student_ids)))
+    masks = {}
+    if not owners:
+        return masks
+    rows = db.session.query(
+        ClassSession.teacher_id, ClassSession.student_id, ClassSession.session_date,
+        ClassSession.start_time, ClassSession.end_time
+    ).filter(
+        ClassSession.session_date >= first, ClassSession.session_date <= last, or_(*owners)
+    ).all()
+    teacher_ids, student_ids = set(teacher_ids), set(student_ids)
+    for teacher_id, student_id, day, start, end in rows:
+        bits = slot_mask(start, end)
+        if teacher_id in teacher_ids:
+            days = masks.setdefault(("teacher", teacher_id), {})
+            days[day] = days.get(day, 0) | bits
+        if student_id in student_ids:
+            days = masks.setdefault(("student", student_id), {})
+            days[day] = days.get(day, 0) | bits
+    return masks
+
+def run_starts(free, length):
+    """Mask of the slots where `length` consecutive free slots begin."""
+    if length > free.bit_length():
+        return 0  # no run that long can exist; don't shift `length` times to find out
+    starts = free
+    for k in range(1, length):
+        starts &= free >> k
+    return starts
+
+def free_windows(free, length):
+    """Maximal runs of set bits in `free` that are at least `length` slots long, as (first, end) indexes."""
+    windows = []
+    i, n = 0, free.bit_length()
+    while i < n:
+        if free >> i & 1:
+            j = i
+            while free >> j & 1:
+                j += 1
+            if j - i >= length:
+                windows.append((i, j))
+            i = j
+        else:
+            i += 1
+    return windows
+
+@app.route("/free_slots")
+def free_slots():
+    """Common free windows for a teacher and/or student that fit ?duration= minutes between ?start= and ?end=."""
+    teacher_id = request.args.get("teacher_id", type=int)
+    student_id = request.args.get("student_id", type=int)
+    duration = request.args.get("duration", 60, type=int)
+    first = parse_date(request.args.get("start", "")) or date.today()
+    last = parse_date(request.args.get("end", "")) or first + timedelta(days=13)
+    if not (teacher_id or student_id) or duration <= 0 or last < first:
+        return {"error": "teacher_id or student_id, a positive duration and a valid range are required"}, 400
+    last = min(last, first + timedelta(days=FREE_SLOTS_MAX_DAYS - 1))
+    if duration > day_slots() * SLOT_MINUTES:
+        return {"duration": duration, "slots": []}  # longer than the opening hours: nothing can fit
+
+    length = -(-duration // SLOT_MINUTES)
+    open_mask = (1 << day_slots()) - 1
+    masks = busy_masks(first, last, [teacher_id] if teacher_id else [], [student_id] if student_id else [])
+    teacher_busy = masks.get(("teacher", teacher_id), {})
+    student_busy = masks.get(("student", student_id), {})
+    slots = []
+    day = first
+    while day <= last:
+        free = open_mask & ~(teacher_busy.get(day, 0) | student_busy.get(day, 0))
+        if run_starts(free, length):
+            for begin, end in free_windows(free, length):
+                slots.append({
+                    "date": day.isoformat(),
+                    "start": slot_time(begin).strftime("%H:%M"),
+                    "end": slot_time(end).strftime("%H:%M"),
+                })
+        day += timedelta(days=1)
+    return {"duration": duration, "slots": slots}
+
+# -------------------------
+# Term scheduler
+# -------------------------
+# Places each enrollment's remaining classes for a term: one class per
+# stretch of the term, same weekday/time/teacher when possible, inside
+# teacher availability windows and free on both sides' day masks. Classes
+# the greedy pass cannot place get a repair pass that moves one blocking
+# proposal elsewhere in its own week. The repair pass has a fixed work
+# budget so a term that simply does not fit still plans in seconds.
+TERM_REPAIR_BUDGET = 200_000  # slot positions examined, plus slots tried when moving a blocker
+
+def _term_inputs(first, last):
+    """Load everything the planner needs in a handful of queries."""
+    enrollments = db.session.query(
+        student_subjects.c.student_id, student_subjects.c.subject_id, Subject.number_of_classes
+    ).join(Subject, Subject.id == student_subjects.c.subject_id).filter(
+        Subject.number_of_classes > 0
+    ).order_by(student_subjects.c.student_id, student_subjects.c.subject_id).all()
+
+    # Who has taught what to whom decides candidate and preferred teachers
+    history = db.session.query(
+        ClassSession.student_id, ClassSession.subject_id, ClassSession.teacher_id, func.count(ClassSession.id)
+    ).group_by(ClassSession.student_id, ClassSession.subject_id, ClassSession.teacher_id).all()
+
+    # Sessions already in the term: how many each enrollment has, and on which days
+    scheduled, booked_days = {}, {}
+    for st, subj, day in db.session.query(
+        ClassSession.student_id, ClassSession.subject_id, ClassSession.session_date
+    ).filter(ClassSession.session_date >= first, ClassSession.session_date <= last):
+        scheduled[(st, subj)] = scheduled.get((st, subj), 0) + 1
+        booked_days.setdefault((st, subj), set()).add(day)
+
+    return enrollments, history, scheduled, booked_days, availability_masks()
+
+def availability_masks():
+    """Slot mask of every teacher's availability windows, keyed by (teacher_id, weekday)."""
+    avail = {}
+    for teacher_id, weekday, start, end in db.session.query(
+        TeacherAvailability.teacher_id, TeacherAvailability.weekday,
+        TeacherAvailability.start_time, TeacherAvailability.end_time
+    ):
+        avail[(teacher_id, weekday)] = avail.get((teacher_id, weekday), 0) | slot_mask(start, end)
+    return avail
+
+def plan_term(first, last, duration):
+    """Plan sessions for all enrollments in [first, last]; returns (proposals, unplaced).
+
+    Proposals are dicts with student_id, subject_id, teacher_id, date and slot;
+    unplaced maps (student_id, subject_id) to the number of classes left over.
+    Enrollments already holding sessions in the term only get the remainder.
+    """
+    length = -(-duration // SLOT_MINUTES)
+    enrollments, history, scheduled, booked_days, avail = _term_inputs(first, last)
+    available_teachers = sorted({t for t, _ in avail})
+    subject_teachers, pair_teachers = {}, {}
+    for st, subj, t, n in history:
+        if t in available_teachers:
+            subject_teachers.setdefault(subj, set()).add(t)
+            pair_teachers.setdefault((st, subj), []).append((-n, t))
+
+    def candidates(st, subj):
+        preferred = [t for _, t in sorted(pair_teachers.get((st, subj), []))]
+        rest = sorted(subject_teachers.get(subj) or available_teachers)
+        return preferred + [t for t in rest if t not in preferred]
+
+    days = [first + timedelta(days=i) for i in range((last - first).days + 1)]
+    weeks = [days[i:i + 7] for i in range(0, len(days), 7)]
+    masks = busy_masks(first, last, available_teachers, {st for st, _, _ in enrollments})
+    base = {key: dict(by_day) for key, by_day in masks.items()}  # existing sessions only
+    proposals_at = {}  # (kind, owner, day) -> proposals booking that teacher or student that day
+    full = set()  # (teacher, day) with no room left for a class, whoever the student
+
+    def busy(kind, owner, day):
+        return masks.get((kind, owner), {}).get(day, 0)
+
+    def reserve(p, sign):
+        bits = ((1 << length) - 1) << p["slot"]
+        for key in (("teacher", p["teacher_id"]), ("student", p["student_id"])):
+            by_day = masks.setdefault(key, {})
+            by_day[p["date"]] = by_day.get(p["date"], 0) | bits if sign > 0 else by_day.get(p["date"], 0) & ~bits
+        for key in (("teacher", p["teacher_id"], p["date"]), ("student", p["student_id"], p["date"])):
+            if sign > 0:
+                proposals_at.setdefault(key, []).append(p)
+            else:
+                proposals_at[key].remove(p)
+        if sign < 0:
+            full.discard((p["teacher_id"], p["date"]))
+
+    def find_slot(st, teachers, day_list, prefer=None, used_days=()):
+        for day in day_list:
+            if day in used_days:
+                continue
+            for t in teachers:
+                if (t, day) in full:
+                    continue
+                free = avail.get((t, day.weekday()), 0) & ~busy("teacher", t, day)
+                if not run_starts(free, length):
+                    full.add((t, day))
+                    continue
+                starts = run_starts(free & ~busy("student", st, day), length)
+                if not starts:
+                    continue
+                if prefer and prefer[0] == t and prefer[1] == day.weekday() and starts >> prefer[2] & 1:
+                    return t, day, prefer[2]
+                return t, day, (starts & -starts).bit_length() - 1
+        return None
+
+    # Most constrained first: fewest candidate teachers, then most classes needed
+    work = []
+    for st, subj, classes in enrollments:
+        needed = classes - scheduled.get((st, subj), 0)
+        teachers = candidates(st, subj)
+        if needed > 0:
+            work.append((len(teachers), -needed, st, subj, needed, teachers))
+    work.sort()
+
+    proposals, unplaced, plans = [], {}, {}
+    for _, _, st, subj, needed, teachers in work:
+        used_days, prefer = set(booked_days.get((st, subj), ())), None
+        for i in range(needed):
+            target = weeks[i * len(weeks) // needed] if weeks else []
+            # Same weekday as the first class first, then the rest of the week, then anywhere in the term
+            ordered = sorted(target, key=lambda d: (prefer is None or d.weekday() != prefer[1], d))
+            found = find_slot(st, [prefer[0]] + [t for t in teachers if t != prefer[0]] if prefer else teachers,
+                              ordered, prefer, used_days) or find_slot(st, teachers, days, None, used_days)
+            if not found:
+                # Nothing fits anywhere in the term, and masks only fill up from here: skip the rest
+                unplaced[(st, subj)] = needed - i
+                break
+            t, day, slot = found
+            p = {"student_id": st, "subject_id": subj, "teacher_id": t, "date": day, "slot": slot}
+            reserve(p, 1)
+            proposals.append(p)
+            used_days.add(day)
+            prefer = prefer or (t, day.weekday(), slot)
+        plans[(st, subj)] = (teachers, used_days)
+
+    # Repair: free a slot by moving a single blocking proposal somewhere else in its week
+    budget = [TERM_REPAIR_BUDGET]
+    for (st, subj), missing in sorted(unplaced.items()):
+        teachers, used_days = plans[(st, subj)]
+        for _ in range(missing):
+            if budget[0] <= 0 or not _repair_one(st, subj, teachers, used_days, days, length, avail, base,
+                                                 proposals_at, plans, reserve, find_slot, proposals, budget):
+                break  # a failed repair changes nothing, so this enrollment's other classes would fail too
+            unplaced[(st, subj)] -= 1
+    unplaced = {k: v for k, v in unplaced.items() if v}
+    proposals.sort(key=lambda p: (p["date"], p["slot"], p["teacher_id"]))
+    return proposals, unplaced
+
+def _repair_one(st, subj, teachers, used_days, days, length, avail, base, proposals_at,
+                plans, reserve, find_slot, proposals, budget):
+    bits_for = lambda slot: ((1 << length) - 1) << slot
+    for day in days:
+        if day in used_days:
+            continue
+        for t in teachers:
+            # Ignoring other proposals, where could this class go?
+            free = avail.get((t, day.weekday()), 0) & ~base.get(("teacher", t), {}).get(day, 0) \
+                & ~base.get(("student", st), {}).get(day, 0)
+            starts = run_starts(free, length)
+            nearby = proposals_at.get(("teacher", t, day), []) + [
+                p for p in proposals_at.get(("student", st, day), []) if p["teacher_id"] != t]
+            while starts:
+                budget[0] -= 1
+                if budget[0] <= 0:
+                    return False
+                slot = (starts & -starts).bit_length() - 1
+                starts &= starts - 1
+                want = bits_for(slot)
+                blockers = [p for p in nearby if bits_for(p["slot"]) & want]
+                mine = {"student_id": st, "subject_id": subj, "teacher_id": t, "date": day, "slot": slot}
+                if not blockers:
+                    # Freed up by an earlier repair
+                    reserve(mine, 1)
+                    proposals.append(mine)
+                    used_days.add(day)
+                    return True
+                if len(blockers) != 1:
+                    continue
+                blocker = blockers[0]
+                b_teachers, b_days = plans[(blocker["student_id"], blocker["subject_id"])]
+                week_start = days[(blocker["date"] - days[0]).days // 7 * 7]
+                week = [d for d in days if 0 <= (d - week_start).days < 7]
+                budget[0] -= len(week) * len(b_teachers)
+                reserve(blocker, -1)
+                reserve(mine, 1)
+                moved = find_slot(blocker["student_id"], b_teachers, week, None, b_days - {blocker["date"]})
+                if moved:
+                    b_days.discard(blocker["date"])
+                    blocker["teacher_id"], blocker["date"], blocker["slot"] = moved
+                    b_days.add(blocker["date"])
+                    reserve(blocker, 1)
+                    proposals.append(mine)
+                    used_days.add(day)
+                    return True
+                reserve(mine, -1)
+                reserve(blocker, 1)
+    return False
+
+def encode_term_plan(first, last, duration, proposals, unplaced):
+    """The previewed plan as compact JSON for the form, so Create books exactly what was shown."""
+    return json.dumps({
+        "start": first.isoformat(), "end": last.isoformat(), "duration": duration,
+        "unplaced": sum(unplaced.values()),
+        "proposals": [[p["student_id"], p["subject_id"], p["teacher_id"], (p["date"] - first).days, p["slot"]]
+                      for p in proposals],
+    }, separators=(",", ":"))
+
+def decode_term_plan(raw):
+    """(first, last, duration, proposals, unplaced count) from encode_term_plan output, or None if malformed."""
+    try:
+        plan = json.loads(raw)
+        first, last = date.fromisoformat(plan["start"]), date.fromisoformat(plan["end"])
+        proposals = [{"student_id": int(st), "subject_id": int(subj), "teacher_id": int(t),
+                      "date": first + timedelta(days=int(offset)), "slot": int(slot)}
+                     for st, subj, t, offset, slot in plan["proposals"]]
+        return first, last, int(plan["duration"]), proposals, int(plan["unplaced"])
+    except (ValueError, TypeError, KeyError):
+        return None
+
+def term_plan_still_fits(first, last, duration, proposals):
+    """Whether previewed proposals are still bookable: inside the term, opening hours and availability,
+    for existing people and subjects, and clear of each other and of anything booked since the preview."""
+    length = duration // SLOT_MINUTES
+    if not proposals or duration <= 0 or duration % SLOT_MINUTES or length > day_slots():
+        return False
+    refs = reference_lists()
+    avail = availability_masks()
+    masks = busy_masks(first, last, {p["teacher_id"] for p in proposals}, {p["student_id"] for p in proposals})
+    for p in proposals:
+        bits = ((1 << length) - 1) << p["slot"]
+        if not first <= p["date"] <= last or p["slot"] < 0 or p["slot"] + length > day_slots() \
+                or p["teacher_id"] not in refs["teacher_by_id"] or p["student_id"] not in refs["student_by_id"] \
+                or p["subject_id"] not in refs["subject_by_id"] \
+                or bits & ~avail.get((p["teacher_id"], p["date"].weekday()), 0):
+            return False
+        for key in (("teacher", p["teacher_id"]), ("student", p["student_id"])):
+            by_day = masks.setdefault(key, {})
+            if by_day.get(p["date"], 0) & bits:
+                return False
+            by_day[p["date"]] = by_day.get(p["date"], 0) | bits
+    return True
+
+@app.route("/schedule/term", methods=["GET","POST"])
+def schedule_term():
+    today = date.today()
+    first = parse_date(request.form.get("start", "")) or today
+    last = parse_date(request.form.get("end", "")) or first + timedelta(weeks=12) - timedelta(days=1)
+    duration = request.form.get("duration", 60, type=int)
+    proposals, unplaced = [], {}
+    if request.method == "POST":
+        if last < first or (last - first).days > 366:
+            flash("Choose an end date after the start date, at most a year apart.")
+            return redirect(url_for("schedule_term"))
+        if duration <= 0 or duration % SLOT_MINUTES or duration > day_slots() * SLOT_MINUTES:
+            flash(f"Class length must be a multiple of {SLOT_MINUTES} minutes, "
+                  f"at most {day_slots() * SLOT_MINUTES} (the opening hours).")
+            return redirect(url_for("schedule_term"))
+        plan = decode_term_plan(request.form.get("plan", "")) if request.form.get("action") == "commit" else None
+        if plan and term_plan_still_fits(*plan[:4]):
+            # Book exactly what was previewed instead of planning again
+            first, last, duration, proposals, unplaced_count = plan
+            length = duration // SLOT_MINUTES
+            new_ids = db.session.execute(
+                ClassSession.__table__.insert().returning(ClassSession.id, sort_by_parameter_order=True), [{
+                    "teacher_id": p["teacher_id"], "student_id": p["student_id"], "subject_id": p["subject_id"],
+                    "session_date": p["date"], "start_time": slot_time(p["slot"]),
+                    "end_time": slot_time(p["slot"] + length), "notes": None
+                } for p in proposals]
+            ).scalars().all()
+            record_changes([{
+                "entity": "session", "entity_id": session_id, "op": "insert", "teacher_id": p["teacher_id"],
+                "student_id": p["student_id"], "session_date": p["date"]
+            } for session_id, p in zip(new_ids, proposals)])
+            log_action("schedule_term", f"Created {len(proposals)} sessions for {first} to {last}"
+                       + (f"; {unplaced_count} classes could not be placed" if unplaced_count else ""),
+                       commit=False)
+            db.session.commit()
+            flash(f"Created {len(proposals)} sessions.")
+            return redirect(url_for("weekly_timetable"))
+        if request.form.get("action") == "commit":
+            flash("The timetable changed since the preview; check the new plan below before creating it.")
+        proposals, unplaced = plan_term(first, last, duration)
+
+    names = {
+        "teacher": dict(db.session.query(Teacher.id, Teacher.name).all()),
+        "student": dict(db.session.query(Student.id, Student.name).all()),
+        "subject": dict(db.session.query(Subject.id, Subject.name).all()),
+    } if request.method == "POST" else {}
+    length = duration // SLOT_MINUTES
+    plan = encode_term_plan(first, last, duration, proposals, unplaced) if proposals else ""
+    page = """
+    <h5>Term Scheduler</h5>
+    <p class="text-muted">Books each enrolled student's remaining classes (subject class count minus sessions
+      already in the term) inside teacher availability windows, without clashes.</p>
+    <form method="post" class="row g-2 mb-3">
+      <div class="col-md-3"><label class="form-label">Term start</label><input class="form-control" type="date" name="start" value="{{ first.isoformat() }}"></div>
+      <div class="col-md-3"><label class="form-label">Term end</label><input class="form-control" type="date" name="end" value="{{ last.isoformat() }}"></div>
+      <div class="col-md-2"><label class="form-label">Minutes</label><input class="form-control" type="number" name="duration" step="15" value="{{ duration }}"></div>
+      <div class="col-md-4 d-flex align-items-end gap-2">
+        <button class="btn btn-primary" name="action" value="preview">Preview</button>
+        {% if proposals %}
+          <input type="hidden" name="plan" value="{{ plan }}">
+          <button class="btn btn-success" name="action" value="commit" onclick="return confirm('Create {{ proposals|length }} sessions?')">Create {{ proposals|length }} sessions</button>
+        {% endif %}
+      </div>
+    </form>
+    {% if unplaced %}
+      <div class="alert alert-warning">
+        Could not place:
+        {% for (st, subj), n in unplaced.items() %}
+          {{ names.student.get(st) }} / {{ names.subject.get(subj) }} ({{ n }}){% if not loop.last %}, {% endif %}
+        {% endfor %}
+      </div>
+    {% endif %}
+    {% if proposals %}
+      <table class="table table-sm table-bordered">
+        <thead><tr><th>Date</th><th>Start</th><th>End</th><th>Teacher</th><th>Student</th><th>Subject</th></tr></thead>
+        <tbody>
+          {% for p in proposals %}
+            <tr>
+              <td>{{ p.date.isoformat() }} ({{ p.date.strftime("%a") }})</td>
+              <td class="timecell">{{ slot_time(p.slot).strftime("%H:%M") }}</td>
+              <td class="timecell">{{ slot_time(p.slot + length).strftime("%H:%M") }}</td>
+              <td>{{ names.teacher.get(p.teacher_id) }}</td>
+              <td>{{ names.student.get(p.student_id) }}</td>
+              <td>{{ names.subject.get(p.subject_id) }}</td>
+            </tr>
+          {% endfor %}
+        </tbody>
+      </table>
+    {% elif request.method == "POST" %}
+      <div class="alert alert-secondary">Nothing to schedule: every enrollment is already booked, or no teacher has availability.</div>
+    {% endif %}
+    """
+    return render(page, first=first, last=last, duration=duration, proposals=proposals, unplaced=unplaced,
+                  names=names, slot_time=slot_time, length=length, plan=plan)
+
+# -------------------------
+# Bulk reschedule (shift, reassign or cancel many sessions at once)
+# -------------------------
+BULK_OPERATIONS = {"shift": "Shift by days", "reassign": "Move to another teacher", "cancel": "Cancel"}
+
+def bulk_selection(teacher_id, start, end):
+    """Criteria for a bulk change: one teacher's (or everyone's) sessions from start to end (inclusive, optional)."""
+    criteria = [ClassSession.session_date >= start]
+    if end:
+        criteria.append(ClassSession.session_date <= end)
+    if teacher_id:
+        criteria.append(ClassSession.teacher_id == teacher_id)
+    return criteria
+
+def bulk_moved(criteria, days=0, new_teacher_id=None):
+    """CTE of the selected sessions as they would be after shifting by days and/or moving to new_teacher_id."""
+    new_date = func.date(ClassSession.session_date, f"{days:+d} days", type_=db.Date) if days \
+        else ClassSession.session_date
+    new_teacher = literal(new_teacher_id) if new_teacher_id else ClassSession.teacher_id
+    return select(
+        ClassSession.id, ClassSession.teacher_id.label("old_teacher_id"), ClassSession.session_date.label("old_date"),
+        new_teacher.label("teacher_id"), ClassSession.student_id, ClassSession.subject_id,
+        new_date.label("session_date"), ClassSession.start_time, ClassSession.end_time
+    ).where(*criteria).cte("moved")
+
+def bulk_conflicts(moved):
+    """(session_id, other_id, "teacher" or "student") for every clash the move would cause, in one query.
+
+    Moved sessions are checked against the sessions staying put, through the
+    (teacher_id, session_date) and (student_id, session_date) indexes, and
+    against each other.
+    """
+    other = aliased(ClassSession)
+
+    def overlaps(a, b):
+        return and_(a.session_date == b.session_date, a.start_time < b.end_time, b.start_time < a.end_time)
+
+    queries = [
+        select(moved.c.id.label("session_id"), other.id.label("other_id"), literal(kind).label("kind")).join(
+            other, and_(getattr(other, f"{kind}_id") == moved.c[f"{kind}_id"], overlaps(moved.c, other))
+        ).where(other.id.not_in(select(moved.c.id)))
+        for kind in ("teacher", "student")
+    ]
+    pair = moved.alias("moved_pair")
+    queries.append(select(
+        moved.c.id, pair.c.id, case((moved.c.teacher_id == pair.c.teacher_id, "teacher"), else_="student")
+    ).join(pair, and_(
+        moved.c.id < pair.c.id,
+        or_(moved.c.teacher_id == pair.c.teacher_id, moved.c.student_id == pair.c.student_id),
+        overlaps(moved.c, pair.c)
+    )))
+    return db.session.execute(union_all(*queries)).all()
+
+@app.route("/sessions/bulk", methods=["GET","POST"])
+def bulk_sessions():
+    refs = reference_lists()
+    teacher_id = request.values.get("teacher_id", type=int)
+    start = parse_date(request.values.get("start", "")) or date.today()
+    end = parse_date(request.values.get("end", ""))
+    operation = request.values.get("operation")
+    operation = operation if operation in BULK_OPERATIONS else "shift"
+    days = request.values.get("days", 0, type=int) or 0
+    new_teacher_id = request.values.get("new_teacher_id", type=int)
+    rows, conflicts = [], {}
+    if request.method == "POST":
+        if not teacher_id and not end:
+            error = "Choose a teacher, an end date, or both."
+        elif end and end < start:
+            error = "The end date must not be before the start date."
+        elif operation == "shift" and not days:
+            error = "Enter how many days to shift by (negative moves earlier)."
+        elif operation == "reassign" and (new_teacher_id not in refs["teacher_by_id"] or new_teacher_id == teacher_id):
+            error = "Choose another teacher to move the sessions to."
+        else:
+            error = None
+        if error:
+            flash(error)
+            return redirect(url_for("bulk_sessions", teacher_id=teacher_id, start=start.isoformat(),
+                                    end=end and end.isoformat(), operation=operation, days=days or None,
+                                    new_teacher_id=new_teacher_id))
+        if operation != "shift":
+            days = 0
+        if operation != "reassign":
+            new_teacher_id = None
+        moved = bulk_moved(bulk_selection(teacher_id, start, end), days, new_teacher_id)
+        rows = db.session.execute(select(moved).order_by(moved.c.old_date.asc(), moved.c.start_time.asc())).all()
+        if operation != "cancel":
+            for session_id, other_id, kind in bulk_conflicts(moved):
+                conflicts.setdefault(session_id, []).append((kind, other_id))
+
+        if request.form.get("action") == "apply" and rows:
+            if conflicts:
+                flash(f"{len(conflicts)} sessions would clash; nothing was changed.")
+            else:
+                names = load_reference_names()
+                ids = [row.id for row in rows]
+                selected = ClassSession.id.in_(ids)
+                scope = (f"{names['teacher'].get(teacher_id, '') if teacher_id else 'all teachers'}, "
+                         f"{start}{f' to {end}' if end else ' onwards'}")
+                if operation == "cancel":
+                    adjust_attendance_stats(ids, -1)
+                    delete_cascading(ClassSession.__table__, selected, "bulk cancel")
+                    summary = f"Cancelled {len(ids)} sessions ({scope})"
+                else:
+                    values = {"teacher_id": new_teacher_id} if new_teacher_id else {
+                        "session_date": func.date(ClassSession.session_date, f"{days:+d} days")}
+                    record_session_changes("update", selected)  # the old owner's view changes too
+                    with attendance_stats_tracking(ids):
+                        db.session.execute(ClassSession.__table__.update().where(selected).values(**values))
+                    record_session_changes("update", selected)
+                    summary = f"Moved {len(ids)} sessions ({scope}) to {names['teacher'][new_teacher_id]}" \
+                        if new_teacher_id else f"Shifted {len(ids)} sessions ({scope}) by {days:+d} days"
+                log_action("bulk_reschedule", summary, commit=False)
+                db.session.commit()
+                flash(summary + ".")
+                return redirect(url_for("home", teacher_id=new_teacher_id or teacher_id,
+                                        date=(start + timedelta(days=days)).isoformat()))
+
+    page = """
+    <h5>Bulk Reschedule</h5>
+    <p class="text-muted">Shift, reassign or cancel every session of a teacher (or of everyone) in a date range,
+      for sick days and school holidays. Clashes are checked for the whole batch before anything changes.</p>
+    <form method="post" class="row g-2 mb-3">
+      <div class="col-md-3">
+        <label class="form-label">Teacher</label>
+        <select class="form-select" name="teacher_id">
+          <option value="">-- all teachers --</option>
+          {% for t in teachers %}
+            <option value="{{ t.id }}" {% if teacher_id == t.id %}selected{% endif %}>{{ t.name }}</option>
+          {% endfor %}
+        </select>
+      </div>
+      <div class="col-md-2"><label class="form-label">From</label><input class="form-control" type="date" name="start" value="{{ start.isoformat() }}"></div>
+      <div class="col-md-2"><label class="form-label">To</label><input class="form-control" type="date" name="end" value="{{ end.isoformat() if end else '' }}"></div>
+      <div class="col-md-2">
+        <label class="form-label">Change</label>
+        <select class="form-select" name="operation">
+          {% for key, label in operations.items() %}
+            <option value="{{ key }}" {% if key == operation %}selected{% endif %}>{{ label }}</option>
+          {% endfor %}
+        </select>
+      </div>
+      <div class="col-md-1"><label class="form-label">Days</label><input class="form-control" type="number" name="days" value="{{ days or '' }}"></div>
+      <div class="col-md-2">
+        <label class="form-label">New teacher</label>
+        <select class="form-select" name="new_teacher_id">
+          <option value="">--</option>
+          {% for t in teachers %}
+            <option value="{{ t.id }}" {% if new_teacher_id == t.id %}selected{% endif %}>{{ t.name }}</option>
+          {% endfor %}
+        </select>
+      </div>
+      <div class="col-12 d-flex gap-2">
+        <button class="btn btn-primary" name="action" value="preview">Preview</button>
+        {% if rows and not conflicts %}
+          <button class="btn btn-danger" name="action" value="apply" onclick="return confirm('Apply to {{ rows|length }} sessions?')">Apply to {{ rows|length }} sessions</button>
+        {% endif %}
+      </div>
+    </form>
+    {% if conflicts %}
+      <div class="alert alert-warning">{{ conflicts|length }} sessions would clash with another booking. Adjust the change or move those sessions first.</div>
+    {% endif %}
+    {% if rows %}
+      <table class="table table-sm table-bordered">
+        <thead><tr><th>Date</th><th>Time</th><th>Teacher</th><th>Student</th><th>Subject</th><th>After</th><th>Clashes</th></tr></thead>
+        <tbody>
+          {% for r in rows %}
+            <tr {% if r.id in conflicts %}class="table-warning"{% endif %}>
+              <td>{{ r.old_date.strftime("%a %d %b %Y") }}</td>
+              <td class="timecell">{{ r.start_time.strftime("%H:%M") }}-{{ r.end_time.strftime("%H:%M") }}</td>
+              <td>{{ names.teacher.get(r.old_teacher_id, "") }}</td>
+              <td>{{ names.student.get(r.student_id, "") }}</td>
+              <td>{{ names.subject.get(r.subject_id, "") }}</td>
+              <td>
+                {% if operation == "cancel" %}Cancelled
+                {% elif operation == "shift" %}{{ r.session_date.strftime("%a %d %b %Y") }}
+                {% else %}{{ names.teacher.get(r.teacher_id, "") }}{% endif %}
+              </td>
+              <td>
+                {% for kind, other_id in conflicts.get(r.id, []) %}
+                  <a href="{{ url_for('edit_session', session_id=other_id) }}">{{ kind }} busy (#{{ other_id }})</a>{% if not loop.last %}, {% endif %}
+                {% endfor %}
+              </td>
+            </tr>
+          {% endfor %}
+        </tbody>
+      </table>
+    {% elif request.method == "POST" %}
+      <div class="alert alert-secondary">No sessions match.</div>
     {% endif %}
     """
-    return render(page, teachers=teachers, selected_teacher=selected_teacher, grouped=grouped, date=date)
+    return render(page, teachers=refs["teachers"], teacher_id=teacher_id, start=start, end=end,
+                  operation=operation, operations=BULK_OPERATIONS, days=days, new_teacher_id=new_teacher_id,
+                  rows=rows, conflicts=conflicts, names=load_reference_names())
+
+# -------------------------
+# Session search (filters, facet counts, keyset pages)
+# -------------------------
+SESSION_SEARCH_PAGE_SIZE = 50
+SESSION_FACETS = {
+    "teacher": ClassSession.teacher_id,
+    "subject": ClassSession.subject_id,
+    "weekday": func.strftime("%w", ClassSession.session_date),  # 0 = Sunday
+}
+
+def session_search_filters():
+    """export_filters plus the search page's weekday (0 = Monday) and notes text."""
+    filters = export_filters()
+    weekday = request.args.get("weekday", type=int)
+    filters["weekday"] = weekday if weekday in range(7) else None
+    filters["q"] = request.args.get("q", "").strip()
+    return filters
+
+def filter_session_search(query, filters):
+    """filter_sessions plus the weekday and notes-text filters."""
+    query = filter_sessions(query, filters)
+    if filters["weekday"] is not None:
+        query = query.filter(SESSION_FACETS["weekday"] == str((filters["weekday"] + 1) % 7))
+    if filters["q"]:
+        query = query.filter(func.lower(ClassSession.notes).like(f"%{filters['q'].lower()}%"))
+    return query
+
+def session_cursor(day, start, session_id):
+    return f"{day.isoformat()}T{start.isoformat()}_{session_id}"
+
+def parse_session_cursor(value):
+    """(date, time, id) from a session_cursor string, or None."""
+    try:
+        stamp, session_id = value.rsplit("_", 1)
+        moment = datetime.fromisoformat(stamp)
+        return moment.date(), moment.time(), int(session_id)
+    except (ValueError, AttributeError):
+        return None
+
+def session_search_page(filters, after=None, limit=SESSION_SEARCH_PAGE_SIZE):
+    """Matching sessions in (date, start, id) order after the cursor, and the cursor for the next page.
+
+    Keyset paging walks the (session_date, start_time) index from the cursor,
+    so a late page costs the same as the first one.
+    """
+    query = filter_session_search(select(
+        ClassSession.id, ClassSession.session_date, ClassSession.start_time, ClassSession.end_time,
+        ClassSession.teacher_id, ClassSession.student_id, ClassSession.subject_id, ClassSession.notes
+    ), filters)
+    if after:
+        day, start, session_id = after
+        query = query.where(or_(
+            ClassSession.session_date > day,
+            and_(ClassSession.session_date == day, or_(
+                ClassSession.start_time > start,
+                and_(ClassSession.start_time == start, ClassSession.id > session_id)
+            ))
+        ))
+    rows = db.session.execute(query.order_by(
+        ClassSession.session_date.asc(), ClassSession.start_time.asc(), ClassSession.id.asc()
+    ).limit(limit + 1)).all()
+    names = load_reference_names()
+    results = [{
+        "id": row.id, "date": row.session_date.isoformat(), "weekday": calendar.day_abbr[row.session_date.weekday()],
+        "start": row.start_time.strftime("%H:%M"), "end": row.end_time.strftime("%H:%M"),
+        "teacher_id": row.teacher_id, "teacher": names["teacher"].get(row.teacher_id, ""),
+        "student_id": row.student_id, "student": names["student"].get(row.student_id, ""),
+        "subject_id": row.subject_id, "subject": names["subject"].get(row.subject_id, ""),
+        "notes": row.notes,
+    } for row in rows[:limit]]
+    last = rows[limit - 1] if len(rows) > limit else None
+    return {"results": results, "next": session_cursor(last.session_date, last.start_time, last.id) if last else None}
+
+def session_facets(filters):
+    """Total matches and counts per teacher, subject and weekday, from one UNION ALL of grouped counts.
+
+    Each facet leaves out its own filter, so its counts show what picking
+    another teacher (say) would find.
+    """
+    queries = [filter_session_search(
+        select(literal("total"), null(), func.count()).select_from(ClassSession), filters
+    )]
+    for facet, column in SESSION_FACETS.items():
+        key = "weekday" if facet == "weekday" else f"{facet}_id"
+        queries.append(filter_session_search(
+            select(literal(facet), column, func.count()).select_from(ClassSession), dict(filters, **{key: None})
+        ).group_by(column))
+    total, counts = 0, {facet: [] for facet in SESSION_FACETS}
+    for facet, value, count in db.session.execute(union_all(*queries)):
+        if facet == "total":
+            total = count
+        elif facet == "weekday":
+            counts[facet].append(((int(value) + 6) % 7, count))
+        else:
+            counts[facet].append((value, count))
+    names = load_reference_names()
+    facets = {
+        facet: sorted(({"id": value, "name": names[facet].get(value, ""), "count": count}
+                       for value, count in counts[facet]), key=lambda f: (-f["count"], f["name"]))
+        for facet in ("teacher", "subject")
+    }
+    facets["weekday"] = [{"id": day, "name": calendar.day_abbr[day], "count": count}
+                         for day, count in sorted(counts["weekday"])]
+    return {"total": total, "facets": facets}
+
+@app.route("/sessions/search/data")
+def session_search_data():
+    """One page of matching sessions as JSON; the first page (no ?after=) also carries total and facets."""
+    filters = session_search_filters()
+    limit = max(1, min(request.args.get("limit", SESSION_SEARCH_PAGE_SIZE, type=int), SEARCH_MAX_LIMIT))
+    after = parse_session_cursor(request.args.get("after", ""))
+    payload = session_search_page(filters, after, limit)
+    if not after:
+        payload.update(session_facets(filters))
+    return payload
+
+@app.route("/sessions/search")
+def session_search():
+    filters = session_search_filters()
+    after = parse_session_cursor(request.args.get("after", ""))
+    page_data = session_search_page(filters, after)
+    page_data.update(session_facets(filters))
+    names = load_reference_names()
+    # Current filters, for facet and paging links
+    args = {k: v for k, v in request.args.items() if v and k != "after"}
+    page = """
+    <h5>Find Sessions</h5>
+    <form method="get" class="row g-2 mb-3">
+      <div class="col-md-2"><input class="form-control" type="date" name="start" value="{{ filters.start.isoformat() if filters.start else '' }}" title="From"></div>
+      <div class="col-md-2"><input class="form-control" type="date" name="end" value="{{ filters.end.isoformat() if filters.end else '' }}" title="To"></div>
+      <div class="col-md-2">
+        <select class="form-select" name="teacher_id">
+          <option value="">-- any teacher --</option>
+          {% for t in teachers %}
+            <option value="{{ t.id }}" {% if filters.teacher_id == t.id %}selected{% endif %}>{{ t.name }}</option>
+          {% endfor %}
+        </select>
+      </div>
+      <div class="col-md-2 typeahead" data-source="{{ url_for('search_students') }}">
+        <input class="form-control typeahead-input" placeholder="Any student" autocomplete="off" value="{{ names.student.get(filters.student_id, '') }}">
+        <input type="hidden" name="student_id" value="{{ filters.student_id or '' }}">
+        <div class="list-group typeahead-results"></div>
+      </div>
+      <div class="col-md-2 typeahead" data-source="{{ url_for('search_subjects') }}">
+        <input class="form-control typeahead-input" placeholder="Any subject" autocomplete="off" value="{{ names.subject.get(filters.subject_id, '') }}">
+        <input type="hidden" name="subject_id" value="{{ filters.subject_id or '' }}">
+        <div class="list-group typeahead-results"></div>
+      </div>
+      <div class="col-md-2"><input class="form-control" name="q" value="{{ filters.q }}" placeholder="Notes contain"></div>
+      {% if filters.weekday is not none %}<input type="hidden" name="weekday" value="{{ filters.weekday }}">{% endif %}
+      <div class="col-md-2"><button class="btn btn-primary w-100">Search</button></div>
+      <div class="col-md-2"><a class="btn btn-outline-secondary w-100" href="{{ url_for('session_search') }}">Clear</a></div>
+    </form>
+    <div class="row">
+      <div class="col-md-3">
+        {% for facet, key, title in [("teacher", "teacher_id", "Teacher"), ("subject", "subject_id", "Subject"), ("weekday", "weekday", "Weekday")] %}
+          <h6 class="mt-2">{{ title }}</h6>
+          <div class="list-group list-group-flush small mb-2">
+            {% if args.get(key) %}
+              <a class="list-group-item list-group-item-action text-muted" href="{{ url_for('session_search', **dict(args, **{key: None})) }}">&laquo; any</a>
+            {% endif %}
+            {% for f in facets[facet] %}
+              <a class="list-group-item list-group-item-action d-flex justify-content-between {% if args.get(key) == f.id|string %}active{% endif %}"
+                 href="{{ url_for('session_search', **dict(args, **{key: f.id})) }}">
+                <span>{{ f.name }}</span><span class="badge text-bg-light">{{ f.count }}</span>
+              </a>
+            {% endfor %}
+          </div>
+        {% endfor %}
+      </div>
+      <div class="col-md-9">
+        <div class="mb-2 text-muted">{{ total }} session{{ "" if total == 1 else "s" }}</div>
+        <table class="table table-sm table-bordered">
+          <thead><tr><th>Date</th><th>Time</th><th>Teacher</th><th>Student</th><th>Subject</th><th>Notes</th><th></th></tr></thead>
+          <tbody>
+            {% for r in results %}
+              <tr>
+                <td class="timecell">{{ r.weekday }} {{ r.date }}</td>
+                <td class="timecell">{{ r.start }}-{{ r.end }}</td>
+                <td>{{ r.teacher }}</td>
+                <td>{{ r.student }}</td>
+                <td>{{ r.subject }}</td>
+                <td>{{ r.notes or "" }}</td>
+                <td><a class="btn btn-sm btn-outline-secondary" href="{{ url_for('edit_session', session_id=r.id) }}">Edit</a></td>
+              </tr>
+            {% else %}
+              <tr><td colspan="7">No sessions match.</td></tr>
+            {% endfor %}
+          </tbody>
+        </table>
+        <div class="d-flex gap-2">
+          {% if paged %}<a class="btn btn-sm btn-outline-secondary" href="{{ url_for('session_search', **args) }}">&laquo; First page</a>{% endif %}
+          {% if next %}<a class="btn btn-sm btn-outline-secondary" href="{{ url_for('session_search', after=next, **args) }}">Next page &raquo;</a>{% endif %}
+        </div>
+      </div>
+    </div>
+    """
+    return render(page, filters=filters, teachers=reference_lists()["teachers"], names=names, args=args,
+                  results=page_data["results"], next=page_data["next"], paged=bool(after),
+                  total=page_data["total"], facets=page_data["facets"])
 
 # -------------------------
 # Teacher management
@@ -302,7 +2481,7 @@ def manage_teachers():
             flash("Teacher added.")
         return redirect(url_for("manage_teachers"))
 
-    teachers = Teacher.query.order_by(Teacher.name.asc()).all()
+    teachers = reference_lists()["teachers"]
     page = """
     <h5>Teachers</h5>
     <form method="post" class="row g-2 mb-3">
@@ -311,13 +2490,16 @@ def manage_teachers():
       <div class="col-md-2"><button class="btn btn-primary w-100">Add</button></div>
     </form>
     <table class="table table-sm table-bordered">
-      <thead><tr><th>Name</th><th>Nickname</th><th style="width:120px">Actions</th></tr></thead>
+      <thead><tr><th>Name</th><th>Nickname</th><th style="width:300px">Actions</th></tr></thead>
       <tbody>
         {% for t in teachers %}
           <tr>
             <td>{{ t.name }}</td>
             <td>{{ t.nickname or "" }}</td>
             <td>
+              <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('teacher_availability', teacher_id=t.id) }}">Availability</a>
+              <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('teacher_ics', teacher_id=t.id, _external=True) }}"
+                 title="Subscribe to this URL in a calendar app">Calendar feed</a>
               <a class="btn btn-sm btn-outline-danger"
                  href="{{ url_for('delete_teacher', teacher_id=t.id) }}"
                  onclick="return confirm('Delete teacher and their sessions?')">Delete</a>
@@ -329,13 +2511,141 @@ def manage_teachers():
     """
     return render(page, teachers=teachers)
 
+@app.route("/teachers/<int:teacher_id>/availability", methods=["GET","POST"])
+def teacher_availability(teacher_id):
+    t = Teacher.query.get_or_404(teacher_id)
+    if request.method == "POST":
+        weekday = request.form.get("weekday", type=int)
+        start_time = parse_time(request.form.get("start_time",""))
+        end_time = parse_time(request.form.get("end_time",""))
+        if weekday not in range(7) or not start_time or not end_time:
+            flash("Weekday, start and end time are required.")
+        elif end_time <= start_time:
+            flash("End time must be after start time.")
+        else:
+            db.session.add(TeacherAvailability(teacher_id=teacher_id, weekday=weekday,
+                                               start_time=start_time, end_time=end_time))
+            db.session.commit()
+            log_action("add_availability", f"Teacher={teacher_id} {calendar.day_name[weekday]} {start_time}-{end_time}")
+            flash("Availability added.")
+        return redirect(url_for("teacher_availability", teacher_id=teacher_id))
+
+    windows = TeacherAvailability.query.filter_by(teacher_id=teacher_id).order_by(
+        TeacherAvailability.weekday.asc(), TeacherAvailability.start_time.asc()
+    ).all()
+    page = """
+    <h5>Availability: {{ t.name }}</h5>
+    <form method="post" class="row g-2 mb-3">
+      <div class="col-md-3">
+        <select class="form-select" name="weekday">
+          {% for d in days %}<option value="{{ loop.index0 }}">{{ d }}</option>{% endfor %}
+        </select>
+      </div>
+      <div class="col-md-3"><input class="form-control" type="time" name="start_time" required></div>
+      <div class="col-md-3"><input class="form-control" type="time" name="end_time" required></div>
+      <div class="col-md-2"><button class="btn btn-primary w-100">Add</button></div>
+    </form>
+    <table class="table table-sm table-bordered">
+      <thead><tr><th>Day</th><th>From</th><th>To</th><th style="width:120px">Actions</th></tr></thead>
+      <tbody>
+        {% for w in windows %}
+          <tr>
+            <td>{{ days[w.weekday] }}</td>
+            <td>{{ w.start_time.strftime("%H:%M") }}</td>
+            <td>{{ w.end_time.strftime("%H:%M") }}</td>
+            <td><a class="btn btn-sm btn-outline-danger" href="{{ url_for('delete_availability', availability_id=w.id) }}">Delete</a></td>
+          </tr>
+        {% endfor %}
+      </tbody>
+    </table>
+    {% if not windows %}
+      <div class="alert alert-secondary">No availability yet. The term scheduler only books teachers inside these windows.</div>
+    {% endif %}
+    """
+    return render(page, t=t, windows=windows, days=list(calendar.day_name))
+
+@app.route("/teachers/availability/<int:availability_id>/delete")
+def delete_availability(availability_id):
+    w = TeacherAvailability.query.get_or_404(availability_id)
+    teacher_id = w.teacher_id
+    db.session.delete(w)
+    db.session.commit()
+    log_action("delete_availability", f"Deleted availability id={availability_id} for teacher={teacher_id}")
+    flash("Availability removed.")
+    return redirect(url_for("teacher_availability", teacher_id=teacher_id))
+
+# -------------------------
+# Cascading deletes (optionally archived)
+# -------------------------
+def cascade_plan(table, where):
+    """(table, where) for the rows matching where and every row ON DELETE CASCADE removes with them.
+
+    Each dependent table appears once, its criteria OR-ed across the paths
+    that reach it (attendance hangs off both student and class_session).
+    """
+    plan = OrderedDict()
+
+    def visit(table, where):
+        plan.setdefault(table, []).append(where)
+        for child in db.metadata.sorted_tables:
+            for fk in child.foreign_keys:
+                if fk.column.table is table and fk.ondelete == "CASCADE":
+                    visit(child, fk.parent.in_(select(fk.column).where(where).correlate(None)))
+
+    visit(table, where)
+    return [(t, or_(*wheres)) for t, wheres in plan.items()]
+
+def delete_cascading(table, where, archived_with):
+    """Delete table's rows matching where and, through the database cascades, everything that hangs off them.
+
+    Deleted sessions, attendance marks and payments go to the change feed
+    first. In archive mode every doomed row is copied to its archive_ table
+    beforehand, one INSERT .. SELECT per table, tagged with archived_with.
+    Returns whether rows were archived; the caller commits.
+    """
+    plan = cascade_plan(table, where)
+    for dependent, dependent_where in plan:
+        if dependent in CHANGE_RECORDERS:
+            CHANGE_RECORDERS[dependent]("delete", dependent_where)
+    archive = app.config["ARCHIVE_DELETES"]
+    if archive:
+        now = datetime.utcnow()
+        for dependent, dependent_where in plan:
+            target = archive_tables[dependent.name]
+            db.session.execute(target.insert().from_select(
+                [c.name for c in dependent.columns] + ["archived_at", "archived_with"],
+                select(*dependent.columns, literal(now), literal(archived_with)).where(dependent_where)
+            ))
+    db.session.execute(table.delete().where(where))
+    return archive
+
+DERIVED_SUMMARIES = (AttendanceStat, AttendanceStreak, PackageUsage, Balance)
+
+def delete_with_dependents(model, row_id):
+    """Delete one teacher, student or subject with everything that hangs off it; see delete_cascading.
+
+    The derived summaries have no foreign keys, so they are settled here: marks
+    in the row's sessions are counted out of the attendance summaries, then
+    summary rows keyed by the row itself are cleared rather than archived.
+    """
+    table = model.__table__
+    owner = f"{table.name}_id"
+    adjust_attendance_stats([sid for (sid,) in db.session.query(Attendance.session_id).join(
+        ClassSession, Attendance.session_id == ClassSession.id
+    ).filter(getattr(ClassSession, owner) == row_id).distinct()], -1)
+    for summary in DERIVED_SUMMARIES:
+        if owner in summary.__table__.c:
+            summary.query.filter(summary.__table__.c[owner] == row_id).delete()
+    archived = delete_cascading(table, table.c.id == row_id, f"{table.name} {row_id}")
+    db.session.info["reference_changed"] = True  # a Core delete skips the ORM flush hook
+    return archived
+
 @app.route("/teachers/<int:teacher_id>/delete")
 def delete_teacher(teacher_id):
-    t = Teacher.query.get_or_404(teacher_id)
-    ClassSession.query.filter_by(teacher_id=teacher_id).delete()
-    db.session.delete(t)
+    Teacher.query.get_or_404(teacher_id)
+    archived = delete_with_dependents(Teacher, teacher_id)
     db.session.commit()
-    log_action("delete_teacher", f"Deleted teacher id={teacher_id}")
+    log_action("delete_teacher", f"Deleted teacher id={teacher_id}{' (archived)' if archived else ''}")
     flash("Teacher deleted.")
     return redirect(url_for("manage_teachers"))
 
@@ -344,18 +2654,20 @@ def delete_teacher(teacher_id):
 # -------------------------
 @app.route("/teacher_totals")
 def teacher_totals():
-    teachers = Teacher.query.order_by(Teacher.name.asc()).all()
+    teachers = reference_lists()["teachers"]
     totals = []
+    # One grouped count instead of loading every teacher's sessions and their subjects
+    counts = db.session.query(ClassSession.teacher_id, Subject.name, func.count(ClassSession.id)).join(
+        Subject, ClassSession.subject_id == Subject.id
+    ).group_by(ClassSession.teacher_id, Subject.name).order_by(Subject.name.asc()).all()
+    subject_counts_by_teacher = {}
+    for teacher_id, subj_name, count in counts:
+        subject_counts_by_teacher.setdefault(teacher_id, {})[subj_name] = count
 
     for t in teachers:
-        # Count sessions
-        session_count = len(t.sessions)
-
         # Build subject -> student count mapping
-        subject_counts = {}
-        for s in t.sessions:
-            subj_name = s.subject.name
-            subject_counts[subj_name] = subject_counts.get(subj_name, 0) + 1
+        subject_counts = subject_counts_by_teacher.get(t.id, {})
+        session_count = sum(subject_counts.values())
 
         # Total students = sum of subject counts
         total_students = sum(subject_counts.values())
@@ -371,6 +2683,7 @@ def teacher_totals():
     page = """
     <h5>Teacher Totals</h5>
     <div class="mb-3">
+      <a class="btn btn-sm btn-outline-primary" href="{{ url_for('payroll') }}">Payroll</a>
       <a class="btn btn-sm btn-outline-success" href="{{ url_for('export_teacher_totals', format='csv') }}">Download CSV</a>
       <a class="btn btn-sm btn-outline-success" href="{{ url_for('export_teacher_totals', format='excel') }}">Download Excel</a>
     </div>
@@ -404,6 +2717,56 @@ def teacher_totals():
     </table>
     """
     return render(page, totals=totals)
+
+# -------------------------
+# Payroll (hours taught x per-subject rate)
+# -------------------------
+@app.route("/payroll")
+def payroll():
+    filters = monthly_filters()
+    df = payroll_frame(load_reference_names(), filters)
+    export_args = {"start": filters["start"] and filters["start"].isoformat(),
+                   "end": filters["end"] and filters["end"].isoformat(),
+                   "teacher_id": filters["teacher_id"]}
+    page = """
+    <h5>Payroll</h5>
+    <form method="get" class="row g-2 mb-3">
+      <div class="col-md-3"><input class="form-control" type="date" name="start" value="{{ export_args.start or "" }}"></div>
+      <div class="col-md-3"><input class="form-control" type="date" name="end" value="{{ export_args.end or "" }}"></div>
+      <div class="col-md-3">
+        <select class="form-select" name="teacher_id">
+          <option value="">-- all teachers --</option>
+          {% for t in teachers %}
+            <option value="{{ t.id }}" {% if export_args.teacher_id == t.id %}selected{% endif %}>{{ t.name }}</option>
+          {% endfor %}
+        </select>
+      </div>
+      <div class="col-md-2"><button class="btn btn-primary w-100">View</button></div>
+    </form>
+    <div class="mb-3">
+      <a class="btn btn-sm btn-outline-success" href="{{ url_for('export_payroll', format='csv', **export_args) }}">Download CSV</a>
+      <a class="btn btn-sm btn-outline-success" href="{{ url_for('export_payroll', format='excel', **export_args) }}">Download Excel</a>
+    </div>
+    <p class="text-muted small">Sessions marked {{ unpaid|join(", ") }} are not paid. Rates are set per subject.</p>
+    <table class="table table-sm table-bordered">
+      <thead><tr>{% for col in columns %}<th>{{ col }}</th>{% endfor %}</tr></thead>
+      <tbody>
+        {% for row in rows %}
+          <tr class="{{ 'table-secondary fw-bold' if row.Subject == 'Total' else '' }}">
+            {% for col in columns %}
+              <td>{% if row[col] is none %}{% elif col in ("Rate/Hour", "Pay") %}${{ "%.2f"|format(row[col]) }}{% else %}{{ row[col] }}{% endif %}</td>
+            {% endfor %}
+          </tr>
+        {% else %}
+          <tr><td colspan="{{ columns|length }}">No sessions in this period.</td></tr>
+        {% endfor %}
+      </tbody>
+    </table>
+    """
+    rows = df.astype(object).where(df.notna(), None).to_dict("records")
+    return render(page, rows=rows, columns=list(df.columns), export_args=export_args,
+                  teachers=reference_lists()["teachers"], unpaid=PAYROLL_UNPAID_STATUSES)
+
 # -------------------------
 # Weekly grid timetable (grouped by teacher)
 # -------------------------
@@ -415,7 +2778,7 @@ def weekly_timetable():
     start_week = today - timedelta(days=today.weekday())  # Monday
     end_week = start_week + timedelta(days=7)
 
-    sessions = ClassSession.query.filter(
+    sessions = ClassSession.query.options(*SESSION_NAMES).filter(
         ClassSession.session_date >= start_week,
         ClassSession.session_date < end_week
     ).order_by(ClassSession.session_date.asc(), ClassSession.start_time.asc()).all()
@@ -485,6 +2848,13 @@ def weekly_timetable():
     {% if not teacher_groups %}
       <div class="alert alert-secondary">No sessions scheduled this week.</div>
     {% endif %}
+    <script>
+      // Reload when a change to what is shown here is committed
+      const events = new EventSource({{ live_url|tojson }});
+      let reloadTimer = null;
+      const reloadSoon = () => { clearTimeout(reloadTimer); reloadTimer = setTimeout(() => location.reload(), 1000); };
+      ["session", "attendance", "resync"].forEach(type => events.addEventListener(type, reloadSoon));
+    </script>
 
     <!-- Individual teacher tables -->
     {% for tg in teacher_groups.values() %}
@@ -527,21 +2897,107 @@ def weekly_timetable():
                   start_week=start_week,
                   end_week=end_week,
                   timedelta=timedelta,
-                  combined_slots=combined_slots)
+                  combined_slots=combined_slots,
+                  live_url=url_for("event_stream", start=start_week.isoformat(),
+                                   end=(end_week - timedelta(days=1)).isoformat()))
 
 # -------------------------
 # Logs page
 # -------------------------
+LOG_PAGE_SIZE = 200
+LOG_ARCHIVE_BATCH = 5000
+
+def log_cursor(entry):
+    return f"{entry.timestamp.isoformat()}_{entry.id}"
+
+def parse_log_cursor(value):
+    """(timestamp, id) from a log_cursor string, or None."""
+    try:
+        stamp, entry_id = value.rsplit("_", 1)
+        return datetime.fromisoformat(stamp), int(entry_id)
+    except (ValueError, AttributeError):
+        return None
+
+def archive_logs(days):
+    """Move log entries older than `days` into gzip JSONL files, one per month; returns the number moved.
+
+    Each batch is appended to its archive files before it is deleted, so an
+    interrupted run can only duplicate archived lines, never lose them.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    archive_dir = app.config["LOG_ARCHIVE_DIR"]
+    os.makedirs(archive_dir, exist_ok=True)
+    moved = 0
+    while True:
+        batch = LogEntry.query.filter(LogEntry.timestamp < cutoff).order_by(
+            LogEntry.timestamp.asc(), LogEntry.id.asc()
+        ).limit(LOG_ARCHIVE_BATCH).all()
+        if not batch:
+            return moved
+        by_month = {}
+        for e in batch:
+            by_month.setdefault(e.timestamp.strftime("%Y-%m"), []).append(e)
+        for month, entries in by_month.items():
+            # Appending adds a new gzip member; gzip readers treat the file as one stream
+            with gzip.open(os.path.join(archive_dir, f"logs-{month}.jsonl.gz"), "at", encoding="utf-8") as f:
+                for e in entries:
+                    f.write(json.dumps({"id": e.id, "timestamp": e.timestamp.isoformat(),
+                                        "action": e.action, "details": e.details}) + "\n")
+        LogEntry.query.filter(LogEntry.id.in_([e.id for e in batch])).delete(synchronize_session=False)
+        db.session.commit()
+        moved += len(batch)
+
+def log_archive_files():
+    archive_dir = app.config["LOG_ARCHIVE_DIR"]
+    if not os.path.isdir(archive_dir):
+        return []
+    return sorted((name for name in os.listdir(archive_dir) if name.endswith(".jsonl.gz")), reverse=True)
+
+@app.cli.command("archive-logs")
+@click.option("--days", type=int, default=None, help="Keep this many days in the log table (default LOG_RETENTION_DAYS).")
+def archive_logs_command(days):
+    """Move old log entries into the monthly archive files."""
+    days = app.config["LOG_RETENTION_DAYS"] if days is None else days
+    print(f"Archived {archive_logs(days)} log entries older than {days} days.")
+
 @app.route("/logs")
 def logs():
-    entries = LogEntry.query.order_by(LogEntry.timestamp.desc()).all()
+    filters = export_filters()
+    query = filter_logs(LogEntry.query, filters)
+    filter_args = {k: request.args[k] for k in ("start", "end", "action") if request.args.get(k)}
+    before = request.args.get("before", "")
+    if before:
+        cursor = parse_log_cursor(before)
+        if cursor is None:
+            flash("Invalid page link; showing the newest entries.")
+            return redirect(url_for("logs", **filter_args))
+        # Entries written in one batch share a timestamp, so the id breaks ties
+        ts, last_id = cursor
+        query = query.filter(or_(LogEntry.timestamp < ts, and_(LogEntry.timestamp == ts, LogEntry.id < last_id)))
+    # Newest first, one page at a time, walking the timestamp (or action+timestamp) index; id is its rowid
+    entries = query.order_by(LogEntry.timestamp.desc(), LogEntry.id.desc()).limit(LOG_PAGE_SIZE).all()
+    older = log_cursor(entries[-1]) if len(entries) == LOG_PAGE_SIZE else None
+    actions = [a for (a,) in db.session.query(LogEntry.action).distinct().order_by(LogEntry.action.asc())]
     page = """
     <h5>System Logs</h5>
     <div class="mb-3">
-      <a class="btn btn-sm btn-outline-success" href="{{ url_for('export_logs', format='csv') }}">Download CSV</a>
-      <a class="btn btn-sm btn-outline-success" href="{{ url_for('export_logs', format='excel') }}">Download Excel</a>
-    </div>    <table class="table table-sm table-bordered">
-
+      <a class="btn btn-sm btn-outline-success" href="{{ url_for('export_logs', format='csv', **filter_args) }}">Download CSV</a>
+      <a class="btn btn-sm btn-outline-success" href="{{ url_for('export_logs', format='excel', **filter_args) }}">Download Excel</a>
+    </div>
+    <form method="get" class="row g-2 mb-3">
+      <div class="col-md-3">
+        <select class="form-select" name="action">
+          <option value="">-- all actions --</option>
+          {% for a in actions %}
+            <option value="{{ a }}" {% if filter_args.get('action') == a %}selected{% endif %}>{{ a }}</option>
+          {% endfor %}
+        </select>
+      </div>
+      <div class="col-md-3"><input class="form-control" type="date" name="start" value="{{ filter_args.get('start', '') }}"></div>
+      <div class="col-md-3"><input class="form-control" type="date" name="end" value="{{ filter_args.get('end', '') }}"></div>
+      <div class="col-md-2"><button class="btn btn-primary w-100">Filter</button></div>
+    </form>
+    <table class="table table-sm table-bordered">
       <thead><tr><th>Time</th><th>Action</th><th>Details</th></tr></thead>
       <tbody>
         {% for e in entries %}
@@ -556,8 +3012,37 @@ def logs():
     {% if not entries %}
       <div class="alert alert-secondary">No log entries yet.</div>
     {% endif %}
+    {% if older %}
+      <a class="btn btn-sm btn-outline-secondary mb-3" href="{{ url_for('logs', before=older, **filter_args) }}">Older entries</a>
+    {% endif %}
+
+    <h6 class="mt-4">Archive</h6>
+    <form method="post" action="{{ url_for('archive_logs_now') }}" class="mb-2">
+      <button class="btn btn-sm btn-outline-danger" onclick="return confirm('Archive entries older than {{ retention_days }} days?')">
+        Archive entries older than {{ retention_days }} days
+      </button>
+    </form>
+    <ul>
+      {% for name in archives %}
+        <li><a href="{{ url_for('download_log_archive', name=name) }}">{{ name }}</a></li>
+      {% endfor %}
+    </ul>
     """
-    return render(page, entries=entries)
+    return render(page, entries=entries, older=older, actions=actions, filter_args=filter_args,
+                  archives=log_archive_files(), retention_days=app.config["LOG_RETENTION_DAYS"])
+
+@app.route("/logs/archive", methods=["POST"])
+def archive_logs_now():
+    moved = archive_logs(app.config["LOG_RETENTION_DAYS"])
+    flash(f"Archived {moved} log entries.")
+    return redirect(url_for("logs"))
+
+@app.route("/logs/archive/<name>")
+def download_log_archive(name):
+    if name not in log_archive_files():
+        return "Not found", 404
+    return send_file(os.path.join(app.config["LOG_ARCHIVE_DIR"], name), mimetype="application/gzip",
+                     download_name=name, as_attachment=True)
 
 # -------------------------
 # Student management (profile + subjects)
@@ -565,7 +3050,6 @@ def logs():
 @app.route("/students/<int:student_id>/edit", methods=["GET","POST"])
 def edit_student(student_id):
     student = Student.query.get_or_404(student_id)
-    subjects = Subject.query.order_by(Subject.name.asc()).all()
 
     if request.method == "POST":
         student.name = request.form.get("name","").strip()
@@ -580,18 +3064,23 @@ def edit_student(student_id):
         student.address = request.form.get("address","").strip() or None
 
         # reset subjects
+        enrolled = {subj.id for subj in student.subjects}
         student.subjects = []
         for sid in request.form.getlist("subjects"):
             subj = Subject.query.get(int(sid))
             if subj:
                 student.subjects.append(subj)
+        selected = {subj.id for subj in student.subjects}
+        post_ledger(enrollment_entries(student.id, selected - enrolled, enrolled - selected))
 
         db.session.commit()
         flash("Student updated.")
         return redirect(url_for("manage_students"))
 
     page = """
-<h5>Edit Student</h5>
+<h5>Edit Student
+  <a class="btn btn-sm btn-outline-secondary ms-2" href="{{ url_for('student_timetable', student_id=student.id) }}">Timetable</a>
+</h5>
 <form method="post" class="row g-2 mb-3">
   <div class="col-md-4">
     <label class="form-label">Name</label>
@@ -640,14 +3129,17 @@ def edit_student(student_id):
 
   <div class="col-md-6">
     <label class="form-label">Subjects</label>
-    <select class="form-select" name="subjects" multiple>
-      {% for subj in subjects %}
-        <option value="{{ subj.id }}" {% if subj in student.subjects %}selected{% endif %}>
-          {{ subj.name }} ({{ "%.2f"|format(subj.price) }} / {{ subj.number_of_classes }} classes{% if subj.discount %}, {{ subj.discount }}% off{% endif %})
-        </option>
-      {% endfor %}
-    </select>
-    <div class="form-text">Hold Ctrl/Cmd to select multiple subjects.</div>
+    <div class="typeahead" data-source="{{ url_for('search_subjects') }}" data-multiple>
+      <div class="typeahead-chosen mb-1" data-name="subjects">
+        {% for subj in enrolled %}
+          <span class="badge text-bg-secondary me-1 typeahead-chip">{{ subj.name }} ({{ subj.detail }})
+            <input type="hidden" name="subjects" value="{{ subj.id }}"><button type="button" class="btn-close btn-close-white btn-sm"></button>
+          </span>
+        {% endfor %}
+      </div>
+      <input class="form-control typeahead-input" placeholder="Search subjects to add" autocomplete="off">
+      <div class="list-group typeahead-results"></div>
+    </div>
   </div>
 
   <div class="col-md-2">
@@ -658,12 +3150,13 @@ def edit_student(student_id):
   </div>
 </form>
 """
-    return render(page, student=student, subjects=subjects)
+    enrolled = [{"id": subj.id, "name": subj.name,
+                 "detail": subject_detail(subj.price, subj.number_of_classes, subj.discount)}
+                for subj in sorted(student.subjects, key=lambda subj: subj.name)]
+    return render(page, student=student, enrolled=enrolled)
 
 @app.route("/students", methods=["GET","POST"])
 def manage_students():
-    subjects = Subject.query.order_by(Subject.name.asc()).all()
-
     if request.method == "POST":
         # --- Add new student logic ---
         name = request.form.get("name", "").strip()
@@ -701,6 +3194,8 @@ def manage_students():
                     new_student.subjects.append(subj)
 
             db.session.add(new_student)
+            db.session.flush()
+            post_ledger(enrollment_entries(new_student.id, {subj.id for subj in new_student.subjects}, set()))
             db.session.commit()
             log_action("add_student", f"Added student {name}")
             flash("Student added.")
@@ -720,6 +3215,29 @@ def manage_students():
             student_subject_rows.append((s, None))
 
     page = """
+    <div class="mb-3">
+      <input class="form-control" id="contactSearch" placeholder="Find student by name, ID, phone, contact or address">
+      <div id="contactResults" class="list-group"></div>
+    </div>
+    <script>
+      document.getElementById("contactSearch").addEventListener("input", async function() {
+        const results = document.getElementById("contactResults");
+        const q = this.value;
+        if (q.length === 0) { results.innerHTML = ""; return; }
+        const res = await fetch(`/search_student_contacts?q=${encodeURIComponent(q)}`);
+        const data = await res.json();
+        results.innerHTML = "";
+        data.results.forEach(st => {
+          const item = document.createElement("a");
+          item.className = "list-group-item list-group-item-action";
+          item.href = `/students/${st.id}/edit`;
+          // Server escapes field values; only <mark> tags are markup
+          item.innerHTML = st.name + Object.entries(st.matches).map(([k, v]) => ` <small class="text-muted">${k}: ${v}</small>`).join("");
+          results.appendChild(item);
+        });
+      });
+    </script>
+
     <h5>Total Student-Subject Enrollments: {{ student_subject_rows|length }}</h5>
 
     <h6>Subject Breakdown</h6>
@@ -742,11 +3260,11 @@ def manage_students():
       <div class="col-md-6"><label class="form-label">Address</label><input class="form-control" name="address" placeholder="Address"></div>
       <div class="col-md-6">
         <label class="form-label">Subjects</label>
-        <select class="form-select" name="subjects" multiple>
-          {% for subj in subjects %}
-            <option value="{{ subj.id }}">{{ subj.name }} ({{ "%.2f"|format(subj.price) }} / {{ subj.number_of_classes }} classes{% if subj.discount %}, {{ subj.discount }}% off{% endif %})</option>
-          {% endfor %}
-        </select>
+        <div class="typeahead" data-source="{{ url_for('search_subjects') }}" data-multiple>
+          <div class="typeahead-chosen mb-1" data-name="subjects"></div>
+          <input class="form-control typeahead-input" placeholder="Search subjects to add" autocomplete="off">
+          <div class="list-group typeahead-results"></div>
+        </div>
       </div>
       <div class="col-md-2"><button class="btn btn-primary w-100">Add</button></div>
     </form>
@@ -763,7 +3281,7 @@ def manage_students():
           <th>Contact2</th>
           <th>Address</th>
           <th>Subject</th>
-          <th style="width:160px">Actions</th>
+          <th style="width:240px">Actions</th>
         </tr>
       </thead>
       <tbody>
@@ -780,6 +3298,7 @@ def manage_students():
             <td>{{ subj.name if subj else "" }}</td>
             <td>
               <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('edit_student', student_id=s.id) }}">Edit</a>
+              <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('student_timetable', student_id=s.id) }}">Timetable</a>
               <a class="btn btn-sm btn-outline-danger"
                  href="{{ url_for('delete_student', student_id=s.id) }}"
                  onclick="return confirm('Delete student and their sessions?')">Delete</a>
@@ -792,15 +3311,13 @@ def manage_students():
 
     return render(page,
                   student_subject_rows=student_subject_rows,
-                  subject_counts=subject_counts,
-                  subjects=subjects)
+                  subject_counts=subject_counts)
 @app.route("/students/<int:student_id>/delete")
 def delete_student(student_id):
-    s = Student.query.get_or_404(student_id)
-    ClassSession.query.filter_by(student_id=student_id).delete()
-    db.session.delete(s)
+    Student.query.get_or_404(student_id)
+    archived = delete_with_dependents(Student, student_id)
     db.session.commit()
-    log_action("delete_student", f"Deleted student id={student_id}")
+    log_action("delete_student", f"Deleted student id={student_id}{' (archived)' if archived else ''}")
     flash("Student deleted.")
     return redirect(url_for("manage_students"))
 
@@ -815,18 +3332,23 @@ def manage_subjects():
         price = request.form.get("price", type=float)
         num_classes = request.form.get("number_of_classes", type=int)
         discount = request.form.get("discount", type=float)
+        rate = request.form.get("teacher_rate", "").strip()
+        rate_amount = parse_money(rate or "0")
         if not name or price is None or num_classes is None:
             flash("Subject name, price, and number of classes are required.")
+        elif rate_amount is None or rate_amount < 0:
+            flash("Teacher pay must be a number of zero or more.")
         elif Subject.query.filter_by(name=name).first():
             flash("Subject already exists.")
         else:
-            db.session.add(Subject(name=name, price=price, number_of_classes=num_classes, discount=discount or 0.0))
+            db.session.add(Subject(name=name, price=price, number_of_classes=num_classes, discount=discount or 0.0,
+                                   teacher_rate_cents=to_cents(rate_amount)))
             db.session.commit()
             log_action("add_subject", f"Added subject {name} price={price}, classes={num_classes}, discount={discount or 0}")
             flash("Subject added.")
         return redirect(url_for("manage_subjects"))
 
-    subjects = Subject.query.order_by(Subject.name.asc()).all()
+    subjects = reference_lists()["subjects"]
     page = """
     <h5>Subjects</h5>
     <form method="post" class="row g-2 mb-3">
@@ -834,10 +3356,11 @@ def manage_subjects():
       <div class="col-md-2"><input class="form-control" name="price" type="number" step="0.01" placeholder="Price"></div>
       <div class="col-md-2"><input class="form-control" name="number_of_classes" type="number" placeholder="Classes"></div>
       <div class="col-md-2"><input class="form-control" name="discount" type="number" step="0.01" placeholder="Discount %"></div>
-      <div class="col-md-2"><button class="btn btn-primary w-100">Add</button></div>
+      <div class="col-md-2"><input class="form-control" name="teacher_rate" type="number" step="0.01" placeholder="Teacher pay / hour"></div>
+      <div class="col-md-1"><button class="btn btn-primary w-100">Add</button></div>
     </form>
     <table class="table table-sm table-bordered">
-      <thead><tr><th>Name</th><th>Price</th><th>Classes</th><th>Discount</th><th style="width:120px">Actions</th></tr></thead>
+      <thead><tr><th>Name</th><th>Price</th><th>Classes</th><th>Discount</th><th>Teacher pay / hour</th><th style="width:120px">Actions</th></tr></thead>
       <tbody>
         {% for subj in subjects %}
           <tr>
@@ -845,6 +3368,7 @@ def manage_subjects():
             <td>${{ "%.2f"|format(subj.price) }}</td>
             <td>{{ subj.number_of_classes }}</td>
             <td>{{ subj.discount }}%</td>
+            <td>${{ money(subj.teacher_rate_cents) }}</td>
             <td>
               <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('edit_subject', subject_id=subj.id) }}">Edit</a>
               <a class="btn btn-sm btn-outline-danger" href="{{ url_for('delete_subject', subject_id=subj.id) }}" onclick="return confirm('Delete subject and their sessions?')">Delete</a>
@@ -854,15 +3378,14 @@ def manage_subjects():
       </tbody>
     </table>
     """
-    return render(page, subjects=subjects)
+    return render(page, subjects=subjects, money=format_cents)
 
 @app.route("/subjects/<int:subject_id>/delete")
 def delete_subject(subject_id):
-    subj = Subject.query.get_or_404(subject_id)
-    ClassSession.query.filter_by(subject_id=subject_id).delete()
-    db.session.delete(subj)
+    Subject.query.get_or_404(subject_id)
+    archived = delete_with_dependents(Subject, subject_id)
     db.session.commit()
-    log_action("delete_subject", f"Deleted subject id={subject_id}")
+    log_action("delete_subject", f"Deleted subject id={subject_id}{' (archived)' if archived else ''}")
     flash("Subject deleted.")
     return redirect(url_for("manage_subjects"))
 
@@ -877,14 +3400,19 @@ def edit_subject(subject_id):
         price = request.form.get("price", type=float)
         num_classes = request.form.get("number_of_classes", type=int)
         discount = request.form.get("discount", type=float)
+        rate = request.form.get("teacher_rate", "").strip()
+        rate_amount = parse_money(rate or "0")
 
         if not name or price is None or num_classes is None:
             flash("Subject name, price, and number of classes are required.")
+        elif rate_amount is None or rate_amount < 0:
+            flash("Teacher pay must be a number of zero or more.")
         else:
             subj.name = name
             subj.price = price
             subj.number_of_classes = num_classes
             subj.discount = discount or 0.0
+            subj.teacher_rate_cents = to_cents(rate_amount)
             db.session.commit()
             log_action("edit_subject", f"Edited subject {name}")
             flash("Subject updated.")
@@ -897,11 +3425,12 @@ def edit_subject(subject_id):
       <div class="col-md-2"><input class="form-control" name="price" type="number" step="0.01" value="{{ subj.price }}"></div>
       <div class="col-md-2"><input class="form-control" name="number_of_classes" type="number" value="{{ subj.number_of_classes }}"></div>
       <div class="col-md-2"><input class="form-control" name="discount" type="number" step="0.01" value="{{ subj.discount }}"></div>
-      <div class="col-md-2"><button class="btn btn-success w-100">Save</button></div>
+      <div class="col-md-2"><input class="form-control" name="teacher_rate" type="number" step="0.01" value="{{ money(subj.teacher_rate_cents) }}" placeholder="Teacher pay / hour"></div>
+      <div class="col-md-1"><button class="btn btn-success w-100">Save</button></div>
       <div class="col-md-2"><a class="btn btn-outline-secondary w-100" href="{{ url_for('manage_subjects') }}">Cancel</a></div>
     </form>
     """
-    return render(page, subj=subj)
+    return render(page, subj=subj, money=format_cents)
 
     page = """
     <h5>Edit Subject</h5>
@@ -919,9 +3448,8 @@ def edit_subject(subject_id):
 # -------------------------
 @app.route("/sessions/add", methods=["GET","POST"])
 def add_session():
-    teachers = Teacher.query.order_by(Teacher.name.asc()).all()
-    students = Student.query.order_by(Student.name.asc()).all()
-    subjects = Subject.query.order_by(Subject.name.asc()).all()
+    refs = reference_lists()
+    teachers, subjects = refs["teachers"], refs["subjects"]
 
     if request.method == "POST":
         teacher_id = request.form.get("teacher_id", type=int)
@@ -959,7 +3487,7 @@ def add_session():
     <form method="post" class="row g-3">
       <div class="col-md-4">
         <label class="form-label">Teacher</label>
-        <select class="form-select" name="teacher_id" required>
+        <select class="form-select" id="teacherSelect" name="teacher_id" required>
           <option value="">-- choose --</option>
           {% for t in teachers %}
             <option value="{{ t.id }}">{{ t.name }}</option>
@@ -986,17 +3514,22 @@ def add_session():
 
       <div class="col-md-4">
         <label class="form-label">Date</label>
-        <input class="form-control" type="date" name="session_date" required>
+        <input class="form-control" type="date" id="sessionDate" name="session_date" required>
       </div>
 
       <div class="col-md-4">
         <label class="form-label">Start time</label>
-        <input class="form-control" type="time" name="start_time" required>
+        <input class="form-control" type="time" id="startTime" name="start_time" required>
       </div>
 
       <div class="col-md-4">
         <label class="form-label">End time</label>
-        <input class="form-control" type="time" name="end_time" required>
+        <input class="form-control" type="time" id="endTime" name="end_time" required>
+      </div>
+
+      <div class="col-12">
+        <label class="form-label">Free for both (click to use)</label>
+        <div id="freeSlots" class="d-flex flex-wrap gap-1 small text-muted">Choose a teacher and a student.</div>
       </div>
 
       <div class="col-12">
@@ -1027,6 +3560,7 @@ def add_session():
               document.getElementById("studentSearch").value = st.name;
               document.getElementById("studentId").value = st.id;
               suggestions.innerHTML = "";
+              refreshFreeSlots();
             };
             suggestions.appendChild(item);
           });
@@ -1034,15 +3568,55 @@ def add_session():
           document.getElementById("studentSuggestions").innerHTML = "";
         }
       });
+
+      // Suggest common free windows for the two weeks from the chosen date
+      let freeSlotsRequest = 0;
+      async function refreshFreeSlots() {
+        const teacherId = document.getElementById("teacherSelect").value;
+        const studentId = document.getElementById("studentId").value;
+        const box = document.getElementById("freeSlots");
+        if (!teacherId || !studentId) { box.textContent = "Choose a teacher and a student."; return; }
+        const start = document.getElementById("startTime").value;
+        const end = document.getElementById("endTime").value;
+        let duration = 60;
+        if (start && end && end > start) {
+          const [sh, sm] = start.split(":").map(Number), [eh, em] = end.split(":").map(Number);
+          duration = (eh * 60 + em) - (sh * 60 + sm);
+        }
+        const day = document.getElementById("sessionDate").value;
+        const params = new URLSearchParams({teacher_id: teacherId, student_id: studentId, duration: duration});
+        if (day) { params.set("start", day); }
+        const request = ++freeSlotsRequest;
+        const res = await fetch(`/free_slots?${params}`);
+        const data = await res.json();
+        if (request !== freeSlotsRequest) { return; }  // a newer request is in flight
+        box.innerHTML = "";
+        if (!data.slots || data.slots.length === 0) { box.textContent = "No common free time in range."; return; }
+        data.slots.slice(0, 30).forEach(slot => {
+          const item = document.createElement("button");
+          item.type = "button";
+          item.className = "btn btn-sm btn-outline-success";
+          item.textContent = `${slot.date} ${slot.start}-${slot.end}`;
+          item.onclick = () => {
+            document.getElementById("sessionDate").value = slot.date;
+            document.getElementById("startTime").value = slot.start;
+            const [h, mi] = slot.start.split(":").map(Number), total = h * 60 + mi + data.duration;
+            document.getElementById("endTime").value = `${String(Math.floor(total / 60)).padStart(2, "0")}:${String(total % 60).padStart(2, "0")}`;
+          };
+          box.appendChild(item);
+        });
+      }
+      ["teacherSelect", "sessionDate", "startTime", "endTime"].forEach(id =>
+        document.getElementById(id).addEventListener("change", refreshFreeSlots));
     </script>
     """
-    return render(page, teachers=teachers, students=students, subjects=subjects)
+    return render(page, teachers=teachers, subjects=subjects)
 
 @app.route("/sessions/<int:session_id>/edit", methods=["GET","POST"])
 def edit_session(session_id):
     s = ClassSession.query.get_or_404(session_id)
-    teachers = Teacher.query.order_by(Teacher.name.asc()).all()
-    subjects = Subject.query.order_by(Subject.name.asc()).all()
+    refs = reference_lists()
+    teachers, subjects = refs["teachers"], refs["subjects"]
 
     if request.method == "POST":
         teacher_id = request.form.get("teacher_id", type=int)
@@ -1060,13 +3634,14 @@ def edit_session(session_id):
             flash("End time must be after start time.")
             return redirect(url_for("edit_session", session_id=session_id))
 
-        s.teacher_id = teacher_id
-        s.student_id = student_id
-        s.subject_id = subject_id
-        s.session_date = session_date
-        s.start_time = start_time
-        s.end_time = end_time
-        s.notes = notes or None
+        with attendance_stats_tracking([session_id]):
+            s.teacher_id = teacher_id
+            s.student_id = student_id
+            s.subject_id = subject_id
+            s.session_date = session_date
+            s.start_time = start_time
+            s.end_time = end_time
+            s.notes = notes or None
         db.session.commit()
         log_action("edit_session", f"Edited session id={session_id}")
         flash("Session updated.")
@@ -1157,6 +3732,9 @@ def edit_session(session_id):
 @app.route("/sessions/<int:session_id>/delete")
 def delete_session(session_id):
     s = ClassSession.query.get_or_404(session_id)
+    adjust_attendance_stats([session_id], -1)
+    record_attendance_changes("delete", Attendance.session_id == session_id)
+    Attendance.query.filter_by(session_id=session_id).delete()
     db.session.delete(s)
     db.session.commit()
     log_action("delete_session", f"Deleted session id={session_id}")
@@ -1166,27 +3744,253 @@ def delete_session(session_id):
 # -------------------------
 # Attendance tracking
 # -------------------------
+ATTENDANCE_STATUSES = ["Arrived", "Late", "Absent", "Vacation"]
+PACKAGE_USED_STATUSES = ("Arrived", "Late")  # marks that use up a class from the package
+
+def upsert_attendance(marks):
+    """Write (session_id, student_id, status) marks in one INSERT .. ON CONFLICT statement; the caller commits."""
+    if not marks:
+        return
+    now = datetime.utcnow()
+    stmt = sqlite_insert(Attendance).values([
+        {"session_id": session_id, "student_id": student_id, "status": status, "timestamp": now}
+        for session_id, student_id, status in marks
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["session_id", "student_id"],
+        set_={"status": stmt.excluded.status, "timestamp": stmt.excluded.timestamp}
+    )
+    session_ids = {session_id for session_id, _, _ in marks}
+    with attendance_stats_tracking(session_ids):
+        db.session.execute(stmt)
+    record_attendance_changes("update", Attendance.session_id.in_(session_ids))
+
+def _attendance_stat_rows(session_ids=None):
+    """Grouped (student, teacher, subject, month, status, count) rows for the given sessions (all when None)."""
+    month = func.strftime("%Y-%m", ClassSession.session_date)
+    query = db.session.query(
+        Attendance.student_id, ClassSession.teacher_id, ClassSession.subject_id,
+        month, Attendance.status, func.count(Attendance.id)
+    ).join(ClassSession, Attendance.session_id == ClassSession.id)
+    if session_ids is not None:
+        query = query.filter(Attendance.session_id.in_(list(session_ids)))
+    return query.group_by(
+        Attendance.student_id, ClassSession.teacher_id, ClassSession.subject_id, month, Attendance.status
+    ).all()
+
+def _package_usage_counts(stat_rows):
+    """Fold stat rows into {(student_id, subject_id): classes used}."""
+    used = {}
+    for st, t, subj, m, status, n in stat_rows:
+        if status in PACKAGE_USED_STATUSES:
+            used[(st, subj)] = used.get((st, subj), 0) + n
+    return used
+
+def refresh_attendance_streaks(student_ids=None, leaving=()):
+    """Recompute the AttendanceStreak rows of the given students (all when None) from their marks.
+
+    Marks of the `leaving` sessions are left out, for callers about to delete
+    or change them. Uses the (student_id, status) index, so the cost follows
+    the students touched rather than the whole Attendance table.
+    """
+    criteria = [Attendance.session_id.notin_(list(leaving))] if leaving else []
+    if student_ids is not None:
+        student_ids = list(student_ids)
+        criteria.append(Attendance.student_id.in_(student_ids))
+        AttendanceStreak.query.filter(AttendanceStreak.student_id.in_(student_ids)).delete()
+    else:
+        AttendanceStreak.query.delete()
+    # Every marked student, with the date of their latest absence (NULL if never absent)
+    marked = db.session.query(
+        Attendance.student_id.label("student_id"),
+        func.max(case((Attendance.status == "Absent", ClassSession.session_date))).label("last_absent")
+    ).join(ClassSession, Attendance.session_id == ClassSession.id).filter(*criteria).group_by(
+        Attendance.student_id
+    ).subquery()
+    last_absent = dict(db.session.query(marked.c.student_id, marked.c.last_absent).all())
+    if not last_absent:
+        return
+    streaks = dict(db.session.query(Attendance.student_id, func.count(Attendance.id)).join(
+        ClassSession, Attendance.session_id == ClassSession.id
+    ).join(marked, marked.c.student_id == Attendance.student_id).filter(
+        Attendance.status.in_(["Arrived", "Late"]), *criteria,
+        or_(marked.c.last_absent.is_(None), ClassSession.session_date > marked.c.last_absent)
+    ).group_by(Attendance.student_id).all())
+    db.session.execute(AttendanceStreak.__table__.insert(), [
+        {"student_id": st, "last_absent": absent, "streak": streaks.get(st, 0)} for st, absent in last_absent.items()
+    ])
+
+def adjust_attendance_stats(session_ids, sign):
+    """Add (sign=1) or remove (sign=-1) the current marks of the given sessions from the attendance summaries.
+
+    AttendanceStat and PackageUsage move by the marks' counts; the marked
+    students' AttendanceStreak rows are recomputed, without these sessions
+    when removing.
+    """
+    if not session_ids:
+        return
+    rows = _attendance_stat_rows(session_ids)
+    if not rows:
+        return
+    stmt = sqlite_insert(AttendanceStat).values([
+        {"student_id": st, "teacher_id": t, "subject_id": subj, "month": m, "status": status, "count": sign * n}
+        for st, t, subj, m, status, n in rows
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["student_id", "teacher_id", "subject_id", "month", "status"],
+        set_={"count": AttendanceStat.count + stmt.excluded.count}
+    )
+    db.session.execute(stmt)
+    used = _package_usage_counts(rows)
+    if used:
+        stmt = sqlite_insert(PackageUsage).values([
+            {"student_id": st, "subject_id": subj, "used": sign * n} for (st, subj), n in used.items()
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["student_id", "subject_id"], set_={"used": PackageUsage.used + stmt.excluded.used}
+        )
+        db.session.execute(stmt)
+    refresh_attendance_streaks({row[0] for row in rows}, session_ids if sign < 0 else ())
+
+@contextmanager
+def attendance_stats_tracking(session_ids):
+    """Move the given sessions' marks out of the summary, run the block, then count them back in."""
+    session_ids = set(session_ids)
+    adjust_attendance_stats(session_ids, -1)
+    yield
+    db.session.flush()
+    adjust_attendance_stats(session_ids, 1)
+
+def rebuild_attendance_stats():
+    """Recompute the whole attendance summary, package usage and streaks from the Attendance table."""
+    AttendanceStat.query.delete()
+    PackageUsage.query.delete()
+    refresh_attendance_streaks()
+    rows = _attendance_stat_rows()
+    if rows:
+        db.session.execute(AttendanceStat.__table__.insert(), [
+            {"student_id": st, "teacher_id": t, "subject_id": subj, "month": m, "status": status, "count": n}
+            for st, t, subj, m, status, n in rows
+        ])
+        used = _package_usage_counts(rows)
+        if used:
+            db.session.execute(PackageUsage.__table__.insert(), [
+                {"student_id": st, "subject_id": subj, "used": n} for (st, subj), n in used.items()
+            ])
+    db.session.commit()
+
+@app.cli.command("rebuild-attendance-stats")
+def rebuild_attendance_stats_command():
+    """Recompute the attendance summary, package usage and streak tables."""
+    rebuild_attendance_stats()
+    print("Attendance statistics rebuilt.")
+
 @app.route("/attendance/<int:session_id>/<int:student_id>/<status>")
 def mark_attendance(session_id, student_id, status):
     s = ClassSession.query.get_or_404(session_id)
     st = Student.query.get_or_404(student_id)
-    valid_status = ["Arrived", "Late", "Absent", "Vacation"]
-    if status not in valid_status:
+    if status not in ATTENDANCE_STATUSES:
         flash("Invalid attendance status.")
         return redirect(url_for("home"))
 
-    record = Attendance(session_id=session_id, student_id=student_id, status=status)
-    db.session.add(record)
+    upsert_attendance([(session_id, student_id, status)])
+    log_action("attendance", f"Marked {status} for student {st.name} in session {session_id}", commit=False)
     db.session.commit()
-    log_action("attendance", f"Marked {status} for student {st.name} in session {session_id}")
     flash(f"Attendance marked: {st.name} - {status}")
     return redirect(url_for("home", teacher_id=s.teacher_id))
 
+@app.route("/attendance/register", methods=["GET","POST"])
+def attendance_register():
+    day = parse_date(request.args.get("date", "")) or date.today()
+    teacher_id = request.args.get("teacher_id", type=int)
+    query = ClassSession.query.options(*SESSION_NAMES).filter(ClassSession.session_date == day)
+    if teacher_id:
+        query = query.filter(ClassSession.teacher_id == teacher_id)
+    sessions = query.order_by(ClassSession.start_time.asc(), ClassSession.teacher_id.asc()).all()
+
+    if request.method == "POST":
+        marks = []
+        for s in sessions:
+            status = request.form.get(f"status_{s.id}", "")
+            if status in ATTENDANCE_STATUSES:
+                marks.append((s.id, s.student_id, status))
+        if marks:
+            upsert_attendance(marks)
+            log_action("attendance_register", f"Marked {len(marks)} sessions on {day}"
+                       + (f" for teacher={teacher_id}" if teacher_id else ""), commit=False)
+            db.session.commit()
+            flash(f"Register saved: {len(marks)} sessions marked.")
+        else:
+            flash("No attendance statuses were selected.")
+        return redirect(url_for("attendance_register", date=day.isoformat(), teacher_id=teacher_id))
+
+    current = {}
+    if sessions:
+        current = dict(db.session.query(Attendance.session_id, Attendance.status).filter(
+            Attendance.session_id.in_([s.id for s in sessions])
+        ).all())
+    teachers = reference_lists()["teachers"]
+    page = """
+    <h5>Attendance Register</h5>
+    <form method="get" class="row g-2 mb-3">
+      <div class="col-md-3"><input class="form-control" type="date" name="date" value="{{ day.isoformat() }}"></div>
+      <div class="col-md-4">
+        <select class="form-select" name="teacher_id">
+          <option value="">-- all teachers --</option>
+          {% for t in teachers %}
+            <option value="{{ t.id }}" {% if teacher_id == t.id %}selected{% endif %}>{{ t.name }}</option>
+          {% endfor %}
+        </select>
+      </div>
+      <div class="col-md-2"><button class="btn btn-primary w-100">View</button></div>
+    </form>
+    {% if sessions %}
+      <form method="post">
+        <table class="table table-sm table-bordered">
+          <thead>
+            <tr>
+              <th class="timecell">Time</th><th>Teacher</th><th>Student</th><th>Subject</th>
+              {% for st in statuses %}<th class="text-center">{{ st }}</th>{% endfor %}
+            </tr>
+          </thead>
+          <tbody>
+            {% for s in sessions %}
+              <tr>
+                <td class="timecell">{{ s.start_time.strftime("%H:%M") }}-{{ s.end_time.strftime("%H:%M") }}</td>
+                <td>{{ s.teacher.name }}</td>
+                <td>{{ s.student.name }}</td>
+                <td>{{ s.subject.name }}</td>
+                {% for st in statuses %}
+                  <td class="text-center">
+                    <input class="form-check-input" type="radio" name="status_{{ s.id }}" value="{{ st }}"
+                           {% if current.get(s.id) == st %}checked{% endif %}>
+                  </td>
+                {% endfor %}
+              </tr>
+            {% endfor %}
+          </tbody>
+        </table>
+        <button class="btn btn-success">Save register</button>
+      </form>
+    {% else %}
+      <div class="alert alert-secondary">No sessions on this day.</div>
+    {% endif %}
+    """
+    return render(page, day=day, teacher_id=teacher_id, teachers=teachers, sessions=sessions,
+                  current=current, statuses=ATTENDANCE_STATUSES)
+
 @app.route("/attendance")
 def attendance_overview():
-    records = Attendance.query.order_by(Attendance.timestamp.desc()).all()
+    records = Attendance.query.options(joinedload(Attendance.student), joinedload(Attendance.session)).order_by(
+        Attendance.timestamp.desc()
+    ).all()
     page = """
     <h5>Attendance Records</h5>
+    <div class="mb-3">
+      <a class="btn btn-sm btn-outline-primary" href="{{ url_for('attendance_register') }}">Register</a>
+      <a class="btn btn-sm btn-outline-primary" href="{{ url_for('attendance_stats') }}">Statistics</a>
+      <a class="btn btn-sm btn-outline-primary" href="{{ url_for('package_report') }}">Packages running out</a>
+    </div>
     <table class="table table-sm table-bordered">
       <thead><tr><th>Timestamp</th><th>Student</th><th>Session</th><th>Status</th></tr></thead>
       <tbody>
@@ -1203,66 +4007,309 @@ def attendance_overview():
     """
     return render(page, records=records)
 
+@app.route("/attendance/stats")
+def attendance_stats():
+    group = request.args.get("group", "student")
+    if group not in ("student", "teacher", "subject"):
+        group = "student"
+    this_month = date.today().strftime("%Y-%m")
+    year_ago = (month_bounds(date.today())[0] - timedelta(days=335)).strftime("%Y-%m")
+    start = request.args.get("start", "") or year_ago
+    end = request.args.get("end", "") or this_month
+
+    # Sum the monthly summary rows and read streaks from AttendanceStreak; Attendance itself is not scanned
+    key = getattr(AttendanceStat, f"{group}_id")
+    counts = [func.sum(case((AttendanceStat.status == st, AttendanceStat.count), else_=0)) for st in ATTENDANCE_STATUSES]
+    rows = db.session.query(key, *counts).filter(
+        AttendanceStat.month >= start, AttendanceStat.month <= end
+    ).group_by(key).all()
+
+    model = {"student": Student, "teacher": Teacher, "subject": Subject}[group]
+    names = dict(db.session.query(model.id, model.name).filter(model.id.in_([r[0] for r in rows])).all()) if rows else {}
+
+    # A streak is as of today, so it is only shown for periods that run up to this month
+    current = end >= this_month
+    streaks = {}
+    if group == "student" and rows and current:
+        streaks = dict(db.session.query(AttendanceStreak.student_id, AttendanceStreak.streak).filter(
+            AttendanceStreak.student_id.in_(list(names))
+        ).all())
+
+    stats = []
+    for row in rows:
+        arrived, late, absent, vacation = (int(n or 0) for n in row[1:])
+        expected = arrived + late + absent
+        stats.append({
+            "name": names.get(row[0], f"#{row[0]}"),
+            "arrived": arrived, "late": late, "absent": absent, "vacation": vacation,
+            "attendance_rate": (arrived + late) / expected * 100 if expected else None,
+            "late_rate": late / (arrived + late) * 100 if arrived + late else None,
+            "streak": streaks.get(row[0], 0) if current else None,
+        })
+    stats.sort(key=lambda r: r["name"])
+
+    page = """
+    <h5>Attendance Statistics</h5>
+    <form method="get" class="row g-2 mb-3">
+      <div class="col-md-3">
+        <select class="form-select" name="group">
+          {% for g in ["student", "teacher", "subject"] %}
+            <option value="{{ g }}" {% if g == group %}selected{% endif %}>Per {{ g }}</option>
+          {% endfor %}
+        </select>
+      </div>
+      <div class="col-md-3"><input class="form-control" type="month" name="start" value="{{ start }}"></div>
+      <div class="col-md-3"><input class="form-control" type="month" name="end" value="{{ end }}"></div>
+      <div class="col-md-2"><button class="btn btn-primary w-100">View</button></div>
+    </form>
+    <table class="table table-sm table-bordered">
+      <thead>
+        <tr>
+          <th>{{ group|capitalize }}</th><th>Arrived</th><th>Late</th><th>Absent</th><th>Vacation</th>
+          <th>Attendance %</th><th>Late %</th>{% if group == "student" %}<th>Current streak</th>{% endif %}
+        </tr>
+      </thead>
+      <tbody>
+        {% for r in stats %}
+          <tr>
+            <td>{{ r.name }}</td><td>{{ r.arrived }}</td><td>{{ r.late }}</td><td>{{ r.absent }}</td><td>{{ r.vacation }}</td>
+            <td>{{ "%.1f"|format(r.attendance_rate) if r.attendance_rate is not none else "-" }}</td>
+            <td>{{ "%.1f"|format(r.late_rate) if r.late_rate is not none else "-" }}</td>
+            {% if group == "student" %}<td>{{ r.streak if r.streak is not none else "-" }}</td>{% endif %}
+          </tr>
+        {% endfor %}
+      </tbody>
+    </table>
+    {% if not stats %}
+      <div class="alert alert-secondary">No attendance marked in this period.</div>
+    {% endif %}
+    """
+    return render(page, stats=stats, group=group, start=start, end=end)
+
+@app.route("/packages")
+def package_report():
+    """Enrolled students with few classes left in what they have bought, read from the usage and balance counters.
+
+    Renewing means paying for another package, so the classes bought are
+    number_of_classes for every full package paid, and at least the one
+    charged on enrolment.
+    """
+    threshold = request.args.get("remaining", 2, type=int)
+    used = func.coalesce(PackageUsage.used, 0)
+    # package_cents in SQL: price after discount, rounded to whole cents
+    package = db.cast(func.round(Subject.price * (100 - func.coalesce(Subject.discount, 0))), db.Integer)
+    packages = func.max(1, case((package > 0, func.coalesce(Balance.paid_cents, 0) // package), else_=1))
+    bought = Subject.number_of_classes * packages
+    remaining = bought - used
+    rows = db.session.query(
+        Student.id, Student.name, Subject.name, bought, used, remaining,
+        func.coalesce(Balance.balance_cents, 0)
+    ).select_from(student_subjects).join(
+        Student, Student.id == student_subjects.c.student_id
+    ).join(Subject, Subject.id == student_subjects.c.subject_id).outerjoin(
+        PackageUsage, (PackageUsage.student_id == student_subjects.c.student_id) &
+                      (PackageUsage.subject_id == student_subjects.c.subject_id)
+    ).outerjoin(
+        Balance, (Balance.student_id == student_subjects.c.student_id) &
+                 (Balance.subject_id == student_subjects.c.subject_id)
+    ).filter(remaining <= threshold).order_by(remaining.asc(), Student.name.asc()).all()
+    page = """
+    <h5>Packages Running Out</h5>
+    <form method="get" class="row g-2 mb-3">
+      <div class="col-md-3">
+        <div class="input-group">
+          <span class="input-group-text">Classes left &le;</span>
+          <input class="form-control" type="number" name="remaining" value="{{ threshold }}">
+        </div>
+      </div>
+      <div class="col-md-2"><button class="btn btn-primary w-100">View</button></div>
+    </form>
+    <table class="table table-sm table-bordered">
+      <thead><tr><th>Student</th><th>Subject</th><th>Bought</th><th>Used</th><th>Left</th><th>Outstanding</th></tr></thead>
+      <tbody>
+        {% for student_id, student, subject, classes, used, left, balance in rows %}
+          <tr class="{{ 'table-danger' if left <= 0 else 'table-warning' if left == 1 else '' }}">
+            <td><a href="{{ url_for('student_timetable', student_id=student_id) }}">{{ student }}</a></td>
+            <td>{{ subject }}</td>
+            <td>{{ classes }}</td>
+            <td>{{ used }}</td>
+            <td>{{ left }}</td>
+            <td>{% if balance > 0 %}${{ money(balance) }}{% endif %}</td>
+          </tr>
+        {% else %}
+          <tr><td colspan="6">No packages at or below {{ threshold }} classes left.</td></tr>
+        {% endfor %}
+      </tbody>
+    </table>
+    """
+    return render(page, rows=rows, threshold=threshold, money=format_cents)
+
+# -------------------------
+# Payment ledger (integer cents)
+# -------------------------
+def to_cents(amount):
+    """Decimal money (number or string) to integer cents, rounding half up."""
+    return int((Decimal(str(amount)) * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+MONEY_LIMIT = Decimal("1000000000")  # far below what the integer-cent columns and their sums can hold
+
+def parse_money(raw):
+    """Form text to a Decimal amount, or None when it isn't a finite one within MONEY_LIMIT ("abc", "nan", "1e30")."""
+    try:
+        amount = Decimal((raw or "").strip())
+    except ArithmeticError:  # InvalidOperation
+        return None
+    return amount if amount.is_finite() and amount.copy_abs() < MONEY_LIMIT else None
+
+def format_cents(cents):
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
+def package_cents(price, discount):
+    """A subject package's price after its percentage discount, in cents."""
+    net = Decimal(str(price)) * (100 - Decimal(str(discount or 0)))
+    return int(net.quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+def post_ledger(entries):
+    """Append ledger entries and move the affected balances, all in the caller's transaction.
+
+    entries: dicts of student_id, subject_id, kind, amount_cents and optionally payment_id and note.
+    """
+    if not entries:
+        return
+    now = datetime.utcnow()
+    db.session.execute(LedgerEntry.__table__.insert(), [
+        {"payment_id": None, "note": None, "created_at": now, **entry} for entry in entries
+    ])
+    deltas = {}
+    for entry in entries:
+        charged, paid = deltas.get((entry["student_id"], entry["subject_id"]), (0, 0))
+        if entry["kind"] == "payment":
+            paid -= entry["amount_cents"]
+        else:
+            charged += entry["amount_cents"]
+        deltas[(entry["student_id"], entry["subject_id"])] = (charged, paid)
+    stmt = sqlite_insert(Balance).values([
+        {"student_id": st, "subject_id": subj, "charged_cents": charged, "paid_cents": paid,
+         "balance_cents": charged - paid}
+        for (st, subj), (charged, paid) in deltas.items()
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["student_id", "subject_id"],
+        set_={"charged_cents": Balance.charged_cents + stmt.excluded.charged_cents,
+              "paid_cents": Balance.paid_cents + stmt.excluded.paid_cents,
+              "balance_cents": Balance.balance_cents + stmt.excluded.balance_cents}
+    )
+    db.session.execute(stmt)
+
+def enrollment_entries(student_id, added, removed):
+    """Charge the package for newly enrolled subjects and reverse the charges of dropped ones."""
+    entries = []
+    if added:
+        for subj_id, price, discount in db.session.query(Subject.id, Subject.price, Subject.discount).filter(
+                Subject.id.in_(added)):
+            entries.append({"student_id": student_id, "subject_id": subj_id, "kind": "charge",
+                            "amount_cents": package_cents(price, discount), "note": "Enrolled"})
+    if removed:
+        charged = db.session.query(Balance.subject_id, Balance.charged_cents).filter(
+            Balance.student_id == student_id, Balance.subject_id.in_(removed)
+        ).all()
+        entries += [{"student_id": student_id, "subject_id": subj_id, "kind": "reversal",
+                     "amount_cents": -cents, "note": "Unenrolled"} for subj_id, cents in charged if cents]
+    return entries
+
+def payment_entry(payment):
+    return {"student_id": payment.student_id, "subject_id": payment.subject_id, "kind": "payment",
+            "amount_cents": -to_cents(payment.amount), "payment_id": payment.id, "note": payment.method}
+
+def rebuild_ledger():
+    """Re-open the ledger: one charge per current enrollment at today's price, one credit per payment."""
+    LedgerEntry.query.delete()
+    Balance.query.delete()
+    entries = []
+    enrollments = db.session.query(student_subjects.c.student_id, Subject.id, Subject.price, Subject.discount).join(
+        Subject, Subject.id == student_subjects.c.subject_id
+    ).all()
+    entries += [{"student_id": st, "subject_id": subj_id, "kind": "charge",
+                 "amount_cents": package_cents(price, discount), "note": "Opening charge"}
+                for st, subj_id, price, discount in enrollments]
+    entries += [payment_entry(p) for p in Payment.query.all()]
+    post_ledger(entries)
+    db.session.commit()
+
+@app.cli.command("rebuild-ledger")
+def rebuild_ledger_command():
+    """Recompute ledger entries and balances from enrollments and payments."""
+    rebuild_ledger()
+    print("Ledger rebuilt.")
+
 # -------------------------
 # Payments management
 # -------------------------
 @app.route("/payments", methods=["GET","POST"])
 def payments():
-    students = Student.query.order_by(Student.name.asc()).all()
-    subjects = Subject.query.order_by(Subject.name.asc()).all()
-
     if request.method == "POST":
         student_id = request.form.get("student_id", type=int)
         subject_id = request.form.get("subject_id", type=int)
-        amount = request.form.get("amount", type=float)
+        raw_amount = request.form.get("amount","").strip()
+        amount = parse_money(raw_amount)
         method = request.form.get("method","").strip()
-        if not all([student_id, subject_id, amount]):
+        if not all([student_id, subject_id, raw_amount]):
             flash("Student, subject, and amount are required.")
+        elif amount is None or amount <= 0:
+            flash("Amount must be a positive number.")
         else:
+            # Keep the cents exactly as typed rather than via a float
+            amount = to_cents(amount) / 100
             payment = Payment(student_id=student_id, subject_id=subject_id, amount=amount, method=method or None)
             db.session.add(payment)
+            db.session.flush()
+            post_ledger([payment_entry(payment)])
             db.session.commit()
             log_action("add_payment", f"Payment student={student_id}, subject={subject_id}, amount={amount}")
             flash("Payment recorded.")
         return redirect(url_for("payments"))
 
-    # Build payment overview per student+subject
-    overview = []
-    for s in students:
-        for subj in s.subjects:
-            paid = sum(p.amount for p in s.payments if p.subject_id == subj.id)
-            overview.append({
-                "student": s.name,
-                "subject": subj.name,
-                "price": subj.price,
-                "classes": subj.number_of_classes,
-                "discount": subj.discount,
-                "paid": paid,
-                "outstanding": max(subj.price - paid, 0)
-            })
+    # Payment overview per student+subject, read straight from the running balances
+    debtors = bool(request.args.get("debtors"))
+    query = db.session.query(
+        Student.name, Subject.name, Subject.price, Subject.number_of_classes, Subject.discount,
+        Balance.charged_cents, Balance.paid_cents, Balance.balance_cents
+    ).join(Student, Balance.student_id == Student.id).join(Subject, Balance.subject_id == Subject.id).filter(
+        or_(Balance.charged_cents != 0, Balance.paid_cents != 0)
+    )
+    if debtors:
+        query = query.filter(Balance.balance_cents > 0).order_by(Balance.balance_cents.desc())
+    else:
+        query = query.order_by(Student.name.asc(), Subject.name.asc())
+    overview = [{
+        "student": student, "subject": subject, "price": price, "classes": classes, "discount": discount,
+        "charged": charged, "paid": paid, "outstanding": max(balance, 0), "credit": max(-balance, 0)
+    } for student, subject, price, classes, discount, charged, paid, balance in query]
 
     page = """
     <h5>Payments</h5>
     <div class="mb-3">
       <a class="btn btn-sm btn-outline-success" href="{{ url_for('export_payments', format='csv') }}">Download CSV</a>
       <a class="btn btn-sm btn-outline-success" href="{{ url_for('export_payments', format='excel') }}">Download Excel</a>
+      <a class="btn btn-sm btn-outline-success" href="{{ url_for('export_payments', format='parquet') }}">Download Parquet</a>
+      {% if debtors %}
+        <a class="btn btn-sm btn-secondary" href="{{ url_for('payments') }}">All balances</a>
+      {% else %}
+        <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('payments', debtors=1) }}">Debtors only</a>
+      {% endif %}
+      <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('package_report') }}">Packages running out</a>
     </div>
     <form method="post" class="row g-2 mb-3">
-      <div class="col-md-3">
-        <select class="form-select" name="student_id" required>
-          <option value="">-- student --</option>
-          {% for s in students %}
-            <option value="{{ s.id }}">{{ s.name }}</option>
-          {% endfor %}
-        </select>
+      <div class="col-md-3 typeahead" data-source="{{ url_for('search_students') }}">
+        <input class="form-control typeahead-input" placeholder="Student" autocomplete="off">
+        <input type="hidden" name="student_id">
+        <div class="list-group typeahead-results"></div>
       </div>
-      <div class="col-md-3">
-        <select class="form-select" name="subject_id" required>
-          <option value="">-- subject --</option>
-          {% for subj in subjects %}
-            <option value="{{ subj.id }}">{{ subj.name }}</option>
-          {% endfor %}
-        </select>
+      <div class="col-md-3 typeahead" data-source="{{ url_for('search_subjects') }}">
+        <input class="form-control typeahead-input" placeholder="Subject" autocomplete="off">
+        <input type="hidden" name="subject_id">
+        <div class="list-group typeahead-results"></div>
       </div>
       <div class="col-md-2"><input class="form-control" name="amount" type="number" step="0.01" placeholder="Amount"></div>
       <div class="col-md-2"><input class="form-control" name="method" placeholder="Method (cash, card, etc.)"></div>
@@ -1270,7 +4317,7 @@ def payments():
     </form>
 
     <table class="table table-sm table-bordered">
-      <thead><tr><th>Student</th><th>Subject</th><th>Price</th><th>Classes</th><th>Discount</th><th>Paid</th><th>Outstanding</th></tr></thead>
+      <thead><tr><th>Student</th><th>Subject</th><th>Price</th><th>Classes</th><th>Discount</th><th>Charged</th><th>Paid</th><th>Outstanding</th></tr></thead>
       <tbody>
         {% for row in overview %}
           <tr>
@@ -1279,158 +4326,322 @@ def payments():
             <td>${{ "%.2f"|format(row.price) }}</td>
             <td>{{ row.classes }}</td>
             <td>{{ row.discount }}%</td>
-            <td>${{ "%.2f"|format(row.paid) }}</td>
-            <td>${{ "%.2f"|format(row.outstanding) }}</td>
+            <td>${{ money(row.charged) }}</td>
+            <td>${{ money(row.paid) }}</td>
+            <td>${{ money(row.outstanding) }}{% if row.credit %} <span class="text-success">(credit ${{ money(row.credit) }})</span>{% endif %}</td>
           </tr>
         {% endfor %}
       </tbody>
     </table>
     """
-    return render(page, students=students, subjects=subjects, overview=overview)
+    return render(page, overview=overview, debtors=debtors, money=format_cents)
 
 # -------------------------
 # Export routes
 # -------------------------
-@app.route("/export/students/<format>")
-def export_students(format):
-    students = Student.query.order_by(Student.name.asc()).all()
-    data = []
-    for s in students:
-        data.append({
-            "Name": s.name,
-            "Student ID": s.student_id or "",
-            "ID Number": s.id_number or "",
-            "Telephone": s.telephone or "",
-            "Mobile": s.mobile or "",
-            "Contact1": s.contact1_name or "",
-            "Contact1 Phone": s.contact1_phone or "",
-            "Contact2": s.contact2_name or "",
-            "Contact2 Phone": s.contact2_phone or "",
-            "Address": s.address or "",
-            "Subjects": ", ".join(subj.name for subj in s.subjects)
-        })
-    df = pd.DataFrame(data)
-    if format == "csv":
-        return send_file(io.BytesIO(df.to_csv(index=False).encode()), mimetype="text/csv",
-                         download_name="students.csv", as_attachment=True)
-    elif format == "excel":
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-            df.to_excel(writer, index=False)
-        output.seek(0)
-        return send_file(output, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                         download_name="students.xlsx", as_attachment=True)
+PARQUET_BATCH_ROWS = 50000
+NAME_TYPE = pa.dictionary(pa.int32(), pa.string())  # teacher/student/subject names repeat on every row
 
-@app.route("/export/payments/<format>")
-def export_payments(format):
-    payments = Payment.query.order_by(Payment.date.desc()).all()
+def send_parquet(query, schema, name):
+    """Stream a projected query into a Parquet file, one row group per batch of PARQUET_BATCH_ROWS rows.
+
+    The query's columns must line up with the schema's fields.
+    """
+    output = io.BytesIO()
+    result = db.session.execute(query.statement.execution_options(yield_per=PARQUET_BATCH_ROWS))
+    with pq.ParquetWriter(output, schema, compression="snappy") as writer:
+        for rows in result.partitions():
+            columns = list(zip(*rows))
+            writer.write_batch(pa.RecordBatch.from_arrays(
+                [pa.array(col, type=field.type) for col, field in zip(columns, schema)], schema=schema
+            ))
+    output.seek(0)
+    return send_file(output, mimetype="application/vnd.apache.parquet",
+                     download_name=f"{name}.parquet", as_attachment=True)
+
+TIMETABLE_SCHEMA = pa.schema([
+    ("Date", pa.date32()), ("Start", pa.time32("s")), ("End", pa.time32("s")),
+    ("Teacher", NAME_TYPE), ("Student", NAME_TYPE), ("Subject", NAME_TYPE), ("Notes", pa.string()),
+])
+
+def timetable_projection(filters):
+    """Typed timetable columns for Parquet, joined to the names in the same query."""
+    query = db.session.query(
+        ClassSession.session_date, ClassSession.start_time, ClassSession.end_time,
+        Teacher.name, Student.name, Subject.name, ClassSession.notes
+    ).join(Teacher, ClassSession.teacher_id == Teacher.id).join(
+        Student, ClassSession.student_id == Student.id
+    ).join(Subject, ClassSession.subject_id == Subject.id)
+    return filter_sessions(query, filters).order_by(ClassSession.session_date.asc(), ClassSession.start_time.asc())
+# Report builders: each returns one export's DataFrame. They take the
+# reference names and filters as arguments (no request or ORM relationships),
+# so the full report can run them side by side in worker threads.
+EXCEL_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+def load_reference_names():
+    """Teacher, student and subject names keyed by id, from the reference cache."""
+    refs = reference_lists()
+    return {
+        "teacher": {t.id: t.name for t in refs["teachers"]},
+        "nickname": {t.id: t.nickname for t in refs["teachers"]},
+        "student": {st.id: st.name for st in refs["students"]},
+        "subject": {subj.id: subj.name for subj in refs["subjects"]},
+    }
+
+def students_frame(names, filters):
+    subjects_by_student = {}
+    for student_id, subject_id in db.session.query(student_subjects.c.student_id, student_subjects.c.subject_id):
+        subjects_by_student.setdefault(student_id, []).append(names["subject"].get(subject_id, ""))
+    query = Student.query.order_by(Student.name.asc())
+    if filters.get("student_id"):
+        query = query.filter(Student.id == filters["student_id"])
+    data = [{
+        "Name": s.name,
+        "Student ID": s.student_id or "",
+        "ID Number": s.id_number or "",
+        "Telephone": s.telephone or "",
+        "Mobile": s.mobile or "",
+        "Contact1": s.contact1_name or "",
+        "Contact1 Phone": s.contact1_phone or "",
+        "Contact2": s.contact2_name or "",
+        "Contact2 Phone": s.contact2_phone or "",
+        "Address": s.address or "",
+        "Subjects": ", ".join(subjects_by_student.get(s.id, []))
+    } for s in query]
+    return pd.DataFrame(data, columns=["Name", "Student ID", "ID Number", "Telephone", "Mobile", "Contact1",
+                                       "Contact1 Phone", "Contact2", "Contact2 Phone", "Address", "Subjects"])
+
+def payments_frame(names, filters):
+    rows = filter_payments(
+        db.session.query(Payment.date, Payment.student_id, Payment.subject_id, Payment.amount, Payment.method),
+        filters
+    ).order_by(Payment.date.desc()).all()
+    return pd.DataFrame([{
+        "Date": d.isoformat() if d else "",
+        "Student": names["student"].get(student_id, ""),
+        "Subject": names["subject"].get(subject_id, ""),
+        "Amount": amount,
+        "Method": method or ""
+    } for d, student_id, subject_id, amount, method in rows], columns=["Date", "Student", "Subject", "Amount", "Method"])
+
+def attendance_frame(names, filters):
+    rows = filter_sessions(
+        db.session.query(Attendance.timestamp, Attendance.student_id, ClassSession.session_date,
+                         ClassSession.start_time, Attendance.status)
+        .join(ClassSession, Attendance.session_id == ClassSession.id),
+        filters
+    ).order_by(Attendance.timestamp.desc()).all()
+    return pd.DataFrame([{
+        "Timestamp": ts.strftime("%Y-%m-%d %H:%M"),
+        "Student": names["student"].get(student_id, ""),
+        "Session Date": d.isoformat(),
+        "Start": start.strftime("%H:%M"),
+        "Status": status
+    } for ts, student_id, d, start, status in rows],
+        columns=["Timestamp", "Student", "Session Date", "Start", "Status"])
+
+def timetable_frame(names, filters):
+    rows = filter_sessions(
+        db.session.query(ClassSession.session_date, ClassSession.start_time, ClassSession.end_time,
+                         ClassSession.teacher_id, ClassSession.student_id, ClassSession.subject_id, ClassSession.notes),
+        filters
+    ).order_by(ClassSession.session_date.asc(), ClassSession.start_time.asc()).all()
+    return pd.DataFrame([{
+        "Date": d.isoformat(),
+        "Start": start.strftime("%H:%M"),
+        "End": end.strftime("%H:%M"),
+        "Teacher": names["teacher"].get(teacher_id, ""),
+        "Student": names["student"].get(student_id, ""),
+        "Subject": names["subject"].get(subject_id, ""),
+        "Notes": notes or ""
+    } for d, start, end, teacher_id, student_id, subject_id, notes in rows],
+        columns=["Date", "Start", "End", "Teacher", "Student", "Subject", "Notes"])
+
+def teacher_totals_frame(names, filters):
+    counts = filter_sessions(
+        db.session.query(ClassSession.teacher_id, ClassSession.subject_id, func.count(ClassSession.id)),
+        filters
+    ).group_by(ClassSession.teacher_id, ClassSession.subject_id).all()
+    subject_counts_by_teacher = {}
+    for teacher_id, subject_id, n in counts:
+        subject_counts_by_teacher.setdefault(teacher_id, {})[names["subject"].get(subject_id, "")] = n
+    teacher_ids = sorted(names["teacher"], key=lambda tid: names["teacher"][tid])
+    if filters.get("teacher_id"):
+        teacher_ids = [tid for tid in teacher_ids if tid == filters["teacher_id"]]
     data = []
-    for p in payments:
+    for tid in teacher_ids:
+        subject_counts = dict(sorted(subject_counts_by_teacher.get(tid, {}).items()))
         data.append({
-            "Date": p.date.isoformat(),
-            "Student": p.student.name,
-            "Subject": p.subject.name,
-            "Amount": p.amount,
-            "Method": p.method or ""
+            "Teacher": names["teacher"][tid],
+            "Nickname": names["nickname"].get(tid) or "",
+            "Sessions": sum(subject_counts.values()),
+            "Total Students": sum(subject_counts.values()),
+            "Subject Breakdown": "; ".join([f"{k}: {v}" for k,v in subject_counts.items()])
         })
-    df = pd.DataFrame(data)
+    return pd.DataFrame(data, columns=["Teacher", "Nickname", "Sessions", "Total Students", "Subject Breakdown"])
+
+PAYROLL_UNPAID_STATUSES = ["Vacation"]  # the class did not take place
+PAYROLL_COLUMNS = ["Teacher", "Subject", "Sessions", "Paid Sessions", "Hours", "Rate/Hour", "Pay"]
+
+def payroll_frame(names, filters):
+    """Hours taught and pay per teacher and subject, plus a Total row per teacher.
+
+    One projected query; minutes, pay and totals are computed column-wise in pandas.
+    """
+    rows = filter_sessions(
+        db.session.query(ClassSession.teacher_id, ClassSession.subject_id, ClassSession.session_date,
+                         ClassSession.start_time, ClassSession.end_time, Attendance.status,
+                         Subject.teacher_rate_cents)
+        .join(Subject, ClassSession.subject_id == Subject.id)
+        .outerjoin(Attendance, (Attendance.session_id == ClassSession.id) &
+                   (Attendance.student_id == ClassSession.student_id)),
+        filters
+    ).all()
+    if not rows:
+        return pd.DataFrame(columns=PAYROLL_COLUMNS)
+    df = pd.DataFrame(rows, columns=["teacher_id", "subject_id", "date", "start", "end", "status", "rate_cents"])
+    minutes = (pd.to_timedelta(df["end"].astype(str)) - pd.to_timedelta(df["start"].astype(str))).dt.total_seconds() / 60
+    df["paid"] = ~df["status"].isin(PAYROLL_UNPAID_STATUSES)
+    df["paid_minutes"] = minutes.where(df["paid"], 0)
+    lines = df.groupby(["teacher_id", "subject_id"], as_index=False).agg(
+        sessions=("date", "size"), paid_sessions=("paid", "sum"), minutes=("paid_minutes", "sum"),
+        rate_cents=("rate_cents", "first")
+    )
+    # Round once per teacher and subject, in cents, so totals add up exactly
+    lines["pay_cents"] = np.rint(lines["minutes"] * lines["rate_cents"] / 60).astype("int64")
+    lines["Teacher"] = lines["teacher_id"].map(names["teacher"])
+    lines["Subject"] = lines["subject_id"].map(names["subject"])
+    totals = lines.groupby(["teacher_id", "Teacher"], as_index=False)[
+        ["sessions", "paid_sessions", "minutes", "pay_cents"]].sum()
+    totals["Subject"] = "Total"
+    totals["rate_cents"] = np.nan
+    out = pd.concat([lines.assign(order=0), totals.assign(order=1)], ignore_index=True).sort_values(
+        ["Teacher", "order", "Subject"])
+    return pd.DataFrame({
+        "Teacher": out["Teacher"], "Subject": out["Subject"],
+        "Sessions": out["sessions"].astype("int64"), "Paid Sessions": out["paid_sessions"].astype("int64"),
+        "Hours": (out["minutes"] / 60).round(2), "Rate/Hour": out["rate_cents"] / 100,
+        "Pay": out["pay_cents"] / 100,
+    }, columns=PAYROLL_COLUMNS).reset_index(drop=True)
+
+def logs_frame(names, filters):
+    rows = filter_logs(
+        db.session.query(LogEntry.timestamp, LogEntry.action, LogEntry.details), filters
+    ).order_by(LogEntry.timestamp.desc()).all()
+    return pd.DataFrame([{
+        "Time": ts.strftime("%Y-%m-%d %H:%M"),
+        "Action": action,
+        "Details": details or ""
+    } for ts, action, details in rows], columns=["Time", "Action", "Details"])
+
+def send_dataframe(df, format, name, sheet_name="Sheet1"):
+    """Send a DataFrame as CSV or a single-sheet Excel download."""
     if format == "csv":
         return send_file(io.BytesIO(df.to_csv(index=False).encode()), mimetype="text/csv",
-                         download_name="payments.csv", as_attachment=True)
+                         download_name=f"{name}.csv", as_attachment=True)
     elif format == "excel":
         output = io.BytesIO()
         with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-            df.to_excel(writer, index=False)
+            df.to_excel(writer, index=False, sheet_name=sheet_name)
         output.seek(0)
-        return send_file(output, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                         download_name="payments.xlsx", as_attachment=True)
-
+        return send_file(output, mimetype=EXCEL_MIMETYPE, download_name=f"{name}.xlsx", as_attachment=True)
+    return "Unknown export format.", 404
 
+@app.route("/export/students/<format>")
+def export_students(format):
+    return send_dataframe(students_frame(load_reference_names(), export_filters()), format, "students")
 
+@app.route("/export/payments/<format>")
+def export_payments(format):
+    filters = export_filters()
+    if format == "parquet":
+        query = db.session.query(Payment.date, Student.name, Subject.name, Payment.amount, Payment.method).join(
+            Student, Payment.student_id == Student.id
+        ).join(Subject, Payment.subject_id == Subject.id)
+        schema = pa.schema([("Date", pa.date32()), ("Student", NAME_TYPE), ("Subject", NAME_TYPE),
+                            ("Amount", pa.float64()), ("Method", NAME_TYPE)])
+        return send_parquet(filter_payments(query, filters).order_by(Payment.date.desc()), schema, "payments")
+    return send_dataframe(payments_frame(load_reference_names(), filters), format, "payments")
 
 @app.route("/export/attendance/<format>")
 def export_attendance(format):
-    records = Attendance.query.order_by(Attendance.timestamp.desc()).all()
-    data = []
-    for r in records:
-        data.append({
-            "Timestamp": r.timestamp.strftime("%Y-%m-%d %H:%M"),
-            "Student": r.student.name,
-            "Session Date": r.session.session_date.isoformat(),
-            "Start": r.session.start_time.strftime("%H:%M"),
-            "Status": r.status
-        })
-    df = pd.DataFrame(data)
-    if format == "csv":
-        return send_file(io.BytesIO(df.to_csv(index=False).encode()), mimetype="text/csv",
-                         download_name="attendance.csv", as_attachment=True)
-    elif format == "excel":
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-            df.to_excel(writer, index=False)
-        output.seek(0)
-        return send_file(output, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                         download_name="attendance.xlsx", as_attachment=True)
+    filters = export_filters()
+    if format == "parquet":
+        query = db.session.query(
+            Attendance.timestamp, Student.name, ClassSession.session_date, ClassSession.start_time, Attendance.status
+        ).join(ClassSession, Attendance.session_id == ClassSession.id).join(Student, Attendance.student_id == Student.id)
+        schema = pa.schema([("Timestamp", pa.timestamp("us")), ("Student", NAME_TYPE), ("Session Date", pa.date32()),
+                            ("Start", pa.time32("s")), ("Status", NAME_TYPE)])
+        return send_parquet(filter_sessions(query, filters).order_by(Attendance.timestamp.desc()), schema, "attendance")
+    return send_dataframe(attendance_frame(load_reference_names(), filters), format, "attendance")
 
 @app.route("/export/timetable/<format>")
 def export_timetable(format):
-    sessions = ClassSession.query.order_by(ClassSession.session_date.asc(), ClassSession.start_time.asc()).all()
-    data = [{
-        "Date": s.session_date.isoformat(),
-        "Start": s.start_time.strftime("%H:%M"),
-        "End": s.end_time.strftime("%H:%M"),
-        "Teacher": s.teacher.name,
-        "Student": s.student.name,
-        "Subject": s.subject.name,
-        "Notes": s.notes or ""
-    } for s in sessions]
-    df = pd.DataFrame(data)
-    if format == "csv":
-        return send_file(io.BytesIO(df.to_csv(index=False).encode()), mimetype="text/csv",
-                         download_name="timetable.csv", as_attachment=True)
-    elif format == "excel":
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-            df.to_excel(writer, index=False, sheet_name="Timetable")
-        output.seek(0)
-        return send_file(output, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                         download_name="timetable.xlsx", as_attachment=True)
+    if format == "parquet":
+        return send_parquet(timetable_projection(export_filters()), TIMETABLE_SCHEMA, "timetable")
+    return send_dataframe(timetable_frame(load_reference_names(), export_filters()), format, "timetable",
+                          sheet_name="Timetable")
 
 @app.route("/export/teacher_totals/<format>")
 def export_teacher_totals(format):
-    teachers = Teacher.query.order_by(Teacher.name.asc()).all()
-    data = []
-    for t in teachers:
-        subject_counts = {}
-        for s in t.sessions:
-            subj_name = s.subject.name
-            subject_counts[subj_name] = subject_counts.get(subj_name, 0) + 1
-        total_students = sum(subject_counts.values())
-        data.append({
-            "Teacher": t.name,
-            "Nickname": t.nickname or "",
-            "Sessions": len(t.sessions),
-            "Total Students": total_students,
-            "Subject Breakdown": "; ".join([f"{k}: {v}" for k,v in subject_counts.items()])
-        })
-    df = pd.DataFrame(data)
-    if format == "csv":
-        return send_file(io.BytesIO(df.to_csv(index=False).encode()), mimetype="text/csv",
-                         download_name="teacher_totals.csv", as_attachment=True)
-    elif format == "excel":
-        output = io.BytesIO()
+    return send_dataframe(teacher_totals_frame(load_reference_names(), export_filters()), format, "teacher_totals",
+                          sheet_name="TeacherTotals")
+
+@app.route("/export/payroll/<format>")
+def export_payroll(format):
+    return send_dataframe(payroll_frame(load_reference_names(), monthly_filters()), format, "payroll",
+                          sheet_name="Payroll")
+
+FULL_REPORT = [
+    ("Students", students_frame),
+    ("Payments", payments_frame),
+    ("Attendance", attendance_frame),
+    ("Timetable", timetable_frame),
+    ("TeacherTotals", teacher_totals_frame),
+    ("Payroll", payroll_frame),
+    ("Logs", logs_frame),
+]
+
+def _build_report(builder, names, filters, as_csv):
+    # Runs in a worker thread: its own app context gives it its own database session
+    with app.app_context():
+        df = builder(names, filters)
+        return df.to_csv(index=False).encode() if as_csv else df
+
+@app.route("/export/full_report/<format>")
+def export_full_report(format):
+    """Every report in one download: sheets of one workbook (excel) or CSV files in a ZIP (zip)."""
+    if format not in ("excel", "zip"):
+        return "Unknown export format.", 404
+    filters = export_filters()
+    names = load_reference_names()
+    with ThreadPoolExecutor(max_workers=len(FULL_REPORT)) as pool:
+        futures = [(sheet, pool.submit(_build_report, builder, names, filters, format == "zip"))
+                   for sheet, builder in FULL_REPORT]
+        reports = [(sheet, future.result()) for sheet, future in futures]
+
+    # Spill large bundles to disk; send_file streams the file out in chunks
+    output = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+    stamp = date.today().isoformat()
+    if format == "zip":
+        with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED) as bundle:
+            for sheet, payload in reports:
+                bundle.writestr(f"{sheet.lower()}.csv", payload)
+        mimetype, download_name = "application/zip", f"full_report_{stamp}.zip"
+    else:
         with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-            df.to_excel(writer, index=False, sheet_name="TeacherTotals")
-        output.seek(0)
-        return send_file(output, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                         download_name="teacher_totals.xlsx", as_attachment=True)
+            for sheet, df in reports:
+                df.to_excel(writer, index=False, sheet_name=sheet)
+        mimetype, download_name = EXCEL_MIMETYPE, f"full_report_{stamp}.xlsx"
+    output.seek(0)
+    return send_file(output, mimetype=mimetype, download_name=download_name, as_attachment=True)
 
 @app.route("/export/weekly/<format>")
 def export_weekly(format):
     today = date.today()
     start_week = today - timedelta(days=today.weekday())
     end_week = start_week + timedelta(days=7)
-    sessions = ClassSession.query.filter(
+    sessions = ClassSession.query.options(*SESSION_NAMES).filter(
         ClassSession.session_date >= start_week,
         ClassSession.session_date < end_week
     ).order_by(ClassSession.session_date.asc(), ClassSession.start_time.asc()).all()
@@ -1456,35 +4667,26 @@ def export_weekly(format):
 
 @app.route("/export/logs/<format>")
 def export_logs(format):
-    entries = LogEntry.query.order_by(LogEntry.timestamp.desc()).all()
-    data = [{
-        "Time": e.timestamp.strftime("%Y-%m-%d %H:%M"),
-        "Action": e.action,
-        "Details": e.details or ""
-    } for e in entries]
-    df = pd.DataFrame(data)
-    if format == "csv":
-        return send_file(io.BytesIO(df.to_csv(index=False).encode()), mimetype="text/csv",
-                         download_name="logs.csv", as_attachment=True)
-    elif format == "excel":
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-            df.to_excel(writer, index=False, sheet_name="Logs")
-        output.seek(0)
-        return send_file(output, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                         download_name="logs.xlsx", as_attachment=True)
+    return send_dataframe(logs_frame(load_reference_names(), export_filters()), format, "logs", sheet_name="Logs")
 
 # -------------------------
 # Download routes (monthly exports)
 # -------------------------
+def monthly_filters():
+    """Export filters defaulting to the current month when no start/end is given."""
+    filters = export_filters()
+    if not filters["start"] and not filters["end"]:
+        first, next_first = month_bounds(date.today())
+        filters["start"], filters["end"] = first, next_first - timedelta(days=1)
+    return filters
 
 @app.route("/download_timetable/<format>")
 def download_timetable(format):
-    today = date.today()
-    sessions = ClassSession.query.filter(
-        extract("year", ClassSession.session_date) == today.year,
-        extract("month", ClassSession.session_date) == today.month
-    ).order_by(ClassSession.session_date.asc(), ClassSession.start_time.asc()).all()
+    if format == "parquet":
+        return send_parquet(timetable_projection(monthly_filters()), TIMETABLE_SCHEMA, "timetable")
+    sessions = filter_sessions(ClassSession.query.options(*SESSION_NAMES), monthly_filters()).order_by(
+        ClassSession.session_date.asc(), ClassSession.start_time.asc()
+    ).all()
 
     data = [{
         "Date": s.session_date.isoformat(),
@@ -1539,19 +4741,26 @@ def download_payments(format):
 
 @app.route("/download_totals/<format>")
 def download_totals(format):
-    today = date.today()
-    teachers = Teacher.query.order_by(Teacher.name.asc()).all()
+    filters = monthly_filters()
+    teachers = Teacher.query.order_by(Teacher.name.asc())
+    if filters["teacher_id"]:
+        teachers = teachers.filter(Teacher.id == filters["teacher_id"])
+    # One grouped query for every teacher's per-subject counts in the range
+    counts = filter_sessions(
+        db.session.query(ClassSession.teacher_id, Subject.name, func.count(ClassSession.id))
+        .join(Subject, ClassSession.subject_id == Subject.id),
+        filters
+    ).group_by(ClassSession.teacher_id, Subject.name).order_by(Subject.name.asc()).all()
+    subject_counts_by_teacher = {}
+    for teacher_id, subj, count in counts:
+        subject_counts_by_teacher.setdefault(teacher_id, {})[subj] = count
     data = []
-    for t in teachers:
-        sessions = current_month_sessions().filter_by(teacher_id=t.id).all()
-        subject_counts = {}
-        for s in sessions:
-            subj = s.subject.name
-            subject_counts[subj] = subject_counts.get(subj, 0) + 1
+    for t in teachers.all():
+        subject_counts = subject_counts_by_teacher.get(t.id, {})
         data.append({
             "Teacher": t.name,
             "Nickname": t.nickname or "",
-            "Total Sessions": len(sessions),
+            "Total Sessions": sum(subject_counts.values()),
             "Subject Breakdown": "; ".join([f"{k}: {v}" for k,v in subject_counts.items()])
         })
     df = pd.DataFrame(data)
@@ -1570,7 +4779,7 @@ def download_totals(format):
 
 @app.route("/download_logs/<format>")
 def download_logs(format):
-    entries = LogEntry.query.order_by(LogEntry.timestamp.desc()).all()
+    entries = filter_logs(LogEntry.query, export_filters()).order_by(LogEntry.timestamp.desc()).all()
     data = [{
         "Time": e.timestamp.strftime("%Y-%m-%d %H:%M"),
         "Action": e.action,
@@ -1589,11 +4798,154 @@ def download_logs(format):
         return send_file(output, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                          download_name="logs.xlsx", as_attachment=True)
 
+# -------------------------
+# Backups (SQLite online backup API)
+# -------------------------
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_SLEEP = 0.005  # seconds between steps, so writers get the lock back
+
+def database_path():
+    return db.engine.url.database
+
+def list_backups():
+    """Snapshot file names, newest first."""
+    backup_dir = app.config["BACKUP_DIR"]
+    if not os.path.isdir(backup_dir):
+        return []
+    return sorted((n for n in os.listdir(backup_dir) if n.startswith("schedule-") and n.endswith(".db.gz")),
+                  reverse=True)
+
+def create_backup():
+    """Copy the live database page-batch by page-batch into a gzip snapshot; returns its file name.
+
+    The backup API only holds the read lock for one step at a time, so
+    requests keep writing while a snapshot is taken. Changes made mid-copy
+    restart the copy, so the snapshot is always consistent.
+    """
+    backup_dir = app.config["BACKUP_DIR"]
+    os.makedirs(backup_dir, exist_ok=True)
+    name = f"schedule-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.db.gz"
+    fd, tmp_path = tempfile.mkstemp(dir=backup_dir, suffix=".db")
+    os.close(fd)
+    try:
+        source = sqlite3.connect(database_path())
+        target = sqlite3.connect(tmp_path)
+        try:
+            source.backup(target, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_SLEEP)
+        finally:
+            target.close()
+            source.close()
+        with open(tmp_path, "rb") as raw, gzip.open(os.path.join(backup_dir, name + ".part"), "wb") as packed:
+            shutil.copyfileobj(raw, packed)
+        os.replace(os.path.join(backup_dir, name + ".part"), os.path.join(backup_dir, name))
+    finally:
+        os.remove(tmp_path)
+    prune_backups()
+    return name
+
+def prune_backups():
+    """Delete snapshots beyond BACKUP_RETENTION, oldest first."""
+    for name in list_backups()[app.config["BACKUP_RETENTION"]:]:
+        os.remove(os.path.join(app.config["BACKUP_DIR"], name))
+
+def change_log_sequence(conn):
+    """Highest change_log version ever handed out on a raw sqlite3 connection, 0 if none."""
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_sequence'").fetchone():
+        return 0
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+    return row[0] if row else 0
+
+def restore_backup(name):
+    """Replace the live database contents with a snapshot, taking a safety snapshot first.
+
+    This process's cached names, home timetables and calendar feeds are
+    dropped afterwards. Another process serving the same database keeps its
+    own caches, so a server must be restarted after a restore from the CLI.
+    """
+    if name not in list_backups():
+        raise ValueError(f"No backup named {name}")
+    fd, tmp_path = tempfile.mkstemp(dir=app.config["BACKUP_DIR"], suffix=".db")
+    os.close(fd)
+    try:
+        with gzip.open(os.path.join(app.config["BACKUP_DIR"], name), "rb") as packed, open(tmp_path, "wb") as raw:
+            shutil.copyfileobj(packed, raw)
+        # Unpack first: the safety snapshot may prune the one being restored
+        safety = create_backup()
+        db.session.remove()
+        db.engine.dispose()
+        source = sqlite3.connect(tmp_path)
+        target = sqlite3.connect(database_path())
+        try:
+            high = change_log_sequence(target)
+            source.backup(target, pages=BACKUP_PAGES_PER_STEP)
+            # The snapshot's change_log ends at an older version; carry on numbering from
+            # where the live one was, so feed clients and a running server's broadcaster
+            # (both at or below `high`) never skip changes made after the restore
+            if high and change_log_sequence(target) < high:
+                with target:
+                    target.execute("DELETE FROM sqlite_sequence WHERE name = 'change_log'")
+                    target.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('change_log', ?)", (high,))
+        finally:
+            target.close()
+            source.close()
+            # After the copy, so nothing read from the old file while it ran stays cached
+            invalidate_reference_cache()
+            with _home_lock:
+                _home_cache.clear()
+            with _ics_lock:
+                _ics_cache.clear()
+    finally:
+        os.remove(tmp_path)
+    return safety
+
+def start_backup_scheduler():
+    """Take a snapshot every BACKUP_INTERVAL_HOURS in a daemon thread."""
+    interval = app.config["BACKUP_INTERVAL_HOURS"] * 3600
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                with app.app_context():
+                    print(f"Backup written: {create_backup()}")
+            except Exception:
+                app.logger.exception("Scheduled backup failed")
+
+    threading.Thread(target=run, name="backup-scheduler", daemon=True).start()
+
+@app.cli.command("backup")
+def backup_command():
+    """Write a compressed snapshot of the database."""
+    print(f"Backup written: {create_backup()}")
+
+@app.cli.command("list-backups")
+def list_backups_command():
+    """List snapshots, newest first."""
+    for name in list_backups():
+        print(name)
+
+@app.cli.command("restore")
+@click.argument("name")
+def restore_command(name):
+    """Restore the database from snapshot NAME (see list-backups), then restart any running server.
+
+    A server keeps names, timetables and calendar feeds cached in memory and
+    would go on serving them from before the restore until restarted.
+    """
+    try:
+        safety = restore_backup(name)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    print(f"Restored {name}; previous state saved as {safety}.")
+    print("Restart the web server so it drops data cached from before the restore.")
+
 
 if __name__ == "__main__":
     import os
     port = int(os.environ.get("PORT", 5000))
     with app.app_context():
-        db.create_all()   # <-- creates tables if they don't exist
+        ensure_schema()   # <-- creates tables and indexes if they don't exist
         print("Database tables created/verified.")
+    if app.config["BACKUP_INTERVAL_HOURS"] > 0:
+        start_backup_scheduler()
     app.run(host="0.0.0.0", port=port)